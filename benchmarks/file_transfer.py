@@ -0,0 +1,123 @@
+"""Loopback throughput of the file transfer path.
+
+Sends the same file once as plaintext frames through sendfile and once as
+encrypted chunks through a session's SendQueue, the path Model sends files
+on, then reports MB/s for both. Both ends run in this process and share one
+interpreter, so the target for a 1 GB file is an absolute TARGET_MBPS for the
+encrypted path, several times gigabit line rate, rather than parity with
+sendfile.
+
+    python benchmarks/file_transfer.py [size_in_mb]
+"""
+import os
+import socket
+import sys
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from noise.connection import NoiseConnection
+from peerlink.codec import FileHeader, JsonCodec
+from peerlink.network import FrameDecoder, Sender
+from peerlink.transfer import CHUNK_HEADER, SendQueue
+
+TARGET_MBPS = 250
+MB = 1024 * 1024
+
+
+def make_file(size):
+    file = NamedTemporaryFile(delete=False)
+    block = os.urandom(MB)
+    for _ in range(size // MB):
+        file.write(block)
+    file.write(block[:size % MB])
+    file.close()
+    return file.name
+
+
+def session_pair():
+    initiator = NoiseConnection.from_name(b'Noise_NN_25519_ChaChaPoly_SHA256')
+    responder = NoiseConnection.from_name(b'Noise_NN_25519_ChaChaPoly_SHA256')
+    initiator.set_as_initiator()
+    responder.set_as_responder()
+    initiator.start_handshake()
+    responder.start_handshake()
+    responder.read_message(initiator.write_message())
+    initiator.read_message(responder.write_message())
+    return initiator, responder
+
+
+def serve(listener, size, proto, result, resume=None):
+    # With a proto the first frame is the file's header, answered like a
+    # peer that has none of it yet.
+    conn, _ = listener.accept()
+    decoder = FrameDecoder()
+    remaining = size
+    with open(os.devnull, 'wb') as sink:
+        while remaining:
+            if not decoder.recv_from(conn):
+                break
+            for frame in decoder.frames():
+                if proto:
+                    frame = proto.decrypt(frame)
+                    if resume:
+                        resume()
+                        resume = None
+                        continue
+                    frame = memoryview(frame)[CHUNK_HEADER.size:]
+                sink.write(frame)
+                remaining -= len(frame)
+    result.append(perf_counter())
+    conn.close()
+
+
+def run(path, size, encrypted):
+    listener = socket.create_server(('127.0.0.1', 0))
+    result = []
+    if not encrypted:
+        server = Thread(target=serve, args=(listener, size, None, result))
+        server.start()
+        sender = Sender(*listener.getsockname()).connect()
+        start = perf_counter()
+        sender.send_file(path)
+        server.join()
+        sender.socket.close()
+        listener.close()
+        return size / MB / (result[0] - start)
+    initiator, responder = session_pair()
+    header = FileHeader.from_path(path)
+    sender = Sender(*listener.getsockname())
+    outbox = SendQueue(sender, initiator, labels={'session': 'benchmark'})
+    server = Thread(target=serve, args=(listener, size, responder, result,
+                                        lambda: outbox.resume(header.transfer, [[0, size]])))
+    server.start()
+    sender.connect()
+    outbox.start()
+    start = perf_counter()
+    outbox.send_file(path, header.transfer, JsonCodec().encode(header))
+    server.join()
+    outbox.close()
+    sender.socket.close()
+    listener.close()
+    return size / MB / (result[0] - start)
+
+
+def main():
+    size = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 1024 * MB
+    path = make_file(size)
+    try:
+        plain = run(path, size, False)
+        secure = run(path, size, True)
+    finally:
+        os.remove(path)
+    print(f"plaintext sendfile : {plain:8.1f} MB/s")
+    print(f"encrypted chunks   : {secure:8.1f} MB/s")
+    status = "ok" if secure >= TARGET_MBPS else "below target"
+    print(f"encrypted / plain  : {secure / plain:8.2f}")
+    print(f"target             : {TARGET_MBPS:8d} MB/s {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+"""Headless loopback benchmark suite.
+
+Runs two headless Model nodes in this process over loopback, with mDNS
+stubbed out, and measures the codec, the handshake, chat, file transfer and
+chat latency while a file is being sent.
+Results are printed and saved as JSON so runs can be compared across commits.
+
+    python benchmarks/run.py [--messages N] [--file-mb N] [--engine NAME]
+                             [--no-compress] [--streams N] [--dedup]
+                             [--room-members N] [--fanout N]
+                             [--output PATH] [--compare PATH]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+from statistics import median, quantiles
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Event
+from time import perf_counter, sleep, time
+from timeit import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stubs
+
+stubs.install()
+
+from peerlink.codec import BinaryCodec, JsonCodec, Text, decode
+from peerlink.model import Model
+from peerlink.rooms import FANOUT_DROPPED, Room
+
+from file_transfer import make_file
+
+MB = 1024 * 1024
+WAIT_TIMEOUT = 60.0
+# Posts the room benchmark lets the host get ahead of the slowest member.
+ROOM_WINDOW = 64
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def wait(event: Event, what: str):
+    if not event.wait(WAIT_TIMEOUT):
+        raise TimeoutError(f"Timed out waiting for {what}")
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss / MB if sys.platform == "darwin" else rss / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def make_text_file(size: int) -> str:
+    # CSV-like rows compress about as well as real logs and exports do.
+    file = NamedTemporaryFile("w", suffix=".csv", delete=False)
+    written = row = 0
+    while written < size:
+        line = f"{row},2024-01-{row % 28 + 1:02d}T{row % 24:02d}:00:00,sensor-{row % 97},{row * 7 % 1000 / 10}\n"
+        written += file.write(line)
+        row += 1
+    file.close()
+    return file.name
+
+
+class Pair:
+    def __init__(self, engine: str, compress: bool = True, streams: int = 1,
+                 dedup: bool = False) -> None:
+        # Fresh identities every run, the first handshake is XX and the
+        # ones after it IK.
+        self.home = TemporaryDirectory()
+        self.alice = Model(free_port(), engine, compress, self.home.name, streams=streams,
+                           dedup=dedup)
+        self.bob = Model(free_port(), engine, compress, self.home.name, dedup=dedup)
+        self.alice.set_username("alice")
+        self.bob.set_username("bob")
+        self.secured = Event()
+        self.bob.onreqrecv.connect(self._bob_request)
+        self.alice.onconnsecure.connect(self._alice_secured)
+
+    def _bob_request(self, uuid, name, ip, port):
+        self.bob.accept_req(uuid)
+
+    def _alice_secured(self, uuid):
+        self.secured.set()
+
+    def connect(self) -> float:
+        self.secured.clear()
+        start = perf_counter()
+        self.alice.send_req(*self.bob.receiver.addr)
+        wait(self.secured, "handshake")
+        elapsed = perf_counter() - start
+        # The responder finishes its side after the initiator.
+        while not all(session.outbox for session in self.bob.sessions):
+            sleep(0.001)
+        return elapsed
+
+    def disconnect(self):
+        self.alice.disconnect()
+        while len(self.bob.sessions):
+            sleep(0.001)
+
+    def close(self):
+        self.alice.shutdown()
+        self.bob.shutdown()
+        self.home.cleanup()
+
+
+def bench_codec(count: int = 100000) -> dict:
+    results = {}
+    message = Text("The quick brown fox jumps over the lazy dog")
+    for codec in (BinaryCodec(), JsonCodec()):
+        encoded = codec.encode(message)
+        encode = timeit(lambda: codec.encode(message), number=count)
+        decoded = timeit(lambda: decode(encoded), number=count)
+        results[codec.name] = {"encode_per_sec": count / encode,
+                               "decode_per_sec": count / decoded,
+                               "bytes": len(encoded)}
+    return results
+
+
+def bench_handshake(pair: Pair, rounds: int = 20) -> dict:
+    times = []
+    for _ in range(rounds):
+        times.append(pair.connect())
+        pair.disconnect()
+    return {"first_ms": times[0] * 1000, "median_ms": median(times[1:]) * 1000,
+            "max_ms": max(times) * 1000}
+
+
+def bench_chat(pair: Pair, count: int) -> dict:
+    latencies = []
+    done = Event()
+
+    def recieved(uuid, text, sent):
+        latencies.append(time() - sent)
+        if len(latencies) == count:
+            done.set()
+
+    pair.bob.ontext.connect(recieved)
+    start = perf_counter()
+    for i in range(count):
+        while not pair.alice.send_msg(f"message {i}"):
+            sleep(0.0005)
+    wait(done, "chat messages")
+    elapsed = perf_counter() - start
+    pair.bob.ontext.disconnect(recieved)
+    p50, p99 = quantiles(latencies, n=100)[49], quantiles(latencies, n=100)[98]
+    return {"messages": count, "messages_per_sec": count / elapsed,
+            "p50_ms": p50 * 1000, "p99_ms": p99 * 1000}
+
+
+def bench_file(pair: Pair, size: int, text: bool = False) -> dict:
+    done = Event()
+
+    def finished(uuid):
+        done.set()
+
+    pair.bob.onfilefinished.connect(finished)
+    path = make_text_file(size) if text else make_file(size)
+    before = compressed_bytes(pair.alice)
+    cwd = os.getcwd()
+    try:
+        with TemporaryDirectory() as target:
+            os.chdir(target)
+            start = perf_counter()
+            pair.alice.send_file(path)
+            wait(done, "file transfer")
+            elapsed = perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        os.remove(path)
+        pair.bob.onfilefinished.disconnect(finished)
+    raw, wire = (after - start for after, start in zip(compressed_bytes(pair.alice), before))
+    streams = pair.alice.metrics().get("peerlink_file_streams", [{"value": 1}])
+    return {"bytes": size, "mb_per_sec": size / MB / elapsed,
+            "compression_ratio": wire / raw if raw else 1.0,
+            "streams": max(series["value"] for series in streams)}
+
+
+def bench_chat_during_file(pair: Pair, size: int, interval: float = 0.01) -> dict:
+    # A message every interval for as long as a file is being sent to the
+    # same peer over the same session.
+    latencies = []
+    done = Event()
+
+    def recieved(uuid, text, sent):
+        latencies.append(time() - sent)
+
+    def finished(uuid):
+        done.set()
+
+    pair.bob.ontext.connect(recieved)
+    pair.bob.onfilefinished.connect(finished)
+    path = make_file(size)
+    cwd = os.getcwd()
+    try:
+        with TemporaryDirectory() as target:
+            os.chdir(target)
+            start = perf_counter()
+            pair.alice.send_file(path)
+            while not done.wait(interval):
+                pair.alice.send_msg("still there?")
+            elapsed = perf_counter() - start
+            # The last few may still be on their way.
+            sleep(0.1)
+    finally:
+        os.chdir(cwd)
+        os.remove(path)
+        pair.bob.ontext.disconnect(recieved)
+        pair.bob.onfilefinished.disconnect(finished)
+    if len(latencies) < 2:
+        return {"messages": len(latencies), "file_mb_per_sec": size / MB / elapsed}
+    # Only a handful of samples, the inclusive method never reports past the
+    # largest one.
+    cuts = quantiles(latencies, n=100, method="inclusive")
+    return {"messages": len(latencies), "p50_ms": cuts[49] * 1000, "p99_ms": cuts[98] * 1000,
+            "max_ms": max(latencies) * 1000, "file_mb_per_sec": size / MB / elapsed}
+
+
+def bench_two_files(pair: Pair, size: int) -> dict:
+    # Two files sent at once, each should get about half the link.
+    finished = []
+    done = Event()
+
+    def recieved(uuid):
+        finished.append(perf_counter())
+        if len(finished) == 2:
+            done.set()
+
+    pair.bob.onfilefinished.connect(recieved)
+    paths = [make_file(size), make_file(size)]
+    cwd = os.getcwd()
+    try:
+        with TemporaryDirectory() as target:
+            os.chdir(target)
+            start = perf_counter()
+            for path in paths:
+                pair.alice.send_file(path)
+            wait(done, "file transfers")
+    finally:
+        os.chdir(cwd)
+        for path in paths:
+            os.remove(path)
+        pair.bob.onfilefinished.disconnect(recieved)
+    first, second = (end - start for end in finished)
+    return {"first_seconds": first, "second_seconds": second,
+            "mb_per_sec": 2 * size / MB / second}
+
+
+def bench_resend(pair: Pair, size: int, edits: int = 40) -> dict:
+    # The same file twice, the second time with about 1% of it rewritten in
+    # scattered places, the way a rebuilt artifact or an edited export is.
+    done = Event()
+
+    def finished(uuid):
+        done.set()
+
+    pair.bob.onfilefinished.connect(finished)
+    file = NamedTemporaryFile(delete=False)
+    for _ in range(size // MB):
+        file.write(os.urandom(MB))
+    file.write(os.urandom(size % MB))
+    file.close()
+    runs = []
+    cwd = os.getcwd()
+    try:
+        with TemporaryDirectory() as target:
+            os.chdir(target)
+            for run in range(2):
+                if run:
+                    os.remove(os.path.basename(file.name))
+                    with open(file.name, "r+b") as edited:
+                        for edit in range(edits):
+                            edited.seek(size // edits * edit)
+                            edited.write(os.urandom(size // edits // 100))
+                done.clear()
+                before = wire_bytes(pair.alice)
+                start = perf_counter()
+                pair.alice.send_file(file.name)
+                wait(done, "file transfer")
+                runs.append({"seconds": perf_counter() - start,
+                             "wire_mb": (wire_bytes(pair.alice) - before) / MB})
+    finally:
+        os.chdir(cwd)
+        os.remove(file.name)
+        pair.bob.onfilefinished.disconnect(finished)
+    return {"bytes": size, "first": runs[0], "resend": runs[1]}
+
+
+def bench_room(engine: str, members: int, count: int, fanout: int = 0) -> dict:
+    # One room of members nodes, the host posts count texts and never gets
+    # more than ROOM_WINDOW ahead of the slowest member, the rate it keeps
+    # up is the one all members can take. Posts dropped anyway are counted.
+    home = TemporaryDirectory()
+    nodes = [Model(free_port(), engine, home=home.name) for _ in range(members)]
+    recieved = [0] * members
+    done = Event()
+    last = [0.0]
+
+    def post(index, room, uuid, text, sent):
+        recieved[index] += 1
+        last[0] = perf_counter()
+        if all(total == count for total in recieved[1:]):
+            done.set()
+
+    try:
+        for index, node in enumerate(nodes):
+            node.set_username(f"member{index}")
+            node.onroomtext.connect(lambda *args, index=index: post(index, *args))
+        host = nodes[0]
+        host.create_room("bench", fanout)
+        start = perf_counter()
+        for node in nodes[1:]:
+            node.join_room("bench", *host.receiver.addr)
+        while not all(len(node.rooms.get("bench", Room("", "")).members) == members
+                      and node.linked("bench") for node in nodes):
+            sleep(0.001)
+        joined = perf_counter() - start
+        before = wire_bytes(host)
+        dropped = FANOUT_DROPPED.value
+        start = last[0] = perf_counter()
+        for index in range(count):
+            while index - min(recieved[1:]) >= ROOM_WINDOW and perf_counter() - last[0] < 1.0:
+                sleep(0.0005)
+            host.send_room("bench", f"announcement {index} " + "x" * 64)
+        # Done when everything arrived or nothing did for a second.
+        while not done.wait(0.1) and perf_counter() - last[0] < 1.0:
+            pass
+        elapsed = last[0] - start
+        wire = wire_bytes(host) - before
+        dropped = FANOUT_DROPPED.value - dropped
+    finally:
+        for node in nodes:
+            node.shutdown()
+        home.cleanup()
+    return {"members": members, "fanout": fanout, "join_seconds": joined,
+            "posts_per_sec": count / elapsed,
+            "deliveries_per_sec": sum(recieved[1:]) / elapsed,
+            "delivered": sum(recieved[1:]) / (count * (members - 1)),
+            "dropped": dropped,
+            "wire_bytes_per_post": wire / count}
+
+
+def wire_bytes(model: Model) -> int:
+    return sum(series["value"]
+               for series in model.metrics().get("peerlink_session_bytes_out_total", ()))
+
+
+def compressed_bytes(model: Model):
+    metrics = model.metrics()
+    return [sum(series["value"] for series in metrics.get(name, ()))
+            for name in ("peerlink_session_compress_raw_bytes_total",
+                         "peerlink_session_compress_wire_bytes_total")]
+
+
+def compare(current: dict, path: str):
+    with open(path) as file:
+        previous = json.load(file)
+    print(f"\nCompared with {path} ({previous.get('commit', '?')}):")
+    for section, values in current.items():
+        if not isinstance(values, dict) or section not in previous:
+            continue
+        for key, value in _flatten(values):
+            old = dict(_flatten(previous[section])).get(key)
+            if isinstance(value, (int, float)) and old:
+                print(f"  {section}.{key:<28} {old:12.2f} -> {value:12.2f} "
+                      f"({(value - old) / old * 100:+.1f}%)")
+
+
+def _flatten(values: dict, prefix: str = ""):
+    for key, value in values.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--file-mb", type=int, default=256)
+    parser.add_argument("--engine", default="selectors", choices=["selectors", "asyncio"])
+    parser.add_argument("--compress", default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--streams", type=int, default=1, help="most connections per file")
+    parser.add_argument("--dedup", action="store_true",
+                        help="content-defined chunking, adds a resend of an edited file")
+    parser.add_argument("--room-members", type=int, default=0,
+                        help="adds a group room with this many nodes")
+    parser.add_argument("--fanout", type=int, default=0, help="relay tree fanout of the room")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "engine": args.engine, "time": time()}
+    results["codec"] = bench_codec()
+    pair = Pair(args.engine, args.compress, args.streams, args.dedup)
+    try:
+        results["handshake"] = bench_handshake(pair)
+        pair.connect()
+        results["chat"] = bench_chat(pair, args.messages)
+        results["file"] = bench_file(pair, args.file_mb * MB)
+        results["text_file"] = bench_file(pair, args.file_mb * MB, text=True)
+        results["chat_during_file"] = bench_chat_during_file(pair, args.file_mb * MB)
+        results["two_files"] = bench_two_files(pair, args.file_mb * MB // 2)
+        if args.dedup:
+            results["resend"] = bench_resend(pair, args.file_mb * MB)
+    finally:
+        pair.close()
+    if args.room_members:
+        results["room"] = bench_room(args.engine, args.room_members,
+                                     min(args.messages, 2000), args.fanout)
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    print(json.dumps(results, indent=2))
+    output = args.output or os.path.join(ROOT, "benchmarks", "results",
+                                         f"{results['commit'] or 'local'}-{args.engine}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Cost of Signal.emit per connected slot.
+
+Emits with 0, 1, 4 and 16 connected slots, strong, weak and queued, and
+reports nanoseconds per emit and per slot. Queued emits only measure posting
+to the dispatcher, not running the slot.
+
+    python benchmarks/signal_emit.py [emits]
+"""
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peerlink.utils import Dispatcher, Signal
+
+
+class Receiver:
+    def slot(self, data, sock):
+        pass
+
+
+def measure(count: int, slots: int, mode: str) -> float:
+    signal = Signal("data", "sock")
+    receivers = [Receiver() for _ in range(slots)]
+    dispatcher = Dispatcher()
+    for receiver in receivers:
+        signal.connect(receiver.slot, weak=mode == "weak",
+                       dispatcher=dispatcher if mode == "queued" else None)
+    elapsed = timeit(lambda: signal.emit(b"", None), number=count)
+    dispatcher.process()
+    return elapsed / count * 1e9
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print(f"{'mode':<8}{'slots':>6}{'ns/emit':>12}{'ns/slot':>12}")
+    for mode in ("strong", "weak", "queued"):
+        base = measure(count, 0, mode)
+        for slots in (0, 1, 4, 16):
+            cost = base if slots == 0 else measure(count, slots, mode)
+            per_slot = (cost - base) / slots if slots else 0.0
+            print(f"{mode:<8}{slots:>6}{cost:>12.0f}{per_slot:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
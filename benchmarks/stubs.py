@@ -0,0 +1,53 @@
+"""mDNS replacement so benchmark nodes stay off the network.
+
+install() must run before peerlink.model is imported.
+"""
+import sys
+from types import ModuleType
+
+
+class PeerDirectory:
+    def __init__(self) -> None:
+        from peerlink.utils import Signal
+        self.onadd = Signal("servicename", "addresses", "port")
+        self.onremove = Signal("servicename")
+
+
+class MultiDNS:
+    directory = None
+    service_info = None
+
+    def __init__(self) -> None:
+        self.directory = PeerDirectory()
+        self.rooms = PeerDirectory()
+
+    def register_service(self, name, port, addresses):
+        pass
+
+    def service_listener(self):
+        pass
+
+    def unregister(self):
+        pass
+
+    def service_exists(self, name):
+        return False
+
+    def register_room(self, name, port, addresses):
+        pass
+
+    def unregister_room(self, name):
+        pass
+
+    def room_exists(self, name):
+        return False
+
+    def shutdown(self):
+        pass
+
+
+def install():
+    mdns = ModuleType("peerlink.mdns")
+    mdns.MultiDNS = MultiDNS
+    mdns.PeerDirectory = PeerDirectory
+    sys.modules["peerlink.mdns"] = mdns
@@ -1,14 +1,36 @@
+from time import perf_counter
+
+STARTED = perf_counter()
+
 import sys
 from random import randrange
 
-from peerlink.model import Model
+from PyQt6.QtCore import QTimer
 from peerlink.ui import (ChatWindow, ConnectionWindow, Controller, LoginWindow,
-                         QApplication)
+                         QApplication, QSignal)
+
+IMPORTED = perf_counter()
+
+
+def start():
+    # Runs once the login window is up, networking loads behind it.
+    global window
+    shown = perf_counter()
+    from peerlink.metrics import REGISTRY
+    from peerlink.model import Model
+    window = Controller(login, ConnectionWindow(), ChatWindow(),
+                        Model(randrange(8000,9000,1), signal=QSignal))
+    stages = {"imports": IMPORTED, "window": shown, "ready": perf_counter()}
+    for stage, at in stages.items():
+        REGISTRY.gauge("peerlink_startup_seconds", "Time from launch to each startup stage.",
+                       stage=stage).set(at - STARTED)
+    if "--startup-report" in sys.argv:
+        print(", ".join(f"{stage} {(at - STARTED) * 1000:.0f} ms" for stage, at in stages.items()),
+              file=sys.stderr)
+
 
 app = QApplication(sys.argv)
 login = LoginWindow()
-conn =ConnectionWindow()
-chat = ChatWindow()
-window = Controller(login, conn, chat, Model(randrange(8000,9000,1)))
 login.show()
+QTimer.singleShot(0, start)
 app.exec()
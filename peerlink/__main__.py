@@ -0,0 +1,5 @@
+import sys
+
+from peerlink.cli import main
+
+sys.exit(main())
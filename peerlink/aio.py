@@ -0,0 +1,185 @@
+import asyncio
+import socket
+from logging import debug, error, exception
+from threading import Thread, get_ident
+
+from peerlink.network import (BACKLOG, BYTES_IN, BYTES_OUT, CONNECT_TIMEOUT,
+                              FILE_CHUNK_SIZE, FRAME_HEADER, FRAMES_IN,
+                              FRAMES_OUT, MAX_FRAME_SIZE, pack_frame)
+from peerlink.transfer import FileStreamer
+from peerlink.utils import Signal
+
+
+class AsyncConnection:
+    def __init__(self, engine, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.onerror = Signal()
+        self.addr = writer.get_extra_info("peername")
+        self._engine = engine
+        self._reader = reader
+        self._writer = writer
+        self.closed = False
+        # Cleared while the frames of this connection cannot be taken in.
+        self._readable = asyncio.Event()
+        self._readable.set()
+
+    def send_data(self, data: bytes):
+        # Never blocks the caller, the write is queued on the event loop.
+        self._engine.loop.call_soon_threadsafe(self._write, pack_frame(data))
+
+    def send_frame(self, data: bytes):
+        # Blocks until the frame is drained, which gives writer threads
+        # backpressure from a slow peer.
+        if self._engine.in_loop():
+            self._write(pack_frame(data))
+            return
+        asyncio.run_coroutine_threadsafe(self._drain(pack_frame(data)), self._engine.loop).result()
+
+    def send_file(self, filepath, proto=None):
+        try:
+            if proto:
+                FileStreamer(filepath, proto, self.send_frame).run()
+                return
+            with open(filepath, "rb") as file:
+                while chunk := file.read(FILE_CHUNK_SIZE):
+                    self.send_frame(chunk)
+        except (OSError, ConnectionError) as e:
+            self.onerror.emit()
+            exception("")
+
+    def shutdown(self):
+        self.closed = True
+        self._engine.loop.call_soon_threadsafe(self._close)
+
+    def abort(self):
+        self.closed = True
+        self._writer.transport.abort()
+        self._readable.set()
+
+    def _write(self, frame: bytes):
+        if self._writer.is_closing():
+            return
+        try:
+            self._writer.write(frame)
+            FRAMES_OUT.inc()
+            BYTES_OUT.inc(len(frame))
+        except (OSError, ConnectionError) as e:
+            self.onerror.emit()
+            exception("")
+
+    async def _drain(self, frame: bytes):
+        if self._writer.is_closing():
+            raise ConnectionResetError("Connection is closed.")
+        self._writer.write(frame)
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(frame))
+        await self._writer.drain()
+
+    def _close(self):
+        if self._writer.can_write_eof() and not self._writer.is_closing():
+            self._writer.write_eof()
+
+    async def _read_frames(self):
+        try:
+            while True:
+                await self._readable.wait()
+                header = await self._reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    error('Malformed frame, closing connection.')
+                    break
+                frame = await self._reader.readexactly(length)
+                FRAMES_IN.inc()
+                BYTES_IN.inc(FRAME_HEADER.size + length)
+                self._engine.onframe.emit(frame, self)
+        except asyncio.IncompleteReadError:
+            pass
+        except ConnectionError as e:
+            exception('Connection closed by remote peer.')
+        except Exception:
+            exception('Failed to handle a frame, closing connection.')
+        finally:
+            self._writer.close()
+            self._engine.ondisconnect.emit(self)
+
+
+class AsyncReciever(Thread):
+    def __init__(self, host: str = "", port: int = 8080, backlog: int = BACKLOG) -> None:
+        super().__init__(name="reciever", daemon=True)
+        self.addr = (host, port)
+        self.loop = asyncio.new_event_loop()
+        self.onconnection = Signal("sock")
+        self.onframe = Signal("data", "sock")
+        self.ondisconnect = Signal("sock")
+        self._thread = None
+        self._pool = {}
+        # Bound right away like the selectors engine, so peers can connect as
+        # soon as the constructor returns.
+        self._socket = None
+        try:
+            self._socket = socket.create_server(self.addr, backlog=backlog)
+        except OSError as e:
+            exception("Couldn't bind socket.")
+
+    def in_loop(self) -> bool:
+        return self._thread == get_ident()
+
+    def dial(self, host, port):
+        # Safe to call from any thread, the caller waits at most
+        # CONNECT_TIMEOUT for the connection to come up.
+        future = asyncio.run_coroutine_threadsafe(self._dial(host, port), self.loop)
+        try:
+            return future.result(CONNECT_TIMEOUT + 1)
+        except (OSError, asyncio.TimeoutError, TimeoutError) as e:
+            exception(f"Couldn't connect to {host}:{port}")
+            return False
+
+    def call_later(self, delay: float, callback):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def pause(self, client: AsyncConnection):
+        # From a frame handler, the reader stops before the next frame and
+        # the transport pauses once its buffer is full.
+        client._readable.clear()
+
+    def resume(self, client: AsyncConnection):
+        self.loop.call_soon_threadsafe(client._readable.set)
+
+    def drop(self, client: AsyncConnection):
+        # For a peer that sent garbage, its read loop ends on the next read.
+        self.loop.call_soon_threadsafe(client.abort)
+
+    async def _dial(self, host, port) -> AsyncConnection:
+        # One connection per peer address, reused until it is closed. The
+        # pool is only touched on the loop, so it needs no lock.
+        conn = self._pool.get((host, port))
+        if conn and not conn.closed:
+            return conn
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+        conn = AsyncConnection(self, reader, writer)
+        self._pool[(host, port)] = conn
+        self.loop.create_task(self._watch(conn, (host, port)))
+        return conn
+
+    async def _watch(self, conn, key):
+        try:
+            await conn._read_frames()
+        finally:
+            if self._pool.get(key) is conn:
+                del self._pool[key]
+
+    async def _accept(self, reader, writer):
+        conn = AsyncConnection(self, reader, writer)
+        debug("%s connected", conn.addr)
+        self.onconnection.emit(conn)
+        await conn._read_frames()
+
+    async def _serve(self):
+        if self._socket:
+            await asyncio.start_server(self._accept, sock=self._socket)
+
+    def run(self):
+        self._thread = get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve())
+        self.loop.run_forever()
@@ -0,0 +1,308 @@
+import os
+import random
+import sqlite3
+from collections import Counter, OrderedDict
+from hashlib import blake2b
+from logging import exception
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import sleep, time
+
+from peerlink.codec import ChunkList
+from peerlink.history import WRITE_BATCH, WRITE_DELAY, connect
+from peerlink.metrics import REGISTRY
+from peerlink.utils import CHUNK_SIZE
+
+CHUNK_DB = "chunks.db"
+STORE_LIMIT = 2 * 1024 ** 3
+DIGEST_SIZE = 16
+# Files are cut where the bytes around a position match an anchor, so an
+# insert early in a file only changes the chunks around it. Chunks are
+# MIN_CHUNK + 8 KiB on average and never longer than a file chunk.
+MIN_CHUNK = 4 * 1024
+MAX_CHUNK = CHUNK_SIZE
+WINDOW = 7
+READ_SIZE = 1024 * 1024
+# Below this a file goes out whole, above MAX_CHUNKS the list of missing
+# chunks would not fit in one message.
+DEDUP_MIN_SIZE = 1024 * 1024
+MAX_CHUNKS = 200_000
+CHUNK_LIST_BATCH = 1000
+# Chunks of files cut before, kept for sending them again.
+CUT_CACHE_CHUNKS = 200_000
+# Both peers must cut files at the same places, the table never changes.
+GEAR = bytes(random.Random(0x5EED).sample(range(256), 256))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    digest BLOB NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_used ON chunks (used);
+"""
+LOOKUP_BATCH = 500
+EVICT_BATCH = 256
+
+STORE_BYTES = REGISTRY.gauge("peerlink_chunk_store_bytes", "Bytes held in the chunk store.")
+REUSED_BYTES = REGISTRY.counter("peerlink_dedup_reused_bytes_total",
+                                "File bytes taken from the chunk store instead of the peer.")
+
+_masks = {}
+_cuts = OrderedDict()
+_cuts_lock = Lock()
+
+
+def digest(data) -> bytes:
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def content_chunks(filepath: str):
+    # (offset, length, digest) of every chunk of the file, yielded while the
+    # file is cut. A file that has not changed since it was last cut to the
+    # end is not read again.
+    status = os.stat(filepath)
+    key = (os.path.abspath(filepath), status.st_size, status.st_mtime_ns)
+    with _cuts_lock:
+        chunks = _cuts.get(key)
+        if chunks is not None:
+            _cuts.move_to_end(key)
+    if chunks is not None:
+        yield from chunks
+        return
+    chunks = []
+    for chunk in _cut_file(filepath):
+        chunks.append(chunk)
+        yield chunk
+    with _cuts_lock:
+        _cuts[key] = chunks
+        total = sum(map(len, _cuts.values()))
+        while total > CUT_CACHE_CHUNKS and len(_cuts) > 1:
+            total -= len(_cuts.popitem(last=False)[1])
+
+
+def _cut_file(filepath: str):
+    chunks = []
+    buffer = bytearray()
+    start = 0
+    tail = b""
+    with open(filepath, "rb") as file:
+        while True:
+            block = file.read(READ_SIZE)
+            if not block:
+                break
+            end = start + len(buffer) + len(block)
+            base = end - len(tail) - len(block)
+            cuts = [base + anchor for anchor in _anchors(tail + block)]
+            buffer += block
+            tail = block[-WINDOW:]
+            start = _cut(chunks, buffer, start, cuts, end)
+            yield from chunks
+            chunks.clear()
+    while buffer:
+        length = min(len(buffer), MAX_CHUNK)
+        yield start, length, digest(buffer[:length])
+        del buffer[:length]
+        start += length
+
+
+def _anchors(data: bytes):
+    # The gear bytes of every WINDOW long run are xor'ed together with a few
+    # big integer shifts, which run at C speed. A position is an anchor when
+    # that byte is zero and the low bits of the next one are too, one in
+    # 8192 positions of random data.
+    n = len(data)
+    x = int.from_bytes(data.translate(GEAR), "little")
+    x2 = x ^ (x << 8)
+    x4 = x2 ^ (x2 << 16)
+    window = x4 ^ (x2 << 32) ^ (x << 48)
+    mask = _masks.get(n)
+    if mask is None:
+        mask = int.from_bytes(b"\x1f" * n, "little")
+        # Only the mask of a full block is kept, the last block of every
+        # file has a length of its own.
+        if n == READ_SIZE + WINDOW:
+            _masks[n] = mask
+    hits = (window | ((window >> 8) & mask)).to_bytes(n + WINDOW, "little")
+    anchors = []
+    position = hits.find(0, WINDOW - 1, n - 1)
+    while position != -1:
+        anchors.append(position + 1)
+        position = hits.find(0, position + 1, n - 1)
+    return anchors
+
+
+def _cut(chunks, buffer: bytearray, start: int, cuts, end: int) -> int:
+    # buffer holds the bytes from start to end that are not in a chunk yet.
+    consumed = 0
+    for cut in cuts:
+        while cut - start > MAX_CHUNK:
+            chunks.append((start, MAX_CHUNK, digest(buffer[consumed:consumed + MAX_CHUNK])))
+            start += MAX_CHUNK
+            consumed += MAX_CHUNK
+        if cut - start >= MIN_CHUNK:
+            chunks.append((start, cut - start, digest(buffer[consumed:consumed + cut - start])))
+            consumed += cut - start
+            start = cut
+    while end - start > MAX_CHUNK:
+        chunks.append((start, MAX_CHUNK, digest(buffer[consumed:consumed + MAX_CHUNK])))
+        start += MAX_CHUNK
+        consumed += MAX_CHUNK
+    del buffer[:consumed]
+    return start
+
+
+def chunk_lists(transfer: str, chunks, spans: list):
+    # A ChunkList for every CHUNK_LIST_BATCH chunks as soon as they are cut,
+    # and the (offset, length) of each chunk listed added to spans. Past
+    # MAX_CHUNKS the lists stop short and spans is emptied, the reciever
+    # then finds they do not add up to the file and takes it whole.
+    batch = []
+    for offset, length, key in chunks:
+        if len(spans) == MAX_CHUNKS:
+            spans.clear()
+            return
+        if len(batch) == CHUNK_LIST_BATCH:
+            yield ChunkList(transfer, batch, False)
+            batch = []
+        batch.append((key, length))
+        spans.append((offset, length))
+    yield ChunkList(transfer, batch, True)
+
+
+def wanted_ranges(spans, bitmap: bytes):
+    # The spans whose bit is set, one bit per chunk.
+    return [[offset, offset + length] for index, (offset, length) in enumerate(spans)
+            if bitmap[index >> 3] & (0x80 >> (index & 7))]
+
+
+class ChunkStore(Thread):
+    # Content addressed chunks of recieved files, at most limit bytes of
+    # them. Lookups count as use and the least recently used chunks are
+    # evicted first, except pinned ones. Writes are batched on this thread
+    # like History's.
+    def __init__(self, path: str, limit: int = STORE_LIMIT) -> None:
+        super().__init__(name="chunk-store", daemon=True)
+        self.path = path
+        self.limit = limit
+        self._jobs = Queue()
+        self._reader = connect(path)
+        self._reader.executescript(SCHEMA)
+        self._lock = Lock()
+        self._pinned = Counter()
+        self.size = self._reader.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+        STORE_BYTES.set(self.size)
+
+    def has(self, digests, pin: bool = False) -> set:
+        # With pin every chunk found stays until unpinned once for each time
+        # it was asked for, so it can still be read later.
+        digests = list(digests)
+        found = set()
+        with self._lock:
+            for i in range(0, len(digests), LOOKUP_BATCH):
+                batch = digests[i:i + LOOKUP_BATCH]
+                found.update(row[0] for row in self._reader.execute(
+                    f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})",
+                    batch))
+            if pin:
+                self._pinned.update(key for key in digests if key in found)
+        if found:
+            self._jobs.put((self._touch, list(found), time()))
+        return found
+
+    def get(self, key: bytes):
+        with self._lock:
+            row = self._reader.execute("SELECT data FROM chunks WHERE digest = ?",
+                                       (key,)).fetchone()
+        return row[0] if row else None
+
+    def unpin(self, keys):
+        with self._lock:
+            for key in keys:
+                self._pinned[key] -= 1
+                if self._pinned[key] <= 0:
+                    del self._pinned[key]
+
+    def put(self, key: bytes, data):
+        # Checked on the writer thread, a chunk that does not match its
+        # digest is never stored.
+        self._jobs.put((self._insert, key, data))
+
+    def flush(self):
+        self._jobs.join()
+
+    def close(self):
+        self._jobs.put(None)
+        self.join()
+        with self._lock:
+            self._reader.close()
+
+    def run(self):
+        conn = connect(self.path)
+        closing = False
+        while not closing:
+            batch = []
+            job = self._jobs.get()
+            if job is not None and self._jobs.qsize() < WRITE_BATCH:
+                sleep(WRITE_DELAY)
+            while True:
+                if job is None:
+                    closing = True
+                    break
+                batch.append(job)
+                if len(batch) == WRITE_BATCH:
+                    break
+                try:
+                    job = self._jobs.get_nowait()
+                except Empty:
+                    break
+            try:
+                with conn:
+                    for work, *args in batch:
+                        work(conn, *args)
+                # Committed under the lock, a lookup either pins a chunk
+                # before it is picked or no longer finds it.
+                with self._lock, conn:
+                    self._evict(conn)
+            except sqlite3.Error:
+                exception(f"Couldn't update {self.path}")
+                self.size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+            STORE_BYTES.set(self.size)
+            for _ in range(len(batch) + closing):
+                self._jobs.task_done()
+        conn.close()
+
+    def _insert(self, conn, key: bytes, data):
+        if digest(data) != key:
+            return
+        cursor = conn.execute("INSERT OR IGNORE INTO chunks (digest, size, used, data) "
+                              "VALUES (?, ?, ?, ?)", (key, len(data), time(), bytes(data)))
+        if cursor.rowcount:
+            self.size += len(data)
+
+    def _touch(self, conn, keys, when: float):
+        conn.executemany("UPDATE chunks SET used = ? WHERE digest = ?",
+                         [(when, key) for key in keys])
+
+    def _evict(self, conn):
+        skipped = 0
+        while self.size > self.limit:
+            # Pinned chunks are skipped and stay at the front of the order.
+            rows = conn.execute("SELECT id, size, digest FROM chunks ORDER BY used "
+                                "LIMIT ? OFFSET ?", (EVICT_BATCH, skipped)).fetchall()
+            if not rows:
+                if not skipped:
+                    self.size = 0
+                break
+            evicted = []
+            for id_, size, key in rows:
+                if self.size <= self.limit:
+                    break
+                if key in self._pinned:
+                    skipped += 1
+                    continue
+                evicted.append((id_,))
+                self.size -= size
+            conn.executemany("DELETE FROM chunks WHERE id = ?", evicted)
@@ -0,0 +1,355 @@
+"""Headless PeerLink node, no Qt involved.
+
+    python -m peerlink listen --name NAME [--accept [PEER]]
+    python -m peerlink recv --name NAME [--from PEER] [--count N] [--out DIR]
+    python -m peerlink send --name NAME PEER [--text TEXT]... [--file PATH]...
+    python -m peerlink room --name NAME ROOM [--host [--fanout N]] [--at HOST:PORT]
+                            [--members N] [--text TEXT]... [--count N]
+
+PEER is a username found over mDNS, or host:port. ROOM is the name of a
+group room, hosted here with --host or joined through mDNS or --at. Every event is printed to
+stdout as one JSON object per line, logs go to stderr. The exit status is 0
+on success, 1 on a failure or timeout and 2 when the username is taken.
+"""
+import argparse
+import json
+import logging
+import sys
+from collections import deque
+from os.path import abspath, join
+from random import randrange
+from socket import gethostbyname
+from threading import Condition, Lock
+from time import time
+
+from peerlink.keystore import PEERLINK_HOME
+from peerlink.model import ENGINES, Model
+
+CONNECT_TIMEOUT = 30.0
+# How long a recieved file may take to land on disk after the peer left.
+FINISH_TIMEOUT = 5.0
+
+
+class Node:
+    # Model events as JSON lines, plus the waits a script needs.
+    def __init__(self, args) -> None:
+        self.model = Model(args.port, args.engine, home=args.home, downloads=args.out,
+                           streams=args.streams, dedup=args.dedup)
+        self.out = args.out
+        self.accept = None
+        self.sessions = {}
+        self.secured = set()
+        self.closed = set()
+        self.sent = {}
+        self.recieved = 0
+        self.rooms = {}
+        self.posts = 0
+        self._incoming = {}
+        self._changed = Condition()
+        self._print_lock = Lock()
+
+        model = self.model
+        model.ondevicediscovery.connect(self._discovered)
+        model.ondeviceloss.connect(self._lost)
+        model.onreqrecv.connect(self._request)
+        model.onreqacpt.connect(self._accepted)
+        model.onconnsecure.connect(self._secured)
+        model.ontext.connect(self._text)
+        model.onfile.connect(self._file)
+        model.onfilefinished.connect(self._file_recieved)
+        model.onfilesent.connect(self._file_sent)
+        model.onsenderror.connect(self._send_error)
+        model.ondisconnect.connect(self._disconnected)
+        model.onroomdiscovery.connect(self._room_found)
+        model.onroom.connect(self._room)
+        model.onroomtext.connect(self._room_text)
+        model.onroomclosed.connect(self._room_closed)
+        model.onroomlinked.connect(self._room_linked)
+
+    def emit(self, event: str, **fields):
+        line = json.dumps({"event": event, "time": time(), **fields})
+        with self._print_lock:
+            print(line, flush=True)
+
+    def start(self, name: str) -> bool:
+        if not self.model.set_username(name):
+            self.emit("error", error="username taken", name=name)
+            return False
+        ip, port = self.model.receiver.addr
+        self.emit("ready", name=name, uuid=self.model.peer.get_uuid(), ip=ip, port=port)
+        return True
+
+    def wait(self, predicate, timeout=None) -> bool:
+        with self._changed:
+            return self._changed.wait_for(predicate, timeout)
+
+    def resolve(self, peer: str, timeout: float):
+        if ":" in peer:
+            return _address(peer)
+        if not self.wait(lambda: peer in self.model.local_devices, timeout):
+            return None
+        device = self.model.local_devices[peer]
+        return device["ip"], device["port"]
+
+    def resolve_room(self, room: str, at: str, timeout: float):
+        if at:
+            return _address(at)
+        if not self.wait(lambda: room in self.model.local_rooms, timeout):
+            return None
+        found = self.model.local_rooms[room]
+        return found["ip"], found["port"]
+
+    def shutdown(self):
+        self.model.shutdown()
+
+    def _changes(self, update=None):
+        with self._changed:
+            if update:
+                update()
+            self._changed.notify_all()
+
+    def _name(self, uuid):
+        return self.sessions.get(uuid, {}).get("name", "")
+
+    def _discovered(self, name, ip, port):
+        self.emit("peer", name=name, ip=ip, port=port)
+        self._changes()
+
+    def _lost(self, name):
+        self.emit("peer_lost", name=name)
+
+    def _request(self, uuid, name, ip, port):
+        self.emit("request", uuid=uuid, name=name, ip=ip, port=port)
+        if self.accept is True or self.accept == name:
+            self.model.accept_req(uuid)
+
+    def _accepted(self, uuid, name, ip, port):
+        self._changes(lambda: self.sessions.update({uuid: {"name": name, "ip": ip, "port": port}}))
+        self.emit("connected", uuid=uuid, name=name, ip=ip, port=port)
+
+    def _secured(self, uuid):
+        self.emit("secured", uuid=uuid, name=self._name(uuid))
+        self._changes(lambda: self.secured.add(uuid))
+
+    def _text(self, uuid, text, time):
+        self.emit("text", uuid=uuid, name=self._name(uuid), text=text, sent=time)
+        self._changes(self._count)
+
+    def _file(self, uuid, filename, time):
+        self._changes(lambda: self._incoming.setdefault(uuid, deque()).append(filename))
+        self.emit("file", uuid=uuid, name=self._name(uuid), filename=filename)
+
+    def _file_recieved(self, uuid):
+        with self._changed:
+            pending = self._incoming.get(uuid)
+            filename = pending.popleft() if pending else ""
+            self._count()
+            self._changed.notify_all()
+        self.emit("file_recieved", uuid=uuid, name=self._name(uuid),
+                  path=abspath(join(self.out, filename)))
+
+    def _file_sent(self, uuid, filepath):
+        self.emit("file_sent", uuid=uuid, path=filepath)
+        self._changes(lambda: self.sent.update({filepath: None}))
+
+    def _send_error(self, uuid, error):
+        self.emit("send_error", uuid=uuid, error=error)
+        # A failure ends whichever file was waiting for its result.
+        self._changes(lambda: self.sent.update({None: error}))
+
+    def _disconnected(self, uuid):
+        self.emit("disconnected", uuid=uuid, name=self._name(uuid))
+        self._changes(lambda: self.closed.add(uuid))
+
+    def _room_found(self, name, ip, port):
+        self.emit("room_found", room=name, ip=ip, port=port)
+        self._changes()
+
+    def _room(self, name, members):
+        self.emit("room", room=name, members=[member[1] for member in members])
+        self._changes(lambda: self.rooms.update({name: len(members)}))
+
+    def _room_text(self, name, uuid, text, time):
+        member = self.model.rooms[name].member(uuid) if name in self.model.rooms else None
+        self.emit("room_text", room=name, uuid=uuid, name=member[1] if member else "",
+                  text=text, sent=time)
+        self._changes(self._count_post)
+
+    def _room_linked(self, name):
+        self._changes()
+
+    def _room_closed(self, name):
+        self.emit("room_closed", room=name)
+        self._changes(lambda: self.rooms.pop(name, None))
+
+    def _count(self):
+        self.recieved += 1
+
+    def _count_post(self):
+        self.posts += 1
+
+    def pending(self) -> int:
+        return sum(len(files) for files in self._incoming.values())
+
+
+def _address(value: str):
+    # The peer is dialed by IP, and a known peer is looked up by the IP it
+    # advertises.
+    host, port = value.rsplit(":", 1)
+    try:
+        return gethostbyname(host), int(port)
+    except (OSError, ValueError):
+        return None
+
+
+def send(node: Node, args) -> int:
+    addr = node.resolve(args.peer, args.timeout)
+    if addr is None:
+        node.emit("error", error="peer not found", peer=args.peer)
+        return 1
+    node.model.send_req(*addr)
+    uuid = None
+
+    def secured():
+        # Only the request sent here is accepted, the peer may advertise
+        # another address than the one dialed.
+        nonlocal uuid
+        uuid = next((session for session in node.sessions if session in node.secured), None)
+        return uuid is not None
+
+    if not node.wait(secured, args.timeout):
+        node.emit("error", error="no secure session", peer=args.peer)
+        return 1
+
+    def failed(**fields):
+        node.emit("error", error="disconnected" if uuid in node.closed else "send queue full",
+                  **fields)
+        return 1
+
+    status = 0
+    for text in args.text:
+        if not node.model.send_msg(text, uuid):
+            status = failed(text=text)
+    for filepath in map(abspath, args.file):
+        if not node.model.send_file(filepath, uuid):
+            status = failed(path=filepath)
+            continue
+        node.wait(lambda: filepath in node.sent or None in node.sent or uuid in node.closed)
+        if filepath not in node.sent:
+            node.sent.pop(None, None)
+            status = 1
+    node.model.disconnect(uuid)
+    return status
+
+
+def recv(node: Node, args) -> int:
+    node.accept = args.peer or True
+
+    def finished():
+        if args.count and node.recieved >= args.count:
+            return True
+        return bool(node.closed) and not (node.secured - node.closed)
+
+    done = node.wait(finished, args.timeout)
+    # Files completed just before the peer left are still being moved in place.
+    node.wait(lambda: not node.pending(), FINISH_TIMEOUT)
+    if not done:
+        node.emit("error", error="timed out", recieved=node.recieved)
+    return 0 if done else 1
+
+
+def room(node: Node, args) -> int:
+    if args.host:
+        if not node.model.create_room(args.room, args.fanout):
+            node.emit("error", error="room exists", room=args.room)
+            return 1
+    else:
+        addr = node.resolve_room(args.room, args.at, args.timeout)
+        if addr is None or not node.model.join_room(args.room, *addr):
+            node.emit("error", error="room not found", room=args.room)
+            return 1
+    # Texts go out once the room has grown to --members and every link is up.
+    ready = lambda: (node.rooms.get(args.room, 0) >= args.members
+                     and node.model.linked(args.room))
+    if not node.wait(ready, args.timeout):
+        node.emit("error", error="room not ready", room=args.room,
+                  members=node.rooms.get(args.room, 0))
+        return 1
+    for text in args.text:
+        node.model.send_room(args.room, text)
+    gone = lambda: args.room not in node.rooms
+    try:
+        if args.count:
+            node.wait(lambda: node.posts >= args.count or gone())
+        elif args.host or not args.text:
+            node.wait(gone)
+    except KeyboardInterrupt:
+        pass
+    node.model.leave_room(args.room)
+    return 0 if not args.count or node.posts >= args.count else 1
+
+
+def listen(node: Node, args) -> int:
+    node.accept = args.accept
+    try:
+        node.wait(lambda: False)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--name", required=True, help="username announced over mDNS")
+    common.add_argument("--port", type=int, default=randrange(8000, 9000))
+    common.add_argument("--engine", choices=ENGINES, default="selectors")
+    common.add_argument("--home", default=PEERLINK_HOME, help="identity, known peers and history")
+    common.add_argument("--out", default=".", help="directory for recieved files")
+    common.add_argument("--timeout", type=float, default=CONNECT_TIMEOUT)
+    common.add_argument("--streams", type=int, default=1,
+                        help="connections a large file may be sent over")
+    common.add_argument("--dedup", action="store_true",
+                        help="only send the parts of a file the peer does not have")
+    common.add_argument("-v", "--verbose", action="store_true")
+
+    parser = argparse.ArgumentParser(prog="python -m peerlink", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("send", parents=[common], help="send messages and files")
+    command.add_argument("peer", help="username or host:port")
+    command.add_argument("--text", action="append", default=[])
+    command.add_argument("--file", action="append", default=[], help="a file or a directory")
+    command.set_defaults(run=send)
+    command = commands.add_parser("recv", parents=[common],
+                                  help="accept one peer and recieve until it disconnects")
+    command.add_argument("--from", dest="peer", help="only accept this username")
+    command.add_argument("--count", type=int, help="exit after this many messages and files")
+    command.set_defaults(run=recv, timeout=None)
+    command = commands.add_parser("room", parents=[common], help="host or join a group room")
+    command.add_argument("room")
+    command.add_argument("--host", action="store_true", help="host the room on this node")
+    command.add_argument("--fanout", type=int, default=0,
+                         help="relay posts along a tree with this many children per member")
+    command.add_argument("--at", help="host:port of the room's host, instead of mDNS")
+    command.add_argument("--members", type=int, default=0,
+                         help="wait for this many members before sending")
+    command.add_argument("--text", action="append", default=[])
+    command.add_argument("--count", type=int, help="exit after this many posts")
+    command.set_defaults(run=room)
+    command = commands.add_parser("listen", parents=[common], help="print events until interrupted")
+    command.add_argument("--accept", nargs="?", const=True,
+                         help="accept requests, from everyone or only this username")
+    command.set_defaults(run=listen)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = parser().parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING)
+    node = Node(args)
+    try:
+        if not node.start(args.name):
+            return 2
+        return args.run(node, args)
+    finally:
+        node.shutdown()
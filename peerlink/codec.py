@@ -0,0 +1,484 @@
+import json
+import struct
+from itertools import count
+from mimetypes import guess_type
+from os.path import basename, getsize
+from time import time
+
+from peerlink.utils import CHUNK_SIZE, transfer_id
+
+# A binary message starts with MAGIC | VERSION. File chunks start with 0x01 and
+# JSON messages with "{", so the first byte of a frame tells all three apart.
+MAGIC = 0x80
+VERSION = 1
+HEADER = struct.Struct("!BBBId")
+STRING = struct.Struct("!H")
+FILE_BODY = struct.Struct("!QI8s")
+PEER_BODY = struct.Struct("!16sH")
+RANGE = struct.Struct("!QQ")
+COUNT = struct.Struct("!I")
+MANIFEST_BODY = struct.Struct("!I8s?I")
+ENTRY = struct.Struct("!qH")
+CHUNK_ENTRY = struct.Struct("!16sI")
+ROOM_BODY = struct.Struct("!BI")
+POST_BODY = struct.Struct("!8s16s")
+# Size of a directory entry in a manifest.
+DIRECTORY = -1
+
+(TEXT, FILE, REQUEST, ACCEPT, RESUME, SHUT, STREAM, MANIFEST, CHUNKS, ROOM, JOIN, LEAVE,
+ POST) = range(1, 14)
+
+
+class CodecError(Exception):
+    pass
+
+
+class Message:
+    __slots__ = ("seq", "flags", "time")
+    kind = 0
+
+    def __init__(self) -> None:
+        self.seq = 0
+        self.flags = 0
+        self.time = time()
+
+
+class Text(Message):
+    __slots__ = ("text",)
+    kind = TEXT
+
+    def __init__(self, text: str) -> None:
+        super().__init__()
+        self.text = text
+
+
+class FileHeader(Message):
+    __slots__ = ("filename", "mime", "size", "chunk", "transfer")
+    kind = FILE
+
+    def __init__(self, filename: str, mime: str, size: int, chunk: int, transfer: str) -> None:
+        super().__init__()
+        self.filename = filename
+        self.mime = mime
+        self.size = size
+        self.chunk = chunk
+        self.transfer = transfer
+
+    @classmethod
+    def from_path(cls, filepath: str, chunk: int = CHUNK_SIZE):
+        return cls(basename(filepath), guess_type(filepath)[0] or "",
+                   getsize(filepath), chunk, transfer_id(filepath))
+
+
+class Request(Message):
+    # handshake names the Noise pattern, payload carries its first message
+    # when the pattern lets it ride along with the request or the accept.
+    # room is set when the session is wanted for a group room.
+    __slots__ = ("name", "uuid", "ip", "port", "codecs", "handshake", "payload", "room")
+    kind = REQUEST
+
+    def __init__(self, name: str, uuid: str, ip: str, port: int, codecs=(),
+                 handshake: str = "", payload: bytes = b"", room: str = "") -> None:
+        super().__init__()
+        self.name = name
+        self.uuid = uuid
+        self.ip = ip
+        self.port = port
+        self.codecs = list(codecs)
+        self.handshake = handshake
+        self.payload = payload
+        self.room = room
+
+
+class Accept(Request):
+    __slots__ = ()
+    kind = ACCEPT
+
+
+class Resume(Message):
+    # key is the pre-shared key for extra streams of this transfer, empty
+    # when the reciever does not take any. When the file was offered as a
+    # ChunkList, chunks has a bit set for every chunk still wanted and
+    # replaces ranges. error is set when the reciever refused the transfer.
+    __slots__ = ("transfer", "ranges", "key", "chunks", "error")
+    kind = RESUME
+
+    def __init__(self, transfer: str, ranges, key: bytes = b"", chunks: bytes = b"",
+                 error: str = "") -> None:
+        super().__init__()
+        self.transfer = transfer
+        self.ranges = ranges
+        self.key = key
+        self.chunks = chunks
+        self.error = error
+
+
+class Stream(Message):
+    # Opens an extra connection for a transfer, payload is a Noise handshake
+    # message keyed with the transfer's Resume key.
+    __slots__ = ("transfer", "payload")
+    kind = STREAM
+
+    def __init__(self, transfer: str, payload: bytes = b"") -> None:
+        super().__init__()
+        self.transfer = transfer
+        self.payload = payload
+
+
+class Manifest(Message):
+    # Describes the files and directories of one transfer as [path, size,
+    # mode] entries, paths relative and "/" separated. A long manifest is
+    # spread over several messages, last marks the final one. The files are
+    # sent as one stream, end to end in manifest order.
+    __slots__ = ("filename", "chunk", "transfer", "entries", "last")
+    kind = MANIFEST
+
+    def __init__(self, filename: str, chunk: int, transfer: str, entries, last: bool = True) -> None:
+        super().__init__()
+        self.filename = filename
+        self.chunk = chunk
+        self.transfer = transfer
+        self.entries = entries
+        self.last = last
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries if size != DIRECTORY)
+
+
+class ChunkList(Message):
+    # (digest, length) of the content defined chunks of a file, sent ahead
+    # of its FileHeader so the reciever can take what it has from its store.
+    __slots__ = ("transfer", "chunks", "last")
+    kind = CHUNKS
+
+    def __init__(self, transfer: str, chunks, last: bool = True) -> None:
+        super().__init__()
+        self.transfer = transfer
+        self.chunks = chunks
+        self.last = last
+
+
+class Members(Message):
+    # Sent by the host of a room to every member whenever someone joins or
+    # leaves. members are [uuid, name, ip, port] in join order, the host
+    # first. With a fanout posts are relayed along a tree, see rooms.py.
+    __slots__ = ("room", "members", "fanout")
+    kind = ROOM
+
+    def __init__(self, room: str, members, fanout: int = 0) -> None:
+        super().__init__()
+        self.room = room
+        self.members = members
+        self.fanout = fanout
+
+
+class Join(Message):
+    __slots__ = ("room",)
+    kind = JOIN
+
+    def __init__(self, room: str) -> None:
+        super().__init__()
+        self.room = room
+
+
+class Leave(Join):
+    __slots__ = ()
+    kind = LEAVE
+
+
+class Post(Message):
+    # A text for everyone in a room. origin is the uuid of the member who
+    # wrote it, id tells relayed copies apart.
+    __slots__ = ("room", "origin", "id", "text")
+    kind = POST
+
+    def __init__(self, room: str, origin: str, id: str, text: str) -> None:
+        super().__init__()
+        self.room = room
+        self.origin = origin
+        self.id = id
+        self.text = text
+
+
+class Shut(Message):
+    __slots__ = ()
+    kind = SHUT
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, message: Message) -> bytes:
+        if message.kind == TEXT:
+            data = {"text": message.text}
+        elif message.kind == FILE:
+            data = {"filename": message.filename, "type": message.mime, "size": message.size,
+                    "chunk": message.chunk, "transfer": message.transfer}
+        elif message.kind in (REQUEST, ACCEPT):
+            data = {"query": "req" if message.kind == REQUEST else "acp", "name": message.name,
+                    "uuid": message.uuid, "ip": message.ip, "port": message.port,
+                    "codecs": message.codecs, "handshake": message.handshake,
+                    "noise": message.payload.hex(), "room": message.room}
+        elif message.kind == RESUME:
+            data = {"query": "resume", "transfer": message.transfer, "ranges": message.ranges,
+                    "key": message.key.hex(), "chunks": message.chunks.hex(),
+                    "error": message.error}
+        elif message.kind == STREAM:
+            data = {"query": "stream", "transfer": message.transfer,
+                    "noise": message.payload.hex()}
+        elif message.kind == CHUNKS:
+            data = {"query": "chunks", "transfer": message.transfer, "last": message.last,
+                    "chunks": [[key.hex(), length] for key, length in message.chunks]}
+        elif message.kind == MANIFEST:
+            data = {"query": "manifest", "filename": message.filename, "chunk": message.chunk,
+                    "transfer": message.transfer, "entries": message.entries,
+                    "last": message.last}
+        elif message.kind == ROOM:
+            data = {"query": "members", "room": message.room, "members": message.members,
+                    "fanout": message.fanout}
+        elif message.kind in (JOIN, LEAVE):
+            data = {"query": "join" if message.kind == JOIN else "leave", "room": message.room}
+        elif message.kind == POST:
+            data = {"query": "post", "room": message.room, "origin": message.origin,
+                    "id": message.id, "post": message.text}
+        else:
+            data = {"query": "shut"}
+        data["time"] = message.time
+        return json.dumps(data).encode("utf-8")
+
+    def decode(self, data: bytes) -> Message:
+        try:
+            data = json.loads(data)
+        except json.JSONDecodeError as e:
+            raise CodecError(f"Invalid json message - {e}")
+        if not isinstance(data, dict):
+            raise CodecError(f"Invalid json message - {type(data).__name__} instead of an object")
+        try:
+            query = data.get("query")
+            if "text" in data:
+                message = Text(data["text"])
+            elif query == "manifest":
+                message = Manifest(data["filename"], data["chunk"], _transfer(data["transfer"]),
+                                   [list(entry) for entry in data["entries"]], data["last"])
+            elif "filename" in data:
+                message = FileHeader(data["filename"], data["type"], data["size"],
+                                     data["chunk"], _transfer(data["transfer"]))
+            elif query in ("req", "acp"):
+                cls = Request if query == "req" else Accept
+                message = cls(data["name"], data["uuid"], data["ip"], data["port"],
+                              data.get("codecs", ()), data.get("handshake", ""),
+                              bytes.fromhex(data.get("noise", "")), data.get("room", ""))
+            elif query == "resume":
+                message = Resume(_transfer(data["transfer"]), data["ranges"],
+                                 bytes.fromhex(data.get("key", "")),
+                                 bytes.fromhex(data.get("chunks", "")),
+                                 data.get("error", ""))
+            elif query == "chunks":
+                message = ChunkList(_transfer(data["transfer"]), [(bytes.fromhex(key), length)
+                                                       for key, length in data["chunks"]],
+                                    data["last"])
+            elif query == "stream":
+                message = Stream(_transfer(data["transfer"]), bytes.fromhex(data["noise"]))
+            elif query == "members":
+                message = Members(data["room"], [list(member) for member in data["members"]],
+                                  data["fanout"])
+            elif query in ("join", "leave"):
+                message = (Join if query == "join" else Leave)(data["room"])
+            elif query == "post":
+                message = Post(data["room"], data["origin"], data["id"], data["post"])
+            elif query == "shut":
+                message = Shut()
+            else:
+                raise CodecError(f"Unknown message - {data}")
+        except (KeyError, ValueError, TypeError):
+            raise CodecError(f"Invalid data recieved - {data}")
+        message.time = data.get("time", message.time)
+        return message
+
+
+class BinaryCodec:
+    name = f"bin{VERSION}"
+
+    def __init__(self) -> None:
+        self._seq = count(1)
+
+    def encode(self, message: Message) -> bytes:
+        message.seq = next(self._seq)
+        header = HEADER.pack(MAGIC | VERSION, message.kind, message.flags,
+                             message.seq & 0xFFFFFFFF, message.time)
+        return header + self._encode_body(message)
+
+    def decode(self, data: bytes) -> Message:
+        try:
+            magic, kind, flags, seq, stamp = HEADER.unpack_from(data)
+            if magic != MAGIC | VERSION:
+                raise CodecError(f"Unsupported binary codec version {magic & 0x7F}")
+            message = self._decode_body(kind, memoryview(data)[HEADER.size:])
+        except (struct.error, UnicodeDecodeError, ValueError) as e:
+            raise CodecError(f"Invalid binary message - {e}")
+        message.seq = seq
+        message.flags = flags
+        message.time = stamp
+        return message
+
+    def _encode_body(self, message: Message) -> bytes:
+        if message.kind == TEXT:
+            return message.text.encode("utf-8")
+        if message.kind == FILE:
+            return (FILE_BODY.pack(message.size, message.chunk, bytes.fromhex(message.transfer))
+                    + _pack_str(message.filename) + _pack_str(message.mime))
+        if message.kind in (REQUEST, ACCEPT):
+            return (PEER_BODY.pack(bytes.fromhex(message.uuid), message.port)
+                    + _pack_str(message.name) + _pack_str(message.ip)
+                    + _pack_str(",".join(message.codecs)) + _pack_str(message.handshake)
+                    + STRING.pack(len(message.payload)) + message.payload
+                    + _pack_str(message.room))
+        if message.kind == RESUME:
+            return (bytes.fromhex(message.transfer) + COUNT.pack(len(message.ranges))
+                    + b"".join(RANGE.pack(start, end) for start, end in message.ranges)
+                    + STRING.pack(len(message.key)) + message.key
+                    + STRING.pack(len(message.chunks)) + message.chunks
+                    + _pack_str(message.error))
+        if message.kind == CHUNKS:
+            return (bytes.fromhex(message.transfer) + bytes([message.last])
+                    + COUNT.pack(len(message.chunks))
+                    + b"".join(CHUNK_ENTRY.pack(key, length) for key, length in message.chunks))
+        if message.kind == STREAM:
+            return (bytes.fromhex(message.transfer) + STRING.pack(len(message.payload))
+                    + message.payload)
+        if message.kind == MANIFEST:
+            return (MANIFEST_BODY.pack(message.chunk, bytes.fromhex(message.transfer),
+                                       message.last, len(message.entries))
+                    + _pack_str(message.filename)
+                    + b"".join(ENTRY.pack(size, mode) + _pack_str(path)
+                               for path, size, mode in message.entries))
+        if message.kind == ROOM:
+            return (ROOM_BODY.pack(message.fanout, len(message.members)) + _pack_str(message.room)
+                    + b"".join(PEER_BODY.pack(bytes.fromhex(uuid), port) + _pack_str(name)
+                               + _pack_str(ip) for uuid, name, ip, port in message.members))
+        if message.kind in (JOIN, LEAVE):
+            return _pack_str(message.room)
+        if message.kind == POST:
+            return (POST_BODY.pack(bytes.fromhex(message.id), bytes.fromhex(message.origin))
+                    + _pack_str(message.room) + message.text.encode("utf-8"))
+        return b""
+
+    def _decode_body(self, kind: int, body: memoryview) -> Message:
+        if kind == TEXT:
+            return Text(str(body, "utf-8"))
+        if kind == FILE:
+            size, chunk, transfer = FILE_BODY.unpack_from(body)
+            filename, offset = _unpack_str(body, FILE_BODY.size)
+            mime, offset = _unpack_str(body, offset)
+            return FileHeader(filename, mime, size, chunk, transfer.hex())
+        if kind in (REQUEST, ACCEPT):
+            uuid, port = PEER_BODY.unpack_from(body)
+            name, offset = _unpack_str(body, PEER_BODY.size)
+            ip, offset = _unpack_str(body, offset)
+            codecs, offset = _unpack_str(body, offset)
+            handshake, payload, room = "", b"", ""
+            # Peers from before static keys end the body here, peers from
+            # before rooms after the payload.
+            if offset < len(body):
+                handshake, offset = _unpack_str(body, offset)
+                (length,) = STRING.unpack_from(body, offset)
+                offset += STRING.size + length
+                payload = bytes(body[offset - length:offset])
+            if offset < len(body):
+                room, offset = _unpack_str(body, offset)
+            cls = Request if kind == REQUEST else Accept
+            return cls(name, uuid.hex(), ip, port, codecs.split(",") if codecs else (),
+                       handshake, payload, room)
+        if kind == RESUME:
+            (total,) = COUNT.unpack_from(body, 8)
+            ranges = [list(RANGE.unpack_from(body, 12 + i * RANGE.size)) for i in range(total)]
+            offset, fields = 12 + total * RANGE.size, []
+            # Peers from before parallel streams end the body after the
+            # ranges, peers from before deduplication after the key.
+            while offset < len(body) and len(fields) < 2:
+                (length,) = STRING.unpack_from(body, offset)
+                offset += STRING.size + length
+                fields.append(bytes(body[offset - length:offset]))
+            if offset < len(body):
+                fields.append(_unpack_str(body, offset)[0])
+            return Resume(bytes(body[:8]).hex(), ranges, *fields)
+        if kind == CHUNKS:
+            (total,) = COUNT.unpack_from(body, 9)
+            chunks = [CHUNK_ENTRY.unpack_from(body, 13 + i * CHUNK_ENTRY.size)
+                      for i in range(total)]
+            return ChunkList(bytes(body[:8]).hex(), chunks, bool(body[8]))
+        if kind == STREAM:
+            (length,) = STRING.unpack_from(body, 8)
+            return Stream(bytes(body[:8]).hex(), bytes(body[8 + STRING.size:8 + STRING.size + length]))
+        if kind == MANIFEST:
+            chunk, transfer, last, total = MANIFEST_BODY.unpack_from(body)
+            filename, offset = _unpack_str(body, MANIFEST_BODY.size)
+            entries = []
+            for _ in range(total):
+                size, mode = ENTRY.unpack_from(body, offset)
+                path, offset = _unpack_str(body, offset + ENTRY.size)
+                entries.append([path, size, mode])
+            return Manifest(filename, chunk, transfer.hex(), entries, last)
+        if kind == ROOM:
+            fanout, total = ROOM_BODY.unpack_from(body)
+            room, offset = _unpack_str(body, ROOM_BODY.size)
+            members = []
+            for _ in range(total):
+                uuid, port = PEER_BODY.unpack_from(body, offset)
+                name, offset = _unpack_str(body, offset + PEER_BODY.size)
+                ip, offset = _unpack_str(body, offset)
+                members.append([uuid.hex(), name, ip, port])
+            return Members(room, members, fanout)
+        if kind in (JOIN, LEAVE):
+            return (Join if kind == JOIN else Leave)(_unpack_str(body, 0)[0])
+        if kind == POST:
+            id, origin = POST_BODY.unpack_from(body)
+            room, offset = _unpack_str(body, POST_BODY.size)
+            return Post(room, origin.hex(), id.hex(), str(body[offset:], "utf-8"))
+        if kind == SHUT:
+            return Shut()
+        raise CodecError(f"Unknown message type {kind}")
+
+
+CODECS = {BinaryCodec.name: BinaryCodec, JsonCodec.name: JsonCodec}
+# In order of preference, JSON stays as the fallback every peer understands.
+PREFERRED = [BinaryCodec.name, JsonCodec.name]
+_json = JsonCodec()
+_binary = BinaryCodec()
+
+
+def negotiate(offered) -> str:
+    for name in PREFERRED:
+        if name in offered:
+            return name
+    return JsonCodec.name
+
+
+def decode(data: bytes) -> Message:
+    # Decoding does not depend on what was negotiated, the first byte says
+    # which codec produced the frame.
+    if not data:
+        raise CodecError("Empty message")
+    if data[0] & 0xF0 == MAGIC:
+        return _binary.decode(data)
+    return _json.decode(data)
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    return STRING.pack(len(raw)) + raw
+
+
+def _unpack_str(body: memoryview, offset: int):
+    (length,) = STRING.unpack_from(body, offset)
+    start = offset + STRING.size
+    return str(body[start:start + length], "utf-8"), start + length
+
+
+def _transfer(value) -> str:
+    # Transfer ids end up in file names, only what the binary codec can
+    # carry is taken, 8 bytes as hex.
+    if not isinstance(value, str) or len(value) != 16 or bytes.fromhex(value).hex() != value:
+        raise ValueError(f"Invalid transfer id - {value!r}")
+    return value
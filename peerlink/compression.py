@@ -0,0 +1,182 @@
+import zlib
+
+from peerlink.metrics import REGISTRY
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# A compressed payload is this tag followed by the compressed bytes of the
+# original payload, whose own first byte still says what kind it is.
+COMPRESSED = b"\x02"
+# Frames are capped by the Noise message size, nothing decompresses past it.
+MAX_PAYLOAD = 65535
+MIN_SIZE = 256
+MAX_RATIO = 0.9
+# After this many payloads that did not shrink, only one in every
+# PROBE_INTERVAL is tried, and the interval doubles with every further miss
+# up to MAX_PROBE_INTERVAL. One payload that shrinks resets it.
+MISSES_BEFORE_BACKOFF = 4
+PROBE_INTERVAL = 16
+MAX_PROBE_INTERVAL = 1024
+
+# Formats that are compressed already, trying them again only costs CPU.
+INCOMPRESSIBLE_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/vnd.rar", "application/zstd", "application/x-lz4", "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/java-archive", "application/epub+zip",
+}
+COMPRESSIBLE_MEDIA = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "audio/x-wav", "audio/wav"}
+
+
+class CompressionError(Exception):
+    pass
+
+
+class ZlibCompression:
+    name = "zlib"
+
+    def compress(self, data) -> bytes:
+        return zlib.compress(data, 1)
+
+    def decompress(self, data) -> bytes:
+        inflater = zlib.decompressobj()
+        try:
+            result = inflater.decompress(data, MAX_PAYLOAD)
+        except zlib.error as e:
+            raise CompressionError(f"Invalid zlib payload - {e}")
+        if inflater.unconsumed_tail:
+            raise CompressionError("Compressed payload exceeds the frame limit.")
+        return result
+
+
+class ZstdCompression:
+    name = "zstd"
+
+    def __init__(self) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=1)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data) -> bytes:
+        # A frame may declare any content size, the reader stops one byte
+        # past the limit whatever it says.
+        try:
+            with self._decompressor.stream_reader(data) as reader:
+                result = reader.read(MAX_PAYLOAD + 1)
+        except zstandard.ZstdError as e:
+            raise CompressionError(f"Invalid zstd payload - {e}")
+        if len(result) > MAX_PAYLOAD:
+            raise CompressionError("Compressed payload exceeds the frame limit.")
+        return result
+
+
+class Lz4Compression:
+    name = "lz4"
+
+    def compress(self, data) -> bytes:
+        return lz4.frame.compress(data, store_size=True)
+
+    def decompress(self, data) -> bytes:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            result = decompressor.decompress(data, max_length=MAX_PAYLOAD + 1)
+        except RuntimeError as e:
+            raise CompressionError(f"Invalid lz4 payload - {e}")
+        if len(result) > MAX_PAYLOAD:
+            raise CompressionError("Compressed payload exceeds the frame limit.")
+        if not decompressor.eof:
+            raise CompressionError("Truncated lz4 payload.")
+        return result
+
+
+COMPRESSIONS = {ZlibCompression.name: ZlibCompression}
+if zstandard:
+    COMPRESSIONS[ZstdCompression.name] = ZstdCompression
+if lz4:
+    COMPRESSIONS[Lz4Compression.name] = Lz4Compression
+# In order of preference, zlib is always there.
+PREFERRED = [name for name in ("zstd", "lz4", "zlib") if name in COMPRESSIONS]
+
+
+def negotiate(offered):
+    for name in PREFERRED:
+        if name in offered:
+            return name
+    return None
+
+
+def compressible(mime: str) -> bool:
+    if not mime or mime in COMPRESSIBLE_MEDIA:
+        return True
+    if mime.split("/")[0] in ("image", "audio", "video"):
+        return False
+    return mime not in INCOMPRESSIBLE_TYPES
+
+
+class CompressedStream:
+    # Compresses the payloads of one sender, falling back to raw payloads
+    # whenever compression does not pay for itself.
+    def __init__(self, compression, labels: dict = None) -> None:
+        self.compression = compression
+        labels = labels or {}
+        self._raw = REGISTRY.counter("peerlink_session_compress_raw_bytes_total",
+                                     "Payload bytes before compression.", **labels)
+        self._wire = REGISTRY.counter("peerlink_session_compress_wire_bytes_total",
+                                      "Payload bytes after compression.", **labels)
+        self.raw = 0
+        self.wire = 0
+        self._misses = 0
+        self._skipped = 0
+        self._interval = PROBE_INTERVAL
+
+    @property
+    def ratio(self) -> float:
+        # Bytes on the wire per byte of payload for this stream, lower is better.
+        return self.wire / self.raw if self.raw else 1.0
+
+    def pack(self, payload: bytes) -> bytes:
+        packed = payload
+        if len(payload) >= MIN_SIZE and not self._backing_off():
+            packed = COMPRESSED + self.compression.compress(payload)
+            if len(packed) > len(payload) * MAX_RATIO:
+                self._misses += 1
+                if self._misses > MISSES_BEFORE_BACKOFF:
+                    self._interval = min(self._interval * 2, MAX_PROBE_INTERVAL)
+                packed = payload
+            else:
+                self._misses = 0
+                self._interval = PROBE_INTERVAL
+        self.raw += len(payload)
+        self.wire += len(packed)
+        self._raw.inc(len(payload))
+        self._wire.inc(len(packed))
+        return packed
+
+    def _backing_off(self) -> bool:
+        if self._misses < MISSES_BEFORE_BACKOFF:
+            return False
+        self._skipped += 1
+        if self._skipped < self._interval:
+            return True
+        self._skipped = 0
+        return False
+
+
+def unpack(compression, payload: bytes) -> bytes:
+    if payload[:1] != COMPRESSED:
+        return payload
+    if compression is None:
+        raise CompressionError("Compressed payload on a session without compression.")
+    return compression.decompress(memoryview(payload)[1:])
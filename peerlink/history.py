@@ -0,0 +1,167 @@
+import sqlite3
+from logging import exception
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import sleep, time
+
+HISTORY_DB = "history.db"
+# Unless a full batch is waiting already, the writer lets rows gather this
+# long after the first one, then commits up to WRITE_BATCH of them at once.
+WRITE_DELAY = 0.05
+WRITE_BATCH = 512
+PAGE_SIZE = 100
+SEARCH_LIMIT = 50
+
+TEXT = "text"
+FILE = "file"
+FILE_RECIEVED = "file_recieved"
+FILE_SENT = "file_sent"
+FILE_FAILED = "file_failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    outgoing INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_peer_time ON messages (peer, time, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    text, content='messages', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+COLUMNS = "id, peer, time, kind, outgoing, text"
+
+
+def _match(query: str) -> str:
+    # Each word is searched as an FTS5 phrase of its own, so quotes, dashes
+    # and the like are plain text. A trailing * still matches by prefix.
+    terms = []
+    for word in query.split():
+        prefix = len(word) > 1 and word.endswith("*")
+        quoted = (word[:-1] if prefix else word).replace('"', '""')
+        terms.append(f'"{quoted}"*' if prefix else f'"{quoted}"')
+    return " ".join(terms)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # With WAL a crash can only lose the last transactions, never corrupt.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class History(Thread):
+    # Append only log of messages and file events per peer uuid. Writes are
+    # queued and committed in batches on this thread, reads go through their
+    # own connection and never wait for the writer.
+    def __init__(self, path: str) -> None:
+        super().__init__(name="history-writer", daemon=True)
+        self.path = path
+        self._rows = Queue()
+        self._reader = connect(path)
+        self._reader.executescript(SCHEMA)
+        self._lock = Lock()
+
+    def record(self, peer: str, kind: str, text: str, outgoing: bool = False, when: float = None):
+        self._rows.put((peer, when or time(), kind, int(outgoing), text))
+
+    def flush(self):
+        # Blocks until everything recorded so far is committed.
+        self._rows.join()
+
+    def close(self):
+        self._rows.put(None)
+        self.join()
+        with self._lock:
+            self._reader.close()
+
+    def page(self, peer: str, before=None, limit: int = PAGE_SIZE):
+        # Newest first. before is the (time, id) of the oldest row already
+        # shown, pages are found through the (peer, time, id) index.
+        with self._lock:
+            if before is None:
+                return self._reader.execute(
+                    f"SELECT {COLUMNS} FROM messages WHERE peer = ? "
+                    "ORDER BY time DESC, id DESC LIMIT ?", (peer, limit)).fetchall()
+            return self._reader.execute(
+                f"SELECT {COLUMNS} FROM messages WHERE peer = ? AND (time, id) < (?, ?) "
+                "ORDER BY time DESC, id DESC LIMIT ?", (peer, *before, limit)).fetchall()
+
+    def search(self, query: str, peer: str = None, limit: int = SEARCH_LIMIT):
+        # Messages with every word of query, newest first. Walking the index
+        # by rowid stops after limit hits, ranking would score every match.
+        query = _match(query)
+        if not query:
+            return []
+        sql = ("SELECT m.id, m.peer, m.time, m.kind, m.outgoing, m.text "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ?")
+        args = [query]
+        if peer:
+            sql += " AND m.peer = ?"
+            args.append(peer)
+        sql += " ORDER BY messages_fts.rowid DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            return self._reader.execute(sql, args).fetchall()
+
+    def pager(self, peer: str) -> "Pager":
+        return Pager(self, peer)
+
+    def run(self):
+        conn = connect(self.path)
+        closing = False
+        while not closing:
+            batch = []
+            row = self._rows.get()
+            if row is not None and self._rows.qsize() < WRITE_BATCH:
+                sleep(WRITE_DELAY)
+            while True:
+                if row is None:
+                    closing = True
+                    break
+                batch.append(row)
+                if len(batch) == WRITE_BATCH:
+                    break
+                try:
+                    row = self._rows.get_nowait()
+                except Empty:
+                    break
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO messages (peer, time, kind, outgoing, text) "
+                        "VALUES (?, ?, ?, ?, ?)", batch)
+            except sqlite3.Error:
+                exception(f"Couldn't write {len(batch)} rows to {self.path}")
+            for _ in range(len(batch) + closing):
+                self._rows.task_done()
+        conn.close()
+
+
+class Pager:
+    # Walks one peer's history backwards a page at a time.
+    def __init__(self, history: History, peer: str) -> None:
+        self.history = history
+        self.peer = peer
+        self._before = None
+        self.done = False
+
+    def older(self, count: int = PAGE_SIZE):
+        # Oldest first, ready to go above what is shown already.
+        if self.done:
+            return []
+        rows = self.history.page(self.peer, self._before, count)
+        if len(rows) < count:
+            self.done = True
+        if rows:
+            self._before = (rows[-1]["time"], rows[-1]["id"])
+        return rows[::-1]
@@ -0,0 +1,96 @@
+import json
+import os
+from os.path import dirname, expanduser, join
+from threading import Lock
+from time import time
+
+from cryptography.exceptions import InvalidTag
+from noise.connection import Keypair, NoiseConnection
+from noise.exceptions import NoiseHandshakeError, NoiseInvalidMessage, NoiseValueError
+
+PEERLINK_HOME = os.environ.get("PEERLINK_HOME") or join(expanduser("~"), ".peerlink")
+KNOWN_PEERS = "known_peers.json"
+# A handshake message that does not authenticate surfaces as InvalidTag,
+# the rest come from messages that are malformed or out of order.
+HANDSHAKE_ERRORS = (InvalidTag, NoiseHandshakeError, NoiseInvalidMessage, NoiseValueError,
+                    ValueError)
+
+
+def noise(pattern: str, priv_key: bytes = None, remote_key: bytes = None,
+          psk: bytes = None) -> NoiseConnection:
+    proto = NoiseConnection.from_name(f"Noise_{pattern}_25519_ChaChaPoly_SHA256".encode())
+    if priv_key and not pattern.startswith("NN"):
+        proto.set_keypair_from_private_bytes(Keypair.STATIC, priv_key)
+    if remote_key:
+        proto.set_keypair_from_public_bytes(Keypair.REMOTE_STATIC, remote_key)
+    if psk:
+        proto.set_psks(psk)
+    return proto
+
+
+def read_handshake(proto: NoiseConnection, message: bytes):
+    # noiseprotocol drops its handshake state, and the remote static key with
+    # it, as soon as the last message is read, so the key is taken from the
+    # state object before that. Returns the key, or None if not sent yet.
+    state = proto.noise_protocol.handshake_state
+    proto.read_message(message)
+    # Until it is known rs is a placeholder without public_bytes.
+    return getattr(getattr(state, "rs", None), "public_bytes", None)
+
+
+class KnownPeers:
+    # Public keys of peers we had a session with, keyed by uuid. A trusted
+    # peer that proves it still holds its key is accepted without asking.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._peers = {}
+        self._lock = Lock()
+        try:
+            with open(path) as file:
+                self._peers = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, uuid: str) -> dict:
+        return self._peers.get(uuid)
+
+    def key(self, uuid: str) -> bytes:
+        peer = self._peers.get(uuid)
+        return bytes.fromhex(peer["key"]) if peer else None
+
+    def by_addr(self, ip: str, port: int):
+        # Returns (uuid, peer) for the peer last seen listening on ip:port.
+        found = [(peer["seen"], uuid, peer) for uuid, peer in list(self._peers.items())
+                 if peer["ip"] == ip and peer["port"] == port]
+        if not found:
+            return None, None
+        _, uuid, peer = max(found)
+        return uuid, peer
+
+    def trusted(self, uuid: str, key: bytes) -> bool:
+        peer = self._peers.get(uuid)
+        return bool(peer and peer["trusted"] and key and peer["key"] == key.hex())
+
+    def remember(self, uuid: str, name: str, key: bytes, ip: str, port: int):
+        with self._lock:
+            self._peers[uuid] = {"name": name, "key": key.hex(), "ip": ip, "port": port,
+                                 "trusted": True, "seen": time()}
+            self._save()
+
+    def forget(self, uuid: str):
+        with self._lock:
+            if self._peers.pop(uuid, None):
+                self._save()
+
+    def _save(self):
+        os.makedirs(dirname(self.path), exist_ok=True)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as file:
+            json.dump(self._peers, file)
+        os.replace(temp, self.path)
+
+    def __contains__(self, uuid: str):
+        return uuid in self._peers
+
+    def __len__(self):
+        return len(self._peers)
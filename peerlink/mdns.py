@@ -1,72 +1,177 @@
+import asyncio
+from logging import exception, info
+from threading import Lock
+from time import monotonic
 from typing import List
 
+from peerlink.metrics import REGISTRY
 from peerlink.utils import Signal
-from zeroconf import ServiceInfo, ServiceListener, Zeroconf
+from zeroconf import ServiceBrowser, ServiceInfo, ServiceStateChange, Zeroconf
+from zeroconf.asyncio import AsyncServiceInfo
 
+SERVICE_TYPE = "_p2p._tcp.local."
+# Group rooms are advertised by their host as services of their own.
+ROOM_SERVICE_TYPE = "_p2proom._tcp.local."
+RESOLVE_TIMEOUT = 3.0
+SERVICE_EXISTS_TIMEOUT = 0.25
+# Once browsing has run this long the directory is taken as complete.
+WARMUP = 1.0
 
-class Listener(ServiceListener):
+DISCOVERY_EVENTS = {event: REGISTRY.counter("peerlink_discovery_events_total",
+                                            "mDNS service events seen.", event=event)
+                    for event in ("add", "update", "remove")}
+
+
+class PeerDirectory:
+    # Resolved services by name. Entries stay until zeroconf reports the
+    # service removed, which it also does once the records expire from its
+    # cache, so refreshed records keep a live peer listed.
     def __init__(self) -> None:
-        super().__init__()
         self.onadd = Signal("servicename", "addresses", "port")
         self.onremove = Signal("servicename")
+        self._peers = {}
+        self._lock = Lock()
 
-    def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        print(f"Service {name} updated")
+    def add(self, name: str, addresses, port: int):
+        record = (list(addresses), port)
+        with self._lock:
+            previous = self._peers.get(name)
+            self._peers[name] = record
+        if previous == record:
+            return
+        if previous:
+            self.onremove.emit(name)
+        self.onadd.emit(name, record[0], port)
 
-    def remove_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        self.onremove.emit(name.removesuffix(f".{type_}"))
-        print(f"Service {name} removed")
+    def remove(self, name: str):
+        with self._lock:
+            removed = self._peers.pop(name, None)
+        if removed:
+            self.onremove.emit(name)
 
-    def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        service = self.get_info(zc, type_, name)
-        if service:
-            self.onadd.emit(service.name.removesuffix(f".{type_}"), service.addresses, service.port)
-            print(
-                f"Service {name} added, service addr: {service.parsed_addresses()}:{service.port}"
-            )
+    def get(self, name: str):
+        # Returns (addresses, port) of a known service.
+        return self._peers.get(name)
+
+    def __contains__(self, name: str):
+        return self.get(name) is not None
 
-    def get_info(self, zc: Zeroconf, type_, name):
-        return zc.get_service_info(type_, name)
+    def __iter__(self):
+        return iter(list(self._peers))
+
+    def __len__(self):
+        return len(self._peers)
 
 
 class MultiDNS:
-    mdns = Zeroconf()
-    listener = Listener()
-    service_info = None
-
-    @classmethod
-    def register_service(cls, name: str, port: int, addresses: List[bytes]) -> None:
-        cls.service_info = ServiceInfo(
-            type_="_p2p._tcp.local.",
-            name=f"{name}._p2p._tcp.local.",
+    def __init__(self) -> None:
+        self.mdns = Zeroconf()
+        self.directory = PeerDirectory()
+        self.rooms = PeerDirectory()
+        self.service_info = None
+        self.room_infos = {}
+        # Browsing starts right away so the directory is warm by the time
+        # a username is checked.
+        self.browser = ServiceBrowser(self.mdns, [SERVICE_TYPE, ROOM_SERVICE_TYPE],
+                                      handlers=[self._on_change])
+        self._started = monotonic()
+
+    def register_service(self, name: str, port: int, addresses: List[bytes]) -> None:
+        self.service_info = ServiceInfo(
+            type_=SERVICE_TYPE,
+            name=f"{name}.{SERVICE_TYPE}",
             port=port,
             addresses=addresses,
         )
-        cls.mdns.register_service(cls.service_info)
-        pass
-
-    @classmethod
-    def service_listener(cls) -> None:
-        cls.mdns.add_service_listener("_p2p._tcp.local.", cls.listener)
-        pass
-
-    @classmethod
-    def unregister(cls):
-        if cls.service_info:
-            cls.mdns.unregister_service(cls.service_info)
-        cls.mdns.remove_all_service_listeners()
-
-    @classmethod
-    def service_exists(cls, name):
-        if cls.mdns.get_service_info(
-            type_="_p2p._tcp.local.", name=f"{name}._p2p._tcp.local."
-        ):
+        self.mdns.register_service(self.service_info)
+
+    def register_room(self, name: str, port: int, addresses: List[bytes]) -> None:
+        self.room_infos[name] = ServiceInfo(
+            type_=ROOM_SERVICE_TYPE,
+            name=f"{name}.{ROOM_SERVICE_TYPE}",
+            port=port,
+            addresses=addresses,
+        )
+        self.mdns.register_service(self.room_infos[name])
+
+    def unregister_room(self, name: str) -> None:
+        service = self.room_infos.pop(name, None)
+        if service:
+            self.mdns.unregister_service(service)
+
+    def service_listener(self) -> None:
+        # Services found before anyone listened are announced now.
+        for directory in (self.directory, self.rooms):
+            for name in directory:
+                record = directory.get(name)
+                if record:
+                    directory.onadd.emit(name, *record)
+
+    def unregister(self):
+        for name in list(self.room_infos):
+            self.unregister_room(name)
+        if self.service_info:
+            self.mdns.unregister_service(self.service_info)
+            self.service_info = None
+
+    def service_exists(self, name: str, timeout: float = SERVICE_EXISTS_TIMEOUT,
+                       service_type: str = SERVICE_TYPE) -> bool:
+        # The directory and zeroconf's record cache answer without touching
+        # the network. Only right after startup, while browsing may not have
+        # heard from everyone, is a name neither has seen asked for, briefly.
+        if name in self._directory(service_type):
             return True
-        else:
+        service = AsyncServiceInfo(service_type, f"{name}.{service_type}")
+        if service.load_from_cache(self.mdns):
+            return True
+        if monotonic() - self._started > WARMUP:
+            return False
+        future = asyncio.run_coroutine_threadsafe(
+            service.async_request(self.mdns, int(timeout * 1000)), self.mdns.loop)
+        try:
+            return bool(future.result(timeout + 1))
+        except Exception:
+            exception(f"Couldn't look up {name}")
             return False
 
-    @classmethod
-    def shutdown(cls):
-        cls.unregister()
-        cls.mdns.close()
+    def room_exists(self, name: str) -> bool:
+        return self.service_exists(name, service_type=ROOM_SERVICE_TYPE)
+
+    def shutdown(self):
+        self.browser.cancel()
+        self.unregister()
+        self.mdns.close()
+
+    def _on_change(self, zeroconf: Zeroconf, service_type: str, name: str,
+                   state_change: ServiceStateChange) -> None:
+        # Runs on the browser thread, nothing here may block.
+        short = name.removesuffix(f".{service_type}")
+        if state_change is ServiceStateChange.Removed:
+            DISCOVERY_EVENTS["remove"].inc()
+            info("Service %s removed", name)
+            self._directory(service_type).remove(short)
+            return
+        DISCOVERY_EVENTS["add" if state_change is ServiceStateChange.Added else "update"].inc()
+        service = AsyncServiceInfo(service_type, name)
+        if service.load_from_cache(zeroconf):
+            self._resolved(service)
+        else:
+            # Every unresolved peer is asked for on zeroconf's own loop, so
+            # many of them resolve concurrently.
+            asyncio.run_coroutine_threadsafe(self._resolve(service), zeroconf.loop)
+
+    async def _resolve(self, service: AsyncServiceInfo):
+        if await service.async_request(self.mdns, int(RESOLVE_TIMEOUT * 1000)):
+            self._resolved(service)
+
+    def _resolved(self, service: ServiceInfo):
+        if not service.addresses:
+            return
+        info("Service %s added, service addr: %s:%s",
+             service.name, service.parsed_addresses(), service.port)
+        self._directory(service.type).add(service.name.removesuffix(f".{service.type}"),
+                                          service.addresses, service.port)
+
+    def _directory(self, service_type: str) -> PeerDirectory:
+        return self.rooms if service_type == ROOM_SERVICE_TYPE else self.directory
 
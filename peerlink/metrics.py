@@ -0,0 +1,181 @@
+import json
+import os
+from bisect import bisect_left
+from logging import exception
+from threading import Event, Lock, Thread
+from time import time
+
+# Bucket bounds in seconds for timings and in bytes per second for rates.
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+RATE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+EXPORT_INTERVAL = 10.0
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def set(self, value):
+        # A single store, the last writer wins so no lock is needed.
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=TIME_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count, "sum": self.sum,
+                    "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self.counts))}
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._help = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = "", **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str = "", buckets=TIME_BUCKETS, **labels) -> Histogram:
+        return self._get(lambda: Histogram(buckets), name, help, labels)
+
+    def _get(self, factory, name, help, labels):
+        # Callers look their metrics up once and keep them, the hot path only
+        # touches the metric itself.
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+                    self._help.setdefault(name, help)
+        return metric
+
+    def remove(self, **match):
+        # Drops every series whose labels contain every key of match, the
+        # metrics of a session that is gone.
+        with self._lock:
+            for key in list(self._metrics):
+                labels = dict(key[1])
+                if all(labels.get(name) == value for name, value in match.items()):
+                    del self._metrics[key]
+
+    def snapshot(self, **match) -> dict:
+        # {name: [{"labels": {...}, "value": ...}, ...]}, optionally only the
+        # series whose labels contain every key of match.
+        result = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            labels = dict(labels)
+            if any(labels.get(key) != value for key, value in match.items()):
+                continue
+            result.setdefault(name, []).append({"labels": labels, "value": metric.snapshot()})
+        return result
+
+    def to_json(self) -> str:
+        return json.dumps({"time": time(), "metrics": self.snapshot()})
+
+    def to_prometheus(self) -> str:
+        lines = []
+        families = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            families.setdefault(name, []).append((labels, metric))
+        for name, series in families.items():
+            if self._help.get(name):
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {series[0][1].kind}")
+            for labels, metric in series:
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {metric.value}")
+                    continue
+                value = metric.snapshot()
+                total = 0
+                for bound, count in value["buckets"].items():
+                    total += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {total}")
+                lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class Exporter(Thread):
+    def __init__(self, registry: Registry, path: str, interval: float = EXPORT_INTERVAL,
+                 format: str = None) -> None:
+        super().__init__(name="metrics-exporter", daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        # Prometheus text unless the file is named *.json.
+        self.format = format or ("json" if path.endswith(".json") else "prometheus")
+        self._halt = Event()
+
+    def write(self):
+        data = self.registry.to_json() if self.format == "json" else self.registry.to_prometheus()
+        # Readers never see a half written file.
+        temp = self.path + ".tmp"
+        with open(temp, "w") as file:
+            file.write(data)
+        os.replace(temp, self.path)
+
+    def stop(self):
+        self._halt.set()
+        self.join(self.interval)
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                exception(f"Couldn't export metrics to {self.path}")
+        try:
+            self.write()
+        except OSError:
+            exception(f"Couldn't export metrics to {self.path}")
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+REGISTRY = Registry()
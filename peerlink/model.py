@@ -1,206 +1,741 @@
 from atexit import register as callonexit
+from functools import partial
+from importlib import import_module
+from logging import error, exception, warning
+from os import urandom
+from os.path import abspath, basename, isdir, join
 from socket import inet_aton, inet_ntoa
-
-from peerlink.mdns import MultiDNS
-from peerlink.network import LOCAL_IP, Reciever, Sender
-from noise.connection import NoiseConnection, NoiseInvalidMessage
-from peerlink.ui import QSignal
-from peerlink.utils import MsgFormat, Peer, Signal
+from threading import Thread
+from time import perf_counter
+
+from peerlink.chunks import CHUNK_DB, STORE_LIMIT, REUSED_BYTES, ChunkStore
+from peerlink.history import (FILE, FILE_FAILED, FILE_RECIEVED, FILE_SENT,
+                              HISTORY_DB, TEXT, History)
+from peerlink.metrics import EXPORT_INTERVAL, REGISTRY, Exporter
+from peerlink.network import Sender, local_ip
+from peerlink.session import Session, SessionManager
+from peerlink.keystore import (HANDSHAKE_ERRORS, KNOWN_PEERS, PEERLINK_HOME,
+                               KnownPeers, noise, read_handshake)
+from peerlink.transfer import (CHUNK_HEADER, FILE_CHUNK, PARALLEL_MIN_SIZE,
+                               IncomingFile, IncomingTree, SendQueue, Tree)
+from peerlink.codec import (CODECS, PREFERRED, Accept, ChunkList, CodecError,
+                            FileHeader, Join, JsonCodec, Leave, Manifest, Members,
+                            Post, Request, Resume, Shut, Stream, Text, decode,
+                            negotiate)
+from peerlink.rooms import ROOM_PREFIX, FanOut, Room
+from peerlink import compression
+from peerlink.utils import DirectSignal, Peer, Signal
+
+SHUTDOWN_TIMEOUT = 2.0
+HANDSHAKE_TIMEOUT = 10.0
+# Extra connections of a parallel transfer are keyed with a fresh secret the
+# reciever hands out in its Resume, NNpsk0 lets only the session's peer in.
+STREAM_PATTERN = 'NNpsk0'
+STREAM_KEY_SIZE = 32
+# Offered alongside the codecs by nodes that keep a chunk store.
+DEDUP = 'cdc'
+# Engines are imported when chosen, asyncio alone adds tens of milliseconds
+# to startup.
+ENGINES = {'selectors': 'peerlink.network.Reciever', 'asyncio': 'peerlink.aio.AsyncReciever'}
+
+HANDSHAKE_TIME = REGISTRY.histogram('peerlink_handshake_seconds',
+                                    'Time from session start to a secure session.')
+FILES_RECIEVED = REGISTRY.counter('peerlink_files_recieved_total', 'Files recieved completely.')
 
 
 class RequestReciver:
-    def __init__(self, reciever: Reciever) -> None:
-        self.onreqrecv = Signal('data')
-        self.onreqacpt = Signal('data')
+    def __init__(self, reciever: SessionManager) -> None:
+        self.onreqrecv = Signal('data', 'sock')
+        self.onreqacpt = Signal('data', 'sock')
+        self.onstream = Signal('data', 'sock')
         self._reciever = reciever
-        self._reciever.ondata.connect(self._read)
+        self._reciever.onframe.connect(self._read)
 
 
     def _read(self, data, sock):
-        data = MsgFormat.unpack(data)
-        data['sock'] = sock
         try:
-            if data.get('query') == 'req':
-                self.onreqrecv.emit(data)
-            elif data.get('query') == 'acp':
-                self.onreqacpt.emit(data)
-        except KeyError:
-            raise KeyError(f'Invalid data recived - {data}')
+            data = decode(data)
+        except CodecError:
+            exception('Dropped a connection that sent an invalid request.')
+            self._reciever.drop(sock)
+            return
+        if isinstance(data, Accept):
+            self.onreqacpt.emit(data, sock)
+        elif isinstance(data, Request):
+            self.onreqrecv.emit(data, sock)
+        elif isinstance(data, Stream):
+            self.onstream.emit(data, sock)
 
     def disable(self):
-        self._reciever.ondata.disconnect(self._read)
+        self._reciever.onframe.disconnect(self._read)
 
 
 class SecureConnection:
-    def __init__(self, reciever : Reciever, sender : Sender , proto : NoiseConnection, initiator = False) -> None:
-        self.reciever = reciever
-        reciever.ondata.connect(self._read_payload)
+    def __init__(self, session : Session, initiator = False) -> None:
+        self.session = session
+        session.onframe.connect(self._read_payload)
 
-        self.onconnsecure = Signal()
-        self.proto = proto
-        self.sender = sender
+        self.onconnsecure = Signal('session')
+        self.onfailed = Signal('session')
+        self.proto = session.proto
+        self.sender = session.sender
 
         if initiator:
-            proto.set_as_initiator()
-            proto.start_handshake()
-            sender.send_data(proto.write_message())
+            self.proto.set_as_initiator()
+            self.proto.start_handshake()
+            self.sender.send_data(self.proto.write_message())
         else:
-            proto.set_as_responder()
-            proto.start_handshake()
+            self.proto.set_as_responder()
+            self.proto.start_handshake()
 
 
     
     def _read_payload(self, data, sock):
-        self.proto.read_message(data)
+        try:
+            key = read_handshake(self.proto, data)
+        except HANDSHAKE_ERRORS as e:
+            exception('Handshake failed.')
+            self.disable()
+            self.onfailed.emit(self.session)
+            return
+        if key:
+            self.session.remote_key = key
         if not self.proto.handshake_finished:
             self.sender.send_data(self.proto.write_message())
             if self.proto.handshake_finished:
-                self.onconnsecure.emit()
-                self.reciever.ondata.disconnect(self._read_payload)
+                self.disable()
+                self.onconnsecure.emit(self.session)
         else:
-            self.onconnsecure.emit()
-            self.reciever.ondata.disconnect(self._read_payload)
+            self.disable()
+            self.onconnsecure.emit(self.session)
 
     def disable(self):
-        self.reciever.ondata.disconnect(self._read_payload)
+        self.session.onframe.disconnect(self._read_payload)
 
 class ChatReciver:
-    def __init__(self, reciever: Reciever, proto : NoiseConnection = None) -> None:
-        self.ontext = Signal('data')
-        self.onfile = Signal('data', 'finished')
-        self.onshut = Signal()
-        self._reciever = reciever
-        self._reciever.ondata.connect(self._read)
-        self._proto = proto
+    # With a store, files offered as a ChunkList take the chunks it has
+    # from there and the chunks recieved go into it. connections stops
+    # reading a socket while the disk falls behind its chunks.
+    def __init__(self, session: Session, downloads: str = '.', store: ChunkStore = None,
+                 connections: SessionManager = None) -> None:
+        self.ontext = Signal('session', 'data')
+        self.onfile = Signal('session', 'data', 'finished')
+        self.onreply = Signal('session', 'data')
+        self.onresume = Signal('session', 'data')
+        self.onroom = Signal('session', 'data')
+        self.onpost = Signal('session', 'data')
+        self.onshut = Signal('session')
+        self._session = session
+        self._session.onframe.connect(self._read)
+        self._proto = session.proto
+        self._compression = None
+        if session.compression:
+            self._compression = compression.COMPRESSIONS[session.compression]()
+        self._downloads = downloads
+        self._incoming = {}
+        # Entries of manifests and chunk lists still arriving, by transfer,
+        # and the digest at every offset of files coming in by chunk list.
+        self._manifests = {}
+        self._offers = {}
+        self._digests = {}
+        self._store = store
+        self._connections = connections
+        # Keys handed out for parallel transfers, and the Noise session of
+        # every extra stream with the transfer it carries.
+        self.keys = {}
+        self._streams = {}
             
     
     def _read(self, data, sock):
         try:
-            if self._proto:
-                data = MsgFormat.unpack(self._proto.decrypt(data))
-            else:
-                data = MsgFormat.unpack(data)
-        except NoiseInvalidMessage :
-            raise 
-
+            proto = self._proto
+            if sock in self._streams:
+                proto = self._streams[sock][0]
+            if proto:
+                start = perf_counter()
+                data = proto.decrypt(data)
+                self._session.decrypt_time.observe(perf_counter() - start)
+        except HANDSHAKE_ERRORS:
+            exception(f'Closing the session with {self._session.name}, a frame failed to decrypt.')
+            self._shut()
+            return
+        try:
+            data = compression.unpack(self._compression, data)
+        except compression.CompressionError as e:
+            exception('Dropped a frame that failed to decompress.')
+            return
+
+        if data[:1] == FILE_CHUNK:
+            if len(data) < CHUNK_HEADER.size:
+                error(f'Closing the session with {self._session.name}, it sent a short chunk.')
+                self._shut()
+                return
+            self._recv_chunk(data, sock)
+            return
         try:
-            if isinstance(data, dict):
-                if data.get('text'):
-                    self.ontext.emit(data)
-                elif data.get('filename'):
-                    self.onfile.emit(data, False)
-                    self._tmp_file = open(data.get('filename'), 'wb')
-                    self._tmp_file_size = data.get('size')
-                    self._reciever.ondata.disconnect(self._read)
-                    self._reciever.ondata.connect(self._recv_file)
-                elif data.get('query') == 'shut':
-                    self._reciever.ondata.disconnect(self._read)
-                    self.onshut.emit()
-        except KeyError:
-            raise KeyError(f'Invalid data recieved - {data}')
+            data = decode(data)
+        except CodecError:
+            exception(f'Closing the session with {self._session.name}, it sent an invalid frame.')
+            self._shut()
+            return
+        self._dispatch(data)
+
+    def _dispatch(self, data):
+        if isinstance(data, Text):
+            self.ontext.emit(self._session, data)
+        elif isinstance(data, FileHeader):
+            self._recv_header(data)
+        elif isinstance(data, Manifest):
+            self._recv_manifest(data)
+        elif isinstance(data, ChunkList):
+            self._offers.setdefault(data.transfer, []).extend(data.chunks)
+        elif isinstance(data, Resume):
+            self.onresume.emit(self._session, data)
+        elif isinstance(data, Post):
+            self.onpost.emit(self._session, data)
+        elif isinstance(data, (Members, Join)):
+            self.onroom.emit(self._session, data)
+        elif isinstance(data, Shut):
+            self._shut()
+
+    def _shut(self):
+        self.disable()
+        self.onshut.emit(self._session)
 
     def disable(self):
-        self._reciever.ondata.disconnect(self._read)
-    
-    def _recv_file(self, data):
-        self._tmp_file.write(data)
-        self._tmp_file_size -= len(data)
-        if self._tmp_file_size == 0:
-            self._reciever.ondata.disconnect(self._recv_file)
-            self._reciever.ondata.connect(self._read)
-            self._tmp_file.close()
-            self.onfile.emit(None, True)
+        self._session.onframe.disconnect(self._read)
+        self.close()
+
+    def close(self):
+        for incoming in self._incoming.values():
+            incoming.suspend()
+        self._incoming.clear()
+        self._manifests.clear()
+        self._offers.clear()
+        self._digests.clear()
+        self.keys.clear()
+        self._streams.clear()
+
+    def attach(self, sock, transfer, proto):
+        self._streams[sock] = (proto, transfer)
+
+    def _recv_manifest(self, data):
+        entries = self._manifests.setdefault(data.transfer, [])
+        entries.extend(data.entries)
+        if not data.last:
+            return
+        data.entries = self._manifests.pop(data.transfer)
+        try:
+            self._recv_header(data)
+        except ValueError as e:
+            exception(f'Refused the manifest of {data.filename}.')
+            self.onreply.emit(self._session, Resume(data.transfer, [], error=str(e)))
+
+    def _recv_header(self, data):
+        chunks = self._offers.pop(data.transfer, None)
+        refetch = partial(self._refetch, data.transfer)
+        try:
+            if isinstance(data, Manifest):
+                incoming = IncomingTree(data, self._downloads, refetch)
+            elif chunks and self._store and sum(length for _, length in chunks) == data.size:
+                incoming = self._deduplicated(data, chunks, refetch)
+            else:
+                chunks = None
+                incoming = IncomingFile(data, self._downloads, refetch=refetch)
+        except OSError as e:
+            exception(f"Couldn't store {data.filename}.")
+            self.onreply.emit(self._session, Resume(data.transfer, [], error=str(e)))
+            return
+        self.onfile.emit(self._session, data, False)
+        # The reply tells the sender which ranges are still missing, a
+        # transfer cut short earlier only resends what never arrived.
+        missing = incoming.missing()
+        key = b''
+        if sum(end - start for start, end in missing) >= PARALLEL_MIN_SIZE:
+            key = self.keys[incoming.transfer] = urandom(STREAM_KEY_SIZE)
+        # With a bitmap the sender goes by chunks, the ranges would only
+        # make the reply longer than a frame may be.
+        wanted = incoming.wanted() if chunks else b''
+        ranges = [] if wanted else missing
+        self.onreply.emit(self._session, Resume(incoming.transfer, ranges, key, wanted))
+        if incoming.done:
+            incoming.finish(partial(self.onfile.emit, self._session, None, True))
+        else:
+            self._incoming[incoming.transfer] = incoming
+
+    def _deduplicated(self, data, chunks, refetch):
+        digests, spans, offset = {}, {}, 0
+        for digest, length in chunks:
+            digests[offset] = digest
+            spans[offset] = length
+            offset += length
+        incoming = IncomingFile(data, self._downloads, spans=spans, refetch=refetch)
+        # The chunks found are pinned until the writer has read them, the
+        # store may need room for others meanwhile.
+        found = self._store.has(digests.values(), pin=True)
+        reused, present = 0, []
+        for offset, digest in digests.items():
+            if digest not in found:
+                continue
+            if incoming.reuse(offset, partial(self._load, digest)):
+                reused += spans[offset]
+            else:
+                present.append(digest)
+        self._store.unpin(present)
+        REUSED_BYTES.inc(reused)
+        self._digests[data.transfer] = digests
+        return incoming
+
+    def _load(self, digest):
+        try:
+            return self._store.get(digest)
+        finally:
+            self._store.unpin([digest])
+
+    def _refetch(self, transfer, ranges):
+        self.onreply.emit(self._session, Resume(transfer, ranges))
+
+    def _finished(self, incoming):
+        del self._incoming[incoming.transfer]
+        self._digests.pop(incoming.transfer, None)
+        self.keys.pop(incoming.transfer, None)
+        for sock, (_, transfer) in list(self._streams.items()):
+            if transfer == incoming.transfer:
+                del self._streams[sock]
+        incoming.finish(partial(self.onfile.emit, self._session, None, True))
+
+    def _recv_chunk(self, data, sock):
+        _, transfer, offset, crc = CHUNK_HEADER.unpack_from(data)
+        incoming = self._incoming.get(transfer.hex())
+        if incoming is None:
+            return
+        payload = memoryview(data)[CHUNK_HEADER.size:]
+        if incoming.write(offset, crc, payload) and incoming.transfer in self._digests:
+            self._store.put(self._digests[incoming.transfer][offset], payload)
+        if incoming.done:
+            self._finished(incoming)
+        elif self._connections and incoming.throttle(partial(self._connections.resume, sock)):
+            self._connections.pause(sock)
+
+
+class RoomReciver(ChatReciver):
+    # Sessions opened for a room carry posts and membership only. Anyone on
+    # the network can ask for one, so no chat and no files come through.
+    def _recv_chunk(self, data, sock):
         pass
 
+    def _dispatch(self, data):
+        if isinstance(data, Post):
+            self.onpost.emit(self._session, data)
+        elif isinstance(data, (Members, Join)):
+            self.onroom.emit(self._session, data)
+        elif isinstance(data, Shut):
+            self._shut()
+
 
 class Model:
-    def __init__(self, port=8080) -> None:
+    # signal builds the signals the front end connects to. DirectSignal runs
+    # slots on the network threads, the GUI passes ui.QSignal to have them
+    # delivered on the Qt thread.
+    # streams above 1 lets large files go out over up to that many
+    # connections, with as many as keep adding throughput.
+    # With dedup files are cut by content and only the chunks the peer does
+    # not hold yet are sent, each node keeps up to store_limit bytes of them.
+    def __init__(self, port=8080, engine='selectors', compress=True, home=None,
+                 signal=DirectSignal, downloads='.', streams=1, dedup=False,
+                 store_limit=STORE_LIMIT) -> None:
         callonexit(self.shutdown)
-        self.sent_reqs = list()
-        self.recv_reqs = list()
-        self.receiver = Reciever(host=LOCAL_IP, port=port)
-        self.mdns = MultiDNS()
-        self.local_devices = list()
-        self.connection = None
+        self.compress = compress
+        self.streams = streams
+        self.dedup = dedup
+        self.store_limit = store_limit
+        self.chunks = None
+        self.home = home or PEERLINK_HOME
+        self.downloads = downloads
+        self.known = None
+        self.history = None
+        self.sent_reqs = dict()
+        # Pending requests by uuid and discovered peers by service name.
+        self.recv_reqs = dict()
+        module, name = ENGINES[engine].rsplit('.', 1)
+        self.receiver = getattr(import_module(module), name)(host=local_ip(), port=port)
+        self.sessions = SessionManager(self.receiver)
+        # Zeroconf starts its sockets and threads with the first username.
+        self.mdns = None
+        self.local_devices = dict()
+        self.active = None
         self.state = None
-
-        self._register_signals()
-
-    def _register_signals(self):
-        self.onreqrecv = QSignal(str, str, int)
-        self.onreqacpt = QSignal(str, str, int)
-        self.ondevicediscovery = QSignal(str, str, int)
-        self.ondeviceloss = QSignal()
-        self.ontext = QSignal(str, float)
-        self.onfile = QSignal(str, float)
-        self.onfilefinished = QSignal()
-        self.ondisconnect = QSignal()
-        self.onconnsecure = QSignal()
-
-    def __set_chat_state(self):
-        self.onconnsecure.emit()
-        self.state = ChatReciver(self.receiver, self.proto)
-        self.state.ontext.connect(self._read_text)
-        self.state.onfile.connect(self._read_file)
-        self.state.onshut.connect(self._connection_shutdown)
-        self.local_devices.clear()
-        self.mdns.unregister()
-
-
-    def _secure_connection(self, initiator = False):
-        self.state.disable()
-        self.proto = NoiseConnection.from_name(b'Noise_NN_25519_ChaChaPoly_SHA256')
-        if initiator:
-            tmp = SecureConnection(self.receiver, self.connection, self.proto, True)
-        else:
-            tmp = SecureConnection(self.receiver, self.connection, self.proto)
-        tmp.onconnsecure.connect(self.__set_chat_state)
-
-            
-
-
-    def _connection_shutdown(self):
-        self.connection = None
-        self.receiver.ondata.disconnectall()
-        self.ondisconnect.emit()
+        self.exporter = None
+        # Group rooms this node hosts or is in, by name, rooms found over
+        # mDNS, and rooms asked to join by the host address they wait on.
+        self.rooms = dict()
+        self.local_rooms = dict()
+        self._joining = dict()
+        self._dialing = set()
+        self._fanout = FanOut()
+
+        self.sessions.onclosed.connect(self._connection_shutdown)
+        self._register_signals(signal)
+
+    def _register_signals(self, signal):
+        self.onreqrecv = signal(str, str, str, int)
+        self.onreqacpt = signal(str, str, str, int)
+        self.ondevicediscovery = signal(str, str, int)
+        self.ondeviceloss = signal(str)
+        self.ontext = signal(str, str, float)
+        self.onfile = signal(str, str, float)
+        self.onfilefinished = signal(str)
+        self.onfileprogress = signal(str, object, object, float, float)
+        self.onfilesent = signal(str, str)
+        self.onsenderror = signal(str, str)
+        self.ondisconnect = signal(str)
+        self.onconnsecure = signal(str)
+        self.onroomdiscovery = signal(str, str, int)
+        self.onroomloss = signal(str)
+        self.onroom = signal(str, object)
+        self.onroomtext = signal(str, str, str, float)
+        self.onroomclosed = signal(str)
+        self.onroomlinked = signal(str)
+
+    def __set_chat_state(self, session, accept=b''):
+        uuid = session.uuid
+        HANDSHAKE_TIME.observe(perf_counter() - session.started)
+        if session.remote_key and not session.room:
+            self._remember(session)
+        session.outbox = SendQueue(session.sender, session.proto, labels={'session': uuid},
+                                   compression=session.compression, streams=self.streams,
+                                   open_stream=partial(self._open_stream, session),
+                                   codec=session.codec, dedup=session.dedup)
+        session.outbox.onprogress.connect(
+            lambda sent, total, rate, eta: self.onfileprogress.emit(uuid, sent, total, rate, eta))
+        session.outbox.onfinished.connect(lambda filepath: self._file_sent(uuid, filepath))
+        session.outbox.onerror.connect(lambda error: self._send_error(uuid, error))
+        reciever = RoomReciver if session.room else ChatReciver
+        session.state = reciever(session, self.downloads, self.chunks if session.dedup else None,
+                                 self.sessions)
+        session.state.ontext.connect(self._read_text)
+        session.state.onfile.connect(self._read_file)
+        session.state.onreply.connect(self._reply)
+        session.state.onresume.connect(self._resume)
+        session.state.onshut.connect(self._connection_shutdown)
+        session.state.onroom.connect(self._room_message)
+        session.state.onpost.connect(self._read_post)
+        # An IK accept goes out once the peer's first chat frames have a
+        # reader, and ahead of anything the send queue writes.
+        if accept:
+            session.sender.send_data(accept)
+        session.outbox.start()
+        for name, addr in list(self._joining.items()):
+            if addr == session.addr:
+                session.outbox.send_data(session.codec.encode(Join(name)))
+        for room in list(self.rooms.values()):
+            for post in room.release(uuid):
+                self._fanout.send(post, [session])
+            if uuid in room.links(self.peer.get_uuid()) and self.linked(room.name):
+                self.onroomlinked.emit(room.name)
+        if not session.room:
+            self.onconnsecure.emit(uuid)
+
+
+    def _remember(self, session):
+        # Anyone may join a room, so keys from room sessions are never kept.
+        # A uuid proves nothing either, a key on record is only replaced once
+        # the user accepted the peer.
+        known = self.known.key(session.uuid)
+        if known and known != session.remote_key and not session.accepted:
+            warning(f'{session.name} presented another key than the one on record, '
+                    'it is not kept.')
+            return
+        self.known.remember(session.uuid, session.name, session.remote_key, *session.addr)
+
+    def _secure_connection(self, session, initiator = False, pattern = 'NN'):
+        session.proto = noise(pattern, self.peer.priv_key)
+        session.state = SecureConnection(session, initiator)
+        session.state.onconnsecure.connect(lambda session: self.__set_chat_state(session))
+        session.state.onfailed.connect(self._connection_shutdown)
+        self.receiver.call_later(HANDSHAKE_TIMEOUT, partial(self._handshake_timeout, session))
+
+    def _handshake_timeout(self, session):
+        if isinstance(session.state, SecureConnection):
+            session.state.disable()
+            self._connection_shutdown(session)
+
+    def _open_session(self, session, sock):
+        old = self.sessions.get(session.uuid)
+        if old:
+            # The new session already counts into the same series.
+            self._close_session(old, keep_metrics=True)
+        self.sessions.add(session, sock)
+        if not session.room:
+            self.active = session.uuid
+
+    def _close_session(self, session, farewell=None, keep_metrics=False):
+        self.sessions.remove(session)
+        if session.outbox:
+            session.outbox.close(SHUTDOWN_TIMEOUT, farewell)
+            session.outbox = None
+        if isinstance(session.state, ChatReciver):
+            session.state.close()
+        session.sender.shutdown()
+        if not keep_metrics:
+            REGISTRY.remove(session=session.uuid)
+        if self.active == session.uuid:
+            self.active = None
+
+    def _connection_shutdown(self, session):
+        if self.sessions.get(session.uuid) is not session:
+            return
+        self._close_session(session)
+        self._left_rooms(session)
+        if not session.room:
+            self.ondisconnect.emit(session.uuid)
 
     def _set_request_state(self):
         self.recv_reqs.clear()
-        self.state = RequestReciver(self.receiver)
+        self.state = RequestReciver(self.sessions)
         self.state.onreqrecv.connect(self._req_recieved)
         self.state.onreqacpt.connect(self._req_accepted)
+        self.state.onstream.connect(self._stream_recieved)
         self.mdns.register_service(self.peer.username, self.receiver.addr[1], [
             inet_aton(self.receiver.addr[0])])
 
+        self.mdns.directory.onadd.connect(self._new_local_service)
+        self.mdns.directory.onremove.connect(self._remove_local_service)
+        self.mdns.rooms.onadd.connect(self._new_local_room)
+        self.mdns.rooms.onremove.connect(self._remove_local_room)
         self.mdns.service_listener()
-        self.mdns.listener.onadd.connect(self._new_local_service)
-        self.mdns.listener.onremove.connect(self._remove_local_service)
-
-    def _req_recieved(self, data):
-        self.recv_reqs.append(data)
-        self.onreqrecv.emit(data['name'], data['ip'], data['port'])
-
-    def _req_accepted(self, data):
-        for req in self.sent_reqs:
-            if req['ip'] == data['ip']:
-                self.receiver.disconnect_except(data['sock'])
-                self.onreqacpt.emit(data['name'], data['ip'], data['port'])
-                self.connection = req['sender']
-                self._secure_connection(True)
 
-    def _read_text(self, data):
-        self.ontext.emit(data['text'], data['time'])
-
-    def _read_file(self, data, finished):
+    def _req_recieved(self, data, sock):
+        req = {'name': data.name, 'uuid': data.uuid, 'ip': data.ip, 'port': data.port,
+               'codecs': data.codecs, 'handshake': data.handshake, 'sock': sock,
+               'proto': None, 'key': None, 'room': data.room}
+        if data.handshake == 'IK' and data.payload:
+            # The request already carries the first IK message. If it reads,
+            # the peer proved it holds its static key, and a trusted peer is
+            # let in without asking. If not, the key we have for ourselves on
+            # their side is stale and the accept falls back to XX.
+            proto = noise('IK', self.peer.priv_key)
+            proto.set_as_responder()
+            proto.start_handshake()
+            try:
+                req['key'] = read_handshake(proto, data.payload)
+                req['proto'] = proto
+            except HANDSHAKE_ERRORS as e:
+                exception(f"IK handshake from {data.name} failed, falling back to XX.")
+        # A peer asking again replaces its earlier request.
+        self.recv_reqs[data.uuid] = req
+        if data.room:
+            # Rooms are open to anyone on the network through their host,
+            # members take links from whoever the host lists. A request
+            # that comes before the host's list waits for it.
+            room = self.rooms.get(data.room)
+            if room and (room.host == self.peer.get_uuid() or room.member(data.uuid)):
+                self.accept_req(data.uuid)
+        elif req['proto'] and self.known.trusted(data.uuid, req['key']):
+            self.accept_req(data.uuid)
+        else:
+            self.onreqrecv.emit(data.uuid, data.name, data.ip, data.port)
+
+    def _req_accepted(self, data, sock):
+        # Found by the socket it came back on, the address the peer
+        # advertises may not be the one it was dialed at.
+        addr = next((addr for addr, (sender, _, _) in self.sent_reqs.items() if sender is sock),
+                    None)
+        sender, proto, room = self.sent_reqs.pop(addr, (None, None, ''))
+        if room and self.sessions.get(data.uuid):
+            warning(f'Refused a link for room {room} from {data.name}, '
+                    'a session with that uuid is open.')
+            sock.shutdown()
+            return
+        if sender is sock:
+            session = Session(data.uuid, data.name, (data.ip, data.port), sender)
+            session.room = room
+            self._negotiate(session, data.codecs)
+            self._open_session(session, sock)
+            if not room:
+                self.onreqacpt.emit(session.uuid, data.name, data.ip, data.port)
+            if data.handshake == 'IK' and proto:
+                # The accept carries the last IK message, one round trip in all.
+                session.proto = proto
+                try:
+                    proto.read_message(data.payload)
+                except HANDSHAKE_ERRORS as e:
+                    exception('Handshake failed.')
+                    self._connection_shutdown(session)
+                    return
+                session.remote_key = self.known.key(data.uuid)
+                self.__set_chat_state(session)
+            else:
+                self._secure_connection(session, True, data.handshake or 'NN')
+
+    def _open_stream(self, session, transfer, key):
+        # Runs on the session's send queue. The stream is a connection of its
+        # own, never watched by the reciever since only chunks go out on it.
+        sender = Sender(*session.addr).connect()
+        if not sender:
+            return None
+        proto = noise(STREAM_PATTERN, psk=key)
+        proto.set_as_initiator()
+        proto.start_handshake()
+        try:
+            sender.send_frame(JsonCodec().encode(Stream(transfer, proto.write_message())))
+            proto.read_message(decode(sender.recv_frame(HANDSHAKE_TIMEOUT)).payload)
+        except (OSError, CodecError, AttributeError, *HANDSHAKE_ERRORS):
+            exception(f'Stream handshake for {transfer} failed.')
+            sender.close()
+            return None
+        return proto, sender
+
+    def _stream_recieved(self, data, sock):
+        session = next((session for session in self.sessions
+                        if isinstance(session.state, ChatReciver)
+                        and data.transfer in session.state.keys), None)
+        if session is None:
+            sock.shutdown()
+            return
+        state = session.state
+        proto = noise(STREAM_PATTERN, psk=state.keys[data.transfer])
+        proto.set_as_responder()
+        proto.start_handshake()
+        try:
+            proto.read_message(data.payload)
+        except HANDSHAKE_ERRORS as e:
+            exception(f'Stream handshake for {data.transfer} failed.')
+            sock.shutdown()
+            return
+        sock.send_data(JsonCodec().encode(Stream(data.transfer, proto.write_message())))
+        state.attach(sock, data.transfer, proto)
+        self.sessions.attach(sock, session)
+
+    def _read_text(self, session, data):
+        self.history.record(session.uuid, TEXT, data.text, when=data.time)
+        self.ontext.emit(session.uuid, data.text, data.time)
+
+    def _read_file(self, session, data, finished):
         if finished and data is None:
-            self.onfilefinished.emit()
+            FILES_RECIEVED.inc()
+            self.history.record(session.uuid, FILE_RECIEVED, '')
+            self.onfilefinished.emit(session.uuid)
         else:
-            self.onfile.emit(data['filename'], data['time'])
+            self.history.record(session.uuid, FILE, data.filename, when=data.time)
+            self.onfile.emit(session.uuid, data.filename, data.time)
+
+    def _file_sent(self, uuid, filepath):
+        self.history.record(uuid, FILE_SENT, filepath, outgoing=True)
+        self.onfilesent.emit(uuid, filepath)
+
+    def _send_error(self, uuid, error):
+        self.history.record(uuid, FILE_FAILED, error, outgoing=True)
+        self.onsenderror.emit(uuid, error)
+
+    def _room_message(self, session, data):
+        room = self.rooms.get(data.room)
+        me = self.peer.get_uuid()
+        if isinstance(data, Members):
+            if self._joining.get(data.room) == session.addr:
+                del self._joining[data.room]
+                room = self.rooms[data.room] = Room(data.room, session.uuid)
+            if room is None or room.host != session.uuid:
+                return
+            room.fanout, room.members = data.fanout, data.members
+            if not room.member(me):
+                del self.rooms[data.room]
+                self.onroomclosed.emit(data.room)
+                return
+            self._link(room)
+            self.onroom.emit(room.name, room.members)
+            if self.linked(room.name):
+                self.onroomlinked.emit(room.name)
+        elif room and room.host == me:
+            if isinstance(data, Leave):
+                changed = room.remove(session.uuid)
+            else:
+                changed = room.add(session.uuid, session.name, *session.addr)
+            if changed:
+                self._announce(room)
+
+    def _announce(self, room):
+        self._tell_members(room, Members(room.name, room.members, room.fanout))
+        self.onroom.emit(room.name, room.members)
+
+    def _tell_members(self, room, message):
+        # The host has a session with everyone in the room.
+        me = self.peer.get_uuid()
+        sessions = (self.sessions.get(uuid) for uuid in room.uuids if uuid != me)
+        self._fanout.send(message, [session for session in sessions if session])
+
+    def _link(self, room):
+        # Runs on the network thread, which must not wait for connections,
+        # so the links are dialed from a thread of their own.
+        addrs = [(ip, port) for uuid, name, ip, port in room.dials(self.peer.get_uuid())
+                 if not self.sessions.get(uuid)]
+        addrs = [addr for addr in addrs if addr not in self.sent_reqs and addr not in self._dialing]
+        if addrs:
+            self._dialing.update(addrs)
+            Thread(target=self._dial_links, args=(room.name, addrs), name='room-links',
+                   daemon=True).start()
+        for uuid, req in list(self.recv_reqs.items()):
+            if req['room'] == room.name and room.member(uuid):
+                self.accept_req(uuid)
+
+    def _dial_links(self, name, addrs):
+        for addr in addrs:
+            self.send_req(*addr, name)
+            self._dialing.discard(addr)
+
+    def _left_rooms(self, session):
+        me = self.peer.get_uuid()
+        for room in list(self.rooms.values()):
+            if room.host == me and room.remove(session.uuid):
+                self._announce(room)
+            elif room.host == session.uuid:
+                self.rooms.pop(room.name, None)
+                self.onroomclosed.emit(room.name)
+
+    def _read_post(self, session, data):
+        room = self.rooms.get(data.room)
+        if room is None or not room.member(session.uuid) or room.seen(data.id):
+            return
+        if room.fanout:
+            # Every link but the one it came over gets a copy, along the tree
+            # that reaches each member once.
+            self._fan_out(room, data, (session.uuid, data.origin))
+        member = room.member(data.origin)
+        name = member[1] if member else data.origin
+        self.history.record(ROOM_PREFIX + room.name, TEXT, f'{name}: {data.text}', when=data.time)
+        self.onroomtext.emit(room.name, data.origin, data.text, data.time)
+
+    def _fan_out(self, room, message, skip=()) -> int:
+        sessions = []
+        for uuid in room.links(self.peer.get_uuid()):
+            session = self.sessions.get(uuid)
+            if uuid in skip:
+                continue
+            if session and session.outbox:
+                sessions.append(session)
+            else:
+                room.hold(uuid, message)
+        return self._fanout.send(message, sessions)
+
+    def _reply(self, session, data):
+        session.outbox.send_data(session.codec.encode(data))
+
+    def _resume(self, session, data):
+        session.outbox.resume(data.transfer, data.ranges, data.key, data.chunks, data.error)
 
     def set_username(self, username) -> bool:
+        if self.mdns is None:
+            from peerlink.mdns import MultiDNS
+            self.mdns = MultiDNS()
         if not self.mdns.service_exists(username):
             self.receiver.start()
-            self.peer = Peer(username)
+            self.peer = Peer.load(username, self.home)
+            self.known = KnownPeers(join(self.home, username, KNOWN_PEERS))
+            self.history = History(join(self.home, username, HISTORY_DB))
+            self.history.start()
+            if self.dedup:
+                self.chunks = ChunkStore(join(self.home, username, CHUNK_DB), self.store_limit)
+                self.chunks.start()
             self._set_request_state()
             return True
         else:
@@ -208,58 +743,265 @@ class Model:
 
     def _new_local_service(self, servicename: str, addresses, port):
         if not servicename == self.mdns.service_info.name.split('.')[0]:
-            self.local_devices.append({'name': servicename,
-                                       'ip': inet_ntoa(addresses[0]),
-                                       'port': port})
+            self.local_devices[servicename] = {'name': servicename,
+                                               'ip': inet_ntoa(addresses[0]),
+                                               'port': port}
             self.ondevicediscovery.emit(
                 servicename, inet_ntoa(addresses[0]), port)
 
     def _remove_local_service(self, servicename):
-        for device in self.local_devices:
-            if device['name'] == servicename:
-                self.local_devices.remove(device)
-                self.ondeviceloss.emit()
-
-    def send_req(self, host, port):
-        obj = Sender.send_query(host, port, MsgFormat.query_req(
-            self.peer.username, self.peer.get_uuid(), *self.receiver.addr).pack())
-        self.sent_reqs.append({'ip': host, 'port': port, 'sender': obj})
-
-
-    def accept_req(self, host, port):
-        for req in self.recv_reqs:
-            if req['port'] == port:
-                self.connection = Sender.send_query(host, port,
-                                                    MsgFormat.query_acpt(self.peer.username,
-                                                                         self.peer.get_uuid(),
-                                                                         *self.receiver.addr).pack())
-                self.receiver.disconnect_except(req['sock'])
-                self._secure_connection()
-                self.onreqacpt.emit(req['name'], req['ip'], req['port'])
-
-    def send_msg(self, text):
-        self.connection.send_data(
-            self.proto.encrypt(MsgFormat.text(text).pack())
-            )
-
-    def send_file(self, path):
-        self.connection.send_data(self.proto.encrypt(MsgFormat.file(path).pack()))
-        self.connection.send_file(path)
-
-    def disconnect(self):
-        if self.connection:
-            self.connection.send_data(
-                self.proto.encrypt(MsgFormat.query_shut().pack())
-                )
-            self.connection.shutdown()
-            self.receiver.ondata.disconnectall()
+        if self.local_devices.pop(servicename, None):
+            self.ondeviceloss.emit(servicename)
+
+    def _new_local_room(self, servicename: str, addresses, port):
+        self.local_rooms[servicename] = {'name': servicename, 'ip': inet_ntoa(addresses[0]),
+                                         'port': port}
+        self.onroomdiscovery.emit(servicename, inet_ntoa(addresses[0]), port)
+
+    def _remove_local_room(self, servicename):
+        if self.local_rooms.pop(servicename, None):
+            self.onroomloss.emit(servicename)
+
+    def _offer(self):
+        # Compression algorithms ride along in the codec list, peers that do
+        # not know them ignore the extra names.
+        offer = PREFERRED + (compression.PREFERRED if self.compress else [])
+        if self.dedup:
+            offer = offer + [DEDUP]
+        return offer
+
+    def _negotiate(self, session, offered):
+        session.codec = CODECS[negotiate(offered)]()
+        if self.compress:
+            session.compression = compression.negotiate(offered)
+        session.dedup = self.dedup and DEDUP in offered
+
+    def send_req(self, host, port, room=''):
+        sender = self.receiver.dial(host, port)
+        if sender:
+            # A peer we know gets the first IK message right away, anyone else
+            # is asked for XX once they accept.
+            uuid, known = self.known.by_addr(host, port)
+            proto, handshake, payload = None, 'XX', b''
+            if known:
+                proto = noise('IK', self.peer.priv_key, self.known.key(uuid))
+                proto.set_as_initiator()
+                proto.start_handshake()
+                handshake, payload = 'IK', proto.write_message()
+            # Recorded first, the accept can come back before send_data returns.
+            self.sent_reqs[(host, port)] = (sender, proto, room)
+            # The request is JSON since nothing is negotiated yet, it offers
+            # the codecs this node understands.
+            sender.send_data(JsonCodec().encode(Request(
+                self.peer.username, self.peer.get_uuid(), *self.receiver.addr, self._offer(),
+                handshake, payload, room)))
+
+    def reconnect(self, uuid) -> bool:
+        known = self.known.get(uuid)
+        if not known:
+            return False
+        self.send_req(known['ip'], known['port'])
+        return True
+
+    def accept_req(self, uuid) -> bool:
+        req = self.recv_reqs.pop(uuid, None)
+        if req is None:
+            return False
+        if req['room'] and self.sessions.get(uuid):
+            # The uuid in a request proves nothing, a room request must not
+            # take the place of a session that is already open.
+            warning(f"Refused a request for room {req['room']} from {req['name']}, "
+                    "a session with that uuid is open.")
+            req['sock'].shutdown()
+            return False
+        # The accept, the handshake and the chat all go back over the
+        # connection that carried the request. The session is bound
+        # before the accept goes out so the peer's first handshake
+        # message already finds it.
+        sender = req['sock']
+        session = Session(uuid, req['name'], (req['ip'], req['port']), sender)
+        session.room = req['room']
+        session.accepted = True
+        self._negotiate(session, req['codecs'])
+        self._open_session(session, req['sock'])
+        chosen = [session.codec.name]
+        if session.compression:
+            chosen.append(session.compression)
+        if session.dedup:
+            chosen.append(DEDUP)
+        handshake, payload = '', b''
+        if req['proto']:
+            session.proto = req['proto']
+            session.remote_key = req['key']
+            handshake, payload = 'IK', session.proto.write_message()
+        else:
+            # Peers from before static keys offer no handshake and
+            # stay on NN.
+            handshake = 'XX' if req['handshake'] else ''
+            self._secure_connection(session, pattern=handshake or 'NN')
+        accept = session.codec.encode(Accept(
+            self.peer.username, self.peer.get_uuid(), *self.receiver.addr, chosen,
+            handshake, payload))
+        if not req['proto']:
+            sender.send_data(accept)
+        if not session.room:
+            self.onreqacpt.emit(session.uuid, req['name'], req['ip'], req['port'])
+        if req['proto']:
+            self.__set_chat_state(session, accept)
+        return True
+
+    def send_msg(self, text, uuid=None) -> bool:
+        session = self.sessions.get(uuid or self.active)
+        # Nothing goes out before the handshake is done or after the session
+        # closed.
+        outbox = session.outbox if session else None
+        if outbox is None:
+            return False
+        data = Text(text)
+        if not outbox.send_data(session.codec.encode(data)):
+            return False
+        self.history.record(session.uuid, TEXT, text, outgoing=True, when=data.time)
+        return True
+
+    def send_file(self, path, uuid=None) -> bool:
+        if isdir(path):
+            return self.send_files([path], uuid)
+        session = self.sessions.get(uuid or self.active)
+        outbox = session.outbox if session else None
+        if outbox is None:
+            return False
+        header = FileHeader.from_path(path)
+        if not outbox.send_file(path, header.transfer, session.codec.encode(header)):
+            return False
+        self.history.record(session.uuid, FILE, path, outgoing=True, when=header.time)
+        return True
+
+    def send_files(self, paths, uuid=None) -> bool:
+        # Files and directories go out as one transfer, a manifest and then
+        # every file end to end, with a single round trip for all of them.
+        session = self.sessions.get(uuid or self.active)
+        outbox = session.outbox if session else None
+        if outbox is None:
+            return False
+        tree = Tree.from_paths(paths)
+        name = basename(abspath(paths[0]))
+        if len(paths) > 1:
+            name = f'{name} and {len(paths) - 1} more'
+        label = paths[0] if len(paths) == 1 else name
+        manifests = tree.manifests(name, tree.transfer_id())
+        headers = [session.codec.encode(manifest) for manifest in manifests]
+        if not outbox.send_tree(label, manifests[0].transfer, headers, tree):
+            return False
+        self.history.record(session.uuid, FILE, label, outgoing=True, when=manifests[0].time)
+        return True
+
+    def create_room(self, name, fanout=0) -> bool:
+        # Hosts a room advertised over mDNS. With a fanout posts travel along
+        # a tree and no member sends more than fanout + 1 copies of one.
+        if name in self.rooms or self.mdns.room_exists(name):
+            return False
+        me = self.peer.get_uuid()
+        room = self.rooms[name] = Room(name, me, fanout,
+                                       [[me, self.peer.username, *self.receiver.addr]])
+        self.mdns.register_room(name, self.receiver.addr[1], [inet_aton(self.receiver.addr[0])])
+        self.onroom.emit(name, room.members)
+        return True
+
+    def join_room(self, name, host=None, port=None) -> bool:
+        # host and port of the room's host, looked up over mDNS by default.
+        if host is None:
+            found = self.local_rooms.get(name)
+            if not found:
+                return False
+            host, port = found['ip'], found['port']
+        if name in self.rooms:
+            return False
+        self._joining[name] = (host, port)
+        session = next((session for session in self.sessions
+                        if session.addr == (host, port) and session.outbox), None)
+        if session:
+            session.outbox.send_data(session.codec.encode(Join(name)))
+        else:
+            self.send_req(host, port, name)
+        return True
+
+    def leave_room(self, name):
+        self._joining.pop(name, None)
+        room = self.rooms.pop(name, None)
+        if room is None:
+            return
+        if room.host == self.peer.get_uuid():
+            self.mdns.unregister_room(name)
+            # An empty list closes the room for everyone.
+            self._tell_members(room, Members(name, [], room.fanout))
+        else:
+            host = self.sessions.get(room.host)
+            if host and host.outbox:
+                host.outbox.send_data(host.codec.encode(Leave(name)))
+        # Sessions opened for the room go with it, unless another room
+        # still needs them.
+        needed = {uuid for room in self.rooms.values() for uuid in room.uuids}
+        for session in self.sessions:
+            if session.room == name and session.uuid not in needed:
+                self.disconnect(session.uuid)
+
+    def linked(self, name) -> bool:
+        # True once this node has a session with each member it sends to.
+        room = self.rooms.get(name)
+        if room is None:
+            return False
+        sessions = (self.sessions.get(uuid) for uuid in room.links(self.peer.get_uuid()))
+        return all(session and session.outbox for session in sessions)
+
+    def send_room(self, name, text) -> bool:
+        # Encoded and compressed once, encrypted for each member, and queued
+        # without waiting on any of them.
+        room = self.rooms.get(name)
+        if room is None:
+            return False
+        post = room.new_post(self.peer.get_uuid(), text)
+        self._fan_out(room, post)
+        self.history.record(ROOM_PREFIX + name, TEXT, text, outgoing=True, when=post.time)
+        return True
+
+    def search_history(self, query, uuid=None):
+        # Messages with every word of query, with a uuid only that peer's.
+        return self.history.search(query, uuid)
+
+    def disconnect(self, uuid=None):
+        session = self.sessions.get(uuid or self.active)
+        if session:
+            # Shut goes out after the files still being sent, not ahead of them.
+            self._close_session(session, Shut())
+            self._left_rooms(session)
 
     def disconnect_n_return(self):
         self.disconnect()
-        self.connection = None
-        self._set_request_state()
+        self.active = None
 
-    def shutdown(self):
-        self.disconnect()
-        self.mdns.shutdown()
+    def metrics(self, uuid=None) -> dict:
+        # Metrics are process wide, with a uuid only that session's series.
+        if uuid:
+            return REGISTRY.snapshot(session=uuid)
+        return REGISTRY.snapshot()
+
+    def export_metrics(self, path, interval=EXPORT_INTERVAL, format=None):
+        if self.exporter:
+            self.exporter.stop()
+        self.exporter = Exporter(REGISTRY, path, interval, format)
+        self.exporter.start()
 
+    def shutdown(self):
+        for session in self.sessions:
+            self.disconnect(session.uuid)
+        if self.exporter:
+            self.exporter.stop()
+        if self.history:
+            self.history.close()
+            self.history = None
+        if self.chunks:
+            self.chunks.close()
+            self.chunks = None
+        if self.mdns:
+            self.mdns.shutdown()
+            self.mdns = None
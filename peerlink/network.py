@@ -1,51 +1,247 @@
+import os
 import selectors
 import socket
-from logging import exception
-from threading import Thread
+import struct
+from functools import lru_cache, partial
+from heapq import heappop, heappush
+from itertools import count
+from logging import debug, exception
+from threading import Lock, Thread
+from time import monotonic
 
+from peerlink.metrics import REGISTRY
+from peerlink.transfer import FileStreamer
 from peerlink.utils import Signal
 
-LOCAL_IP = socket.gethostbyname_ex(socket.getfqdn())[2][0]
+# Every payload on the wire is prefixed with its length as an unsigned
+# 32 bit big-endian integer.
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 256 * 1024
+FILE_CHUNK_SIZE = 64 * 1024
+CONNECT_TIMEOUT = 5.0
+SEND_TIMEOUT = 30.0
+# Members of a room all connect to its host at once, a short queue drops
+# their SYNs and each retry costs a second.
+BACKLOG = 100
+
+BYTES_IN = REGISTRY.counter("peerlink_bytes_in_total", "Bytes read from peer connections.")
+FRAMES_IN = REGISTRY.counter("peerlink_frames_in_total", "Frames read from peer connections.")
+BYTES_OUT = REGISTRY.counter("peerlink_bytes_out_total", "Bytes written to peer connections.")
+FRAMES_OUT = REGISTRY.counter("peerlink_frames_out_total", "Frames written to peer connections.")
+
+
+class FrameError(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def local_ip() -> str:
+    # The address of the interface that routes to the LAN. Connecting a UDP
+    # socket only picks a route, nothing is sent and no name is resolved, so
+    # this neither blocks on DNS nor lands on 127.0.1.1 from /etc/hosts.
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(("10.255.255.255", 1))
+        return probe.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+    finally:
+        probe.close()
+
+
+def pack_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    def __init__(self, size: int = RECV_SIZE) -> None:
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def recv_from(self, sock: socket.socket) -> int:
+        if self._end == len(self._buf):
+            self._compact()
+        nbytes = sock.recv_into(self._view[self._end:])
+        self._end += nbytes
+        return nbytes
+
+    def frames(self):
+        while self._end - self._start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buf, self._start)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Frame of {length} bytes exceeds limit.")
+            begin = self._start + FRAME_HEADER.size
+            end = begin + length
+            if end > self._end:
+                self._reserve(FRAME_HEADER.size + length)
+                break
+            frame = bytes(self._view[begin:end])
+            self._start = end
+            yield frame
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _compact(self):
+        pending = self._end - self._start
+        if self._start:
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+    def _reserve(self, size: int):
+        # Make room for a whole frame, growing the buffer only when a frame
+        # larger than the current capacity is announced.
+        if len(self._buf) - self._start >= size:
+            return
+        self._compact()
+        if len(self._buf) < size:
+            buf = bytearray(max(size, len(self._buf) * 2))
+            buf[:self._end] = self._view[:self._end]
+            self._view.release()
+            self._buf = buf
+            self._view = memoryview(buf)
 
 
 class Reciever(Thread):
-    def __init__(self, host: str = "", port: int = 8080, backlog: int = 0) -> None:
+    def __init__(self, host: str = "", port: int = 8080, backlog: int = BACKLOG) -> None:
         super().__init__(name="reciever", daemon=True)
         self.addr = (host, port)
         self.selector = selectors.DefaultSelector()
         self.socket = socket.socket()
-        self.clients = []
+        self.clients = {}
+        self.decoders = {}
+        self._paused = set()
         self._bind(host, port, backlog)
         self.onconnection = Signal("sock")
-        self.ondata = Signal("data","sock")
+        self.onframe = Signal("data","sock")
+        self.ondisconnect = Signal("sock")
+        self._timers = []
+        self._timer_ids = count()
+        self._timer_lock = Lock()
+        self._dial_lock = Lock()
+        self.pool = ConnectionPool()
+        # Other threads write a byte here to cut the select short.
+        self._woken, self._waker = socket.socketpair()
+        self._woken.setblocking(False)
+        self._waker.setblocking(False)
 
         self.socket.setblocking(False)
 
+    def dial(self, host, port):
+        # Dialed connections are read by this thread as well, so the peer
+        # answers on the same socket instead of dialing back.
+        with self._dial_lock:
+            client = self.pool.get(host, port)
+            if client and client.socket not in self.clients:
+                self._watch(client)
+            return client
+
+    def call_later(self, delay: float, callback):
+        # Callbacks run on the reciever thread, like every frame handler.
+        with self._timer_lock:
+            heappush(self._timers, (monotonic() + delay, next(self._timer_ids), callback))
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            # Woken up already.
+            pass
+
+    def pause(self, client):
+        # From a frame handler, the connection is not read again until
+        # resume. Frames already in its buffer are still handed out.
+        sock = client.socket
+        if sock in self.clients and sock not in self._paused:
+            self._paused.add(sock)
+            self.selector.unregister(sock)
+
+    def resume(self, client):
+        # Safe from any thread, it always runs after the matching pause.
+        self.call_later(0, partial(self._resume, client.socket))
+
+    def _resume(self, sock):
+        if sock in self._paused:
+            self._paused.discard(sock)
+            if sock in self.clients:
+                self.selector.register(sock, selectors.EVENT_READ, self._read)
+
+    def _run_timers(self) -> float:
+        while True:
+            with self._timer_lock:
+                if not self._timers:
+                    return 1.0
+                deadline, _, callback = self._timers[0]
+                if deadline > monotonic():
+                    return min(1.0, deadline - monotonic())
+                heappop(self._timers)
+            callback()
+
     def _accept(self, sock: socket.socket):
         conn, addr = sock.accept()
-        print(addr," Connected")
-        self.clients.append(conn)
-        conn.setblocking(False)
-        self.selector.register(conn, selectors.EVENT_READ, self._read)
+        debug("%s connected", addr)
+        self.onconnection.emit(self._watch(Sender.from_socket(conn)))
 
-        self.onconnection.emit(conn)
+    def _watch(self, client):
+        # Reads only happen once the selector reports data, the timeout
+        # bounds how long a writer waits on a peer that stopped reading.
+        client.socket.settimeout(SEND_TIMEOUT)
+        self.clients[client.socket] = client
+        self.decoders[client.socket] = FrameDecoder()
+        self.selector.register(client.socket, selectors.EVENT_READ, self._read)
+        return client
 
     def _read(self, sock):
+        decoder = self.decoders[sock]
         try:
-            data = sock.recv(1024)
-            print("Recieved ",data)
+            nbytes = decoder.recv_from(sock)
+        except (BlockingIOError, socket.timeout):
+            return
         except ConnectionResetError as e:
             exception('Connection closed by remote peer.')
-            self.selector.unregister(sock)
-            self.clients.remove(sock)
+            self._drop(sock)
             return
         except socket.error as e:
             exception('')
-        if data:
-            self.ondata.emit(data,sock)
-        else:
-            self.selector.unregister(sock)
-            self.clients.remove(sock)
+            self._drop(sock)
+            return
+        if not nbytes:
+            self._drop(sock)
+            return
+        debug("Recieved %d bytes", nbytes)
+        BYTES_IN.inc(nbytes)
+        try:
+            client = self.clients[sock]
+            for frame in decoder.frames():
+                FRAMES_IN.inc()
+                self.onframe.emit(frame, client)
+                if sock not in self.clients:
+                    # Dropped by whoever read the frame.
+                    break
+        except FrameError as e:
+            exception('Malformed frame, closing connection.')
+            self._drop(sock)
+        except Exception:
+            # Every connection shares this thread, only the one whose frame
+            # could not be handled goes.
+            exception('Failed to handle a frame, closing connection.')
+            self._drop(sock)
+
+    def drop(self, client):
+        # For a peer that sent garbage, only called from this thread.
+        self._drop(client.socket)
+
+    def _drop(self, sock):
+        client = self.clients.pop(sock, None)
+        if client:
+            if sock in self._paused:
+                self._paused.discard(sock)
+            else:
+                self.selector.unregister(sock)
+            self.decoders.pop(sock, None)
+            self.pool.release(client)
+            sock.close()
+            self.ondisconnect.emit(client)
 
     def _bind(self, host, port, backlog):
         try:
@@ -54,26 +250,36 @@ class Reciever(Thread):
         except socket.error as e:
             exception("Couldn't bind socket.")
 
-    def disconnect_except(self, sock):
-        for client in self.clients:
-            if sock != client:
-                self.selector.unregister(client)
+    def _wake(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
 
     def run(self):
         self.selector.register(self.socket, selectors.EVENT_READ, self._accept)
+        self.selector.register(self._woken, selectors.EVENT_READ, self._wake)
         while True:
-            for key, mask in self.selector.select(1.0):
+            for key, mask in self.selector.select(self._run_timers()):
                 callback = key.data
                 callback(key.fileobj)
 
 
 class Sender:
-    def __init__(self, host, port) -> None:
-        self.socket = socket.socket()
+    def __init__(self, host, port, sock: socket.socket = None) -> None:
+        self.socket = sock or socket.socket()
         self.onerror = Signal()
         if isinstance(host, bytes):
             host = socket.inet_ntoa(host)
         self.addr = (host, port)
+        self.closed = False
+        self._lock = Lock()
+
+    @classmethod
+    def from_socket(cls, sock: socket.socket):
+        return cls(*sock.getpeername()[:2], sock)
+
 
     def try_block(func):
         def wrapper(self, *args):
@@ -84,38 +290,99 @@ class Sender:
                 exception("")
         return wrapper
 
-    def connect(self):
+    def connect(self, timeout: float = CONNECT_TIMEOUT):
         try:
+            self.socket.settimeout(timeout)
             self.socket.connect(self.addr)
+            self.socket.settimeout(None)
             return self
         except ConnectionRefusedError as e:
             exception('Connection Refused')
             return False
-
-    @classmethod
-    def send_query(cls, host: str, port: int, payload: bytes):
-        tmp = cls(host, port)
-        try:
-            if tmp.connect():
-                tmp.socket.sendall(payload)
-                return tmp
+        except socket.timeout as e:
+            exception('Connection timed out')
             return False
 
-        except socket.error as e:
-            tmp.onerror.emit()
-            raise
-
     @try_block
     def send_data(self, data: bytes):
-        self.socket.sendall(data)
+        self.send_frame(data)
         pass
 
+    def send_frame(self, data: bytes):
+        # Several threads write to one connection, frames must not interleave.
+        frame = pack_frame(data)
+        with self._lock:
+            self.socket.sendall(frame)
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(frame))
+
     @try_block
-    def send_file(self, filepath):
+    def send_file(self, filepath, proto=None):
+        if proto:
+            FileStreamer(filepath, proto, self.send_frame).run()
+            return
+        # Without a session the file goes out as a run of plaintext frames and
+        # the payload of each frame is still handed to the kernel with sendfile.
         with open(filepath, "rb") as file:
-            self.socket.sendfile(file)
+            size = os.fstat(file.fileno()).st_size
+            offset = 0
+            while offset < size:
+                length = min(FILE_CHUNK_SIZE, size - offset)
+                with self._lock:
+                    self.socket.sendall(FRAME_HEADER.pack(length))
+                    self.socket.sendfile(file, offset, length)
+                FRAMES_OUT.inc()
+                BYTES_OUT.inc(FRAME_HEADER.size + length)
+                offset += length
         pass
 
-    @try_block
+    def recv_frame(self, timeout: float) -> bytes:
+        # Blocking read of one frame, for connections no reciever watches.
+        decoder = FrameDecoder()
+        self.socket.settimeout(timeout)
+        try:
+            while True:
+                for frame in decoder.frames():
+                    return frame
+                if not decoder.recv_from(self.socket):
+                    raise ConnectionResetError("Connection closed by remote peer.")
+        finally:
+            self.socket.settimeout(None)
+
+    def close(self):
+        self.shutdown()
+        self.socket.close()
+
     def shutdown(self):
-        self.socket.shutdown(1)
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            # The peer closed the connection first, nothing left to flush.
+            pass
+
+
+class ConnectionPool:
+    def __init__(self) -> None:
+        self._senders = {}
+        self._lock = Lock()
+
+    def get(self, host, port) -> Sender:
+        # One connection per peer address, reused until it is closed.
+        if isinstance(host, bytes):
+            host = socket.inet_ntoa(host)
+        with self._lock:
+            sender = self._senders.get((host, port))
+            if not sender or sender.closed:
+                sender = Sender(host, port).connect()
+                if sender:
+                    self._senders[(host, port)] = sender
+            return sender
+
+    def release(self, sender: Sender):
+        with self._lock:
+            if self._senders.get(sender.addr) is sender:
+                del self._senders[sender.addr]
+
+    def __len__(self):
+        return len(self._senders)
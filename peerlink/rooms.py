@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from logging import warning
+from os import urandom
+from threading import Lock
+
+from peerlink.codec import CODECS, Post
+from peerlink.compression import COMPRESSIONS, CompressedStream
+from peerlink.metrics import REGISTRY
+
+# History keeps room posts under the room name with this in front, apart
+# from the uuids of peers.
+ROOM_PREFIX = "#"
+# Ids of the posts seen last, a relayed post that comes around again while
+# the tree is being rebuilt is dropped.
+SEEN_POSTS = 4096
+POST_ID_SIZE = 8
+# Posts kept for a link that is still connecting, per member.
+HELD_POSTS = 256
+
+FANOUT_COPIES = REGISTRY.counter("peerlink_room_copies_total",
+                                 "Copies of room posts queued for members.")
+FANOUT_DROPPED = REGISTRY.counter("peerlink_room_dropped_total",
+                                  "Copies of room posts dropped because a member's queue was full.")
+
+
+class Room:
+    # A group room as every member sees it. members are [uuid, name, ip,
+    # port] in join order, the host first. Who sends to whom follows from
+    # that order alone, so all members agree on it without talking: with
+    # no fanout everyone sends to everyone, with one the members form a
+    # tree of fanout children per node, posts are relayed along its edges
+    # and no member sends more than fanout + 1 copies of any post.
+    def __init__(self, name: str, host: str, fanout: int = 0, members=None) -> None:
+        self.name = name
+        self.host = host
+        self.fanout = fanout
+        self.members = members or []
+        self._seen = OrderedDict()
+        self._held = {}
+        self._lock = Lock()
+
+    @property
+    def uuids(self):
+        return [member[0] for member in self.members]
+
+    def member(self, uuid: str):
+        return next((member for member in self.members if member[0] == uuid), None)
+
+    def add(self, uuid: str, name: str, ip: str, port: int) -> bool:
+        if self.member(uuid):
+            return False
+        self.members.append([uuid, name, ip, port])
+        return True
+
+    def remove(self, uuid: str) -> bool:
+        # The last member takes the free place, so only its links change.
+        member = self.member(uuid)
+        if member is None:
+            return False
+        index = self.members.index(member)
+        last = self.members.pop()
+        if last is not member:
+            self.members[index] = last
+        return True
+
+    def links(self, uuid: str):
+        # The members uuid sends posts to and recieves them from.
+        uuids = self.uuids
+        if uuid not in uuids:
+            return []
+        if not self.fanout:
+            return [other for other in uuids if other != uuid]
+        index = uuids.index(uuid)
+        links = uuids[index * self.fanout + 1:(index + 1) * self.fanout + 1]
+        if index:
+            links.insert(0, uuids[(index - 1) // self.fanout])
+        return links
+
+    def dials(self, uuid: str):
+        # Of the links, the ones uuid connects to itself. Members joined
+        # later dial the ones before them, so every link is dialed once.
+        uuids = self.uuids
+        if uuid not in uuids:
+            return []
+        index = uuids.index(uuid)
+        return [self.member(other) for other in self.links(uuid) if uuids.index(other) < index]
+
+    def hold(self, uuid: str, post: Post):
+        # For a member that is linked but not connected yet, the oldest
+        # posts go first when it takes too long.
+        with self._lock:
+            held = self._held.setdefault(uuid, [])
+            held.append(post)
+            del held[:-HELD_POSTS]
+
+    def release(self, uuid: str):
+        with self._lock:
+            return self._held.pop(uuid, [])
+
+    def new_post(self, origin: str, text: str) -> Post:
+        post = Post(self.name, origin, urandom(POST_ID_SIZE).hex(), text)
+        self.seen(post.id)
+        return post
+
+    def seen(self, id: str) -> bool:
+        # True for a post seen before, remembers it otherwise.
+        with self._lock:
+            if id in self._seen:
+                return True
+            self._seen[id] = None
+            if len(self._seen) > SEEN_POSTS:
+                self._seen.popitem(last=False)
+            return False
+
+
+class FanOut:
+    # Writes one message to many sessions. It is encoded and compressed once
+    # per codec and compression in use among them, usually once, and only
+    # the encryption is left to each session's send queue. Queues never
+    # block, a member that does not keep up loses its copy and nobody else
+    # waits for it.
+    def __init__(self) -> None:
+        self._codecs = {}
+        self._streams = {}
+        self._lock = Lock()
+
+    def send(self, message, sessions) -> int:
+        groups = {}
+        for session in sessions:
+            if session.outbox:
+                groups.setdefault((session.codec.name, session.compression), []).append(session)
+        queued = 0
+        for (codec, compression), members in groups.items():
+            with self._lock:
+                payload = self._codec(codec).encode(message)
+                if compression:
+                    payload = self._stream(compression).pack(payload)
+            for session in members:
+                if session.outbox.send_packed(payload):
+                    queued += 1
+                else:
+                    FANOUT_DROPPED.inc()
+                    warning(f"Send queue of {session.name} is full, dropped a post for it")
+        FANOUT_COPIES.inc(queued)
+        return queued
+
+    def _codec(self, name: str):
+        if name not in self._codecs:
+            self._codecs[name] = CODECS[name]()
+        return self._codecs[name]
+
+    def _stream(self, name: str) -> CompressedStream:
+        if name not in self._streams:
+            self._streams[name] = CompressedStream(COMPRESSIONS[name](), {"session": "rooms"})
+        return self._streams[name]
@@ -0,0 +1,111 @@
+from time import perf_counter
+
+from peerlink.codec import JsonCodec
+from peerlink.metrics import REGISTRY
+from peerlink.network import Reciever, Sender
+from peerlink.utils import Signal
+
+
+class Session:
+    def __init__(self, uuid: str, name: str, addr, sender: Sender) -> None:
+        self.uuid = uuid
+        self.name = name
+        self.addr = addr
+        self.sender = sender
+        self.sock = None
+        self.proto = None
+        self.codec = JsonCodec()
+        self.compression = None
+        self.dedup = False
+        # Name of the group room the session was opened for, such sessions
+        # are not shown as chats.
+        self.room = ''
+        self.remote_key = None
+        # Set when this node accepted the peer's request, which is the user
+        # agreeing to whatever key it proves.
+        self.accepted = False
+        self.started = perf_counter()
+        self.state = None
+        self.outbox = None
+        self.onframe = Signal("data", "sock")
+        self.frames_in = REGISTRY.counter("peerlink_session_frames_in_total",
+                                          "Frames recieved per session.", session=uuid)
+        self.bytes_in = REGISTRY.counter("peerlink_session_bytes_in_total",
+                                         "Payload bytes recieved per session.", session=uuid)
+        self.decrypt_time = REGISTRY.histogram("peerlink_session_decrypt_seconds",
+                                               "Time to decrypt one frame.", session=uuid)
+
+
+class SessionManager:
+    def __init__(self, reciever: Reciever) -> None:
+        self.sessions = {}
+        self.names = {}
+        self._by_sock = {}
+        self._attached = set()
+        self._closed = set()
+        # Frames from sockets that are not bound to a session yet, these carry
+        # the request and accept queries.
+        self.onframe = Signal("data", "sock")
+        self.onclosed = Signal("session")
+        self._reciever = reciever
+        reciever.onframe.connect(self._route)
+        reciever.ondisconnect.connect(self._dropped)
+
+    def _route(self, data, sock):
+        session = self._by_sock.get(sock)
+        if session:
+            session.frames_in.inc()
+            session.bytes_in.inc(len(data))
+            session.onframe.emit(data, sock)
+        elif sock not in self._closed:
+            self.onframe.emit(data, sock)
+
+    def _dropped(self, sock):
+        self._closed.discard(sock)
+        if sock in self._attached:
+            # An extra stream ending leaves its session open.
+            self._attached.discard(sock)
+            self._by_sock.pop(sock, None)
+            return
+        session = self._by_sock.get(sock)
+        if session:
+            self.onclosed.emit(session)
+
+    def add(self, session: Session, sock) -> Session:
+        session.sock = sock
+        self.sessions[session.uuid] = session
+        self.names[session.uuid] = session.name
+        self._by_sock[sock] = session
+        return session
+
+    def drop(self, sock):
+        # Closes the connection without a word to the peer.
+        self._reciever.drop(sock)
+
+    def pause(self, sock):
+        self._reciever.pause(sock)
+
+    def resume(self, sock):
+        self._reciever.resume(sock)
+
+    def attach(self, sock, session: Session):
+        # Frames from an extra connection of the session go to it as well.
+        self._attached.add(sock)
+        self._by_sock[sock] = session
+
+    def remove(self, session: Session):
+        if self.sessions.get(session.uuid) is session:
+            del self.sessions[session.uuid]
+        # Whatever the peer still sends on a closed session is dropped until
+        # its socket goes away.
+        if self._by_sock.pop(session.sock, None):
+            self._closed.add(session.sock)
+
+    def get(self, uuid: str) -> Session:
+        return self.sessions.get(uuid)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,1236 @@
+import json
+import os
+import stat
+import struct
+from bisect import bisect_right
+from collections import deque
+from functools import partial
+from hashlib import sha1
+from itertools import accumulate
+from logging import error, exception, info
+from mimetypes import guess_type
+from os.path import (abspath, basename, dirname, exists, getsize, isdir, join, lexists, relpath,
+                     splitext)
+from queue import Empty, Full, Queue
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, perf_counter
+from zlib import crc32
+
+from noise.connection import NoiseConnection
+from peerlink.chunks import DEDUP_MIN_SIZE, chunk_lists, content_chunks, wanted_ranges
+from peerlink.codec import DIRECTORY, JsonCodec, Manifest
+from peerlink.compression import COMPRESSIONS, CompressedStream, compressible
+from peerlink.metrics import RATE_BUCKETS, REGISTRY, Histogram
+from peerlink.utils import CHUNK_SIZE, Signal, transfer_id
+
+NOISE_MAX_MESSAGE = 65535
+TAG_SIZE = 16
+PIPELINE_DEPTH = 8
+# Encrypted frames a session may have waiting for its socket. Two keep the
+# socket busy while the next frame is encrypted without holding up messages.
+FRAMES_AHEAD = 2
+SEND_QUEUE_SIZE = 256
+PROGRESS_INTERVAL = 0.1
+WRITE_QUEUE_SIZE = 64
+WRITE_BATCH = 32
+# Files from this size on may be sent over several connections. They are cut
+# into slices of SLICE_CHUNKS chunks, and every ADAPT_INTERVAL another stream
+# is opened for as long as the last one added ADAPT_GAIN to the throughput.
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+SLICE_CHUNKS = 64
+ADAPT_INTERVAL = 0.5
+ADAPT_GAIN = 0.1
+# Path bytes per manifest message, well below the Noise message limit even
+# once JSON escapes them.
+MANIFEST_BYTES = 16 * 1024
+# Files of a recieved tree kept open between writes.
+OPEN_FILES = 64
+# File frames a transfer may have waiting for the session's scheduler before
+# its reader stops, and the bytes it may send per turn when several share
+# the connection.
+CHANNEL_WINDOW = 1024 * 1024
+QUANTUM = CHUNK_SIZE
+# Transfers the sender still answers once they were resumed, for chunks that
+# arrived damaged, and how often the reciever asks for one chunk.
+RESENDABLE = 64
+MAX_RETRIES = 3
+
+# A file chunk is a tag byte, the 8 byte transfer id, the offset of the chunk
+# in the file and a crc32 of its payload. JSON messages always start with "{"
+# so the tag keeps both kinds of frame apart.
+FILE_CHUNK = b"\x01"
+CHUNK_HEADER = struct.Struct("!c8sQI")
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".peerlink"
+
+_DONE = object()
+# Writers still flushing a suspended file, by its part path.
+_suspended = {}
+
+
+def chunk_ranges(size: int):
+    return [[0, size]] if size else []
+
+
+def split_ranges(ranges, size: int, whole: bool = False):
+    # Slices are lists of ranges about size bytes long. Ranges are cut on a
+    # chunk boundary so the reciever sees the same chunks whichever stream
+    # carries them, whole ranges are single chunks already and only grouped.
+    slices = []
+    if whole:
+        for start, end in ranges:
+            if not slices or sum(e - s for s, e in slices[-1]) >= size:
+                slices.append([])
+            slices[-1].append([start, end])
+        return slices
+    for start, end in ranges:
+        while start < end:
+            cut = min(end, (start // size + 1) * size)
+            slices.append([[start, cut]])
+            start = cut
+    return slices
+
+
+class Tree:
+    # The files of a manifest laid end to end as one stream, in manifest
+    # order. Directories take no room in it. paths are where the files are
+    # on this side, the sender's sources or the reciever's staging copies.
+    def __init__(self, entries, paths, stamps=None) -> None:
+        self.entries = entries
+        self.paths = paths
+        self.stamps = stamps
+        self.starts = list(accumulate((size for _, size, _ in entries if size != DIRECTORY),
+                                      initial=0))
+        self.size = self.starts[-1]
+
+    @classmethod
+    def from_paths(cls, paths) -> "Tree":
+        # Every path lands in the reciever's downloads under its own name,
+        # directories with everything below them.
+        entries, sources, stamps = [], [], []
+        for path in map(abspath, paths):
+            base = dirname(path)
+            if not isdir(path):
+                status = os.stat(path)
+                entries.append([basename(path), status.st_size, stat.S_IMODE(status.st_mode)])
+                sources.append(path)
+                stamps.append(status.st_mtime_ns)
+                continue
+            for top, dirs, files in os.walk(path):
+                dirs.sort()
+                prefix = _posix(relpath(top, base))
+                entries.append([prefix, DIRECTORY, _mode(top)])
+                for name in sorted(files):
+                    source = join(top, name)
+                    status = os.stat(source)
+                    if stat.S_ISREG(status.st_mode):
+                        entries.append([f"{prefix}/{name}", status.st_size,
+                                        stat.S_IMODE(status.st_mode)])
+                        sources.append(source)
+                        stamps.append(status.st_mtime_ns)
+        return cls(entries, sources, stamps)
+
+    @classmethod
+    def staged(cls, entries, root: str) -> "Tree":
+        # Paths come from the peer, anything that could leave root is refused.
+        for path, _, _ in entries:
+            parts = path.split("/")
+            if (path.startswith("/") or "\\" in path or ":" in parts[0]
+                    or any(part in ("", ".", "..") for part in parts)):
+                raise ValueError(f"Unsafe path in manifest - {path!r}")
+        return cls(entries, [join(root, *path.split("/")) for path, size, _ in entries
+                             if size != DIRECTORY])
+
+    def transfer_id(self) -> str:
+        # Stable for as long as no file in the tree changes.
+        key = sha1()
+        for (path, size, _), stamp in zip(self.files(), self.stamps):
+            key.update(f"{path}:{size}:{stamp}\n".encode("utf-8"))
+        for path, size, _ in self.entries:
+            if size == DIRECTORY:
+                key.update(f"{path}/\n".encode("utf-8"))
+        return key.hexdigest()[:16]
+
+    def files(self):
+        return [entry for entry in self.entries if entry[1] != DIRECTORY]
+
+    def manifests(self, filename: str, transfer: str, chunk: int = CHUNK_SIZE):
+        batches, batch, used = [], [], 0
+        for entry in self.entries:
+            length = len(entry[0].encode("utf-8")) + 32
+            if batch and used + length > MANIFEST_BYTES:
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(entry)
+            used += length
+        batches.append(batch)
+        return [Manifest(filename, chunk, transfer, batch, index == len(batches) - 1)
+                for index, batch in enumerate(batches)]
+
+    def segments(self, offset: int, length: int):
+        # (file index, offset in that file, length) for a span of the stream.
+        index = bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.paths):
+            count = min(length, self.starts[index + 1] - offset)
+            if count > 0:
+                yield index, offset - self.starts[index], count
+                offset += count
+                length -= count
+            index += 1
+
+    def open(self) -> "TreeReader":
+        return TreeReader(self)
+
+
+class TreeReader:
+    # File-like reads over a Tree, one file open at a time.
+    def __init__(self, tree: Tree) -> None:
+        self._tree = tree
+        self._offset = 0
+        self._index = None
+        self._file = None
+
+    def seek(self, offset: int):
+        self._offset = offset
+
+    def read(self, size: int) -> bytes:
+        parts = []
+        for index, offset, count in self._tree.segments(self._offset, size):
+            if index != self._index:
+                self.close()
+                self._file = open(self._tree.paths[index], "rb", buffering=0)
+                self._index = index
+            self._file.seek(offset)
+            parts.append(self._file.read(count))
+        data = b"".join(parts)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileStreamer:
+    # reader opens the source, a plain file at filepath unless given.
+    def __init__(self, filepath: str, proto: NoiseConnection, send,
+                 chunk_size: int = CHUNK_SIZE, depth: int = PIPELINE_DEPTH,
+                 progress=None, transfer: str = None, ranges=None,
+                 encrypt_time: Histogram = None, pack=None, reader=None) -> None:
+        if chunk_size + CHUNK_HEADER.size + TAG_SIZE > NOISE_MAX_MESSAGE:
+            raise ValueError(f"Chunk size {chunk_size} exceeds noise message limit.")
+        self.filepath = filepath
+        self.proto = proto
+        self.chunk_size = chunk_size
+        self.transfer = bytes.fromhex(transfer or transfer_id(filepath))
+        self.ranges = chunk_ranges(getsize(filepath)) if ranges is None else ranges
+        self.sent = 0
+        self._send = send
+        self._progress = progress
+        self._encrypt_time = encrypt_time
+        self._pack = pack
+        self._reader = reader or partial(open, filepath, "rb")
+        self._plain = Queue(depth)
+        self._cipher = Queue(depth)
+        self._stop = Event()
+        self._error = None
+
+    def run(self) -> int:
+        # Disk reads, encryption and socket writes run as three stages joined
+        # by bounded queues, so each stage works while the others block.
+        # Without a proto there is nothing to encrypt, whoever send hands
+        # the chunks to does that, and they are sent as they are read.
+        if self.proto is None:
+            self._read(self._deliver)
+            return self.sent
+        stages = [Thread(target=self._guard, args=(self._read,), name="file-reader", daemon=True),
+                  Thread(target=self._guard, args=(self._encrypt,), name="file-encryptor", daemon=True)]
+        for stage in stages:
+            stage.start()
+        try:
+            while True:
+                item = self._cipher.get()
+                if item is _DONE:
+                    break
+                self._deliver(item)
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+        if self._error:
+            raise self._error
+        return self.sent
+
+    def _deliver(self, item):
+        if item is _DONE:
+            return
+        chunk, size = item
+        self._send(chunk)
+        self.sent += size
+        if self._progress:
+            self._progress(self.sent)
+
+    def _read(self, put=None):
+        put = put or self._plain.put
+        with self._reader() as file:
+            for start, end in self.ranges:
+                file.seek(start)
+                offset = start
+                while offset < end and not self._stop.is_set():
+                    data = file.read(min(self.chunk_size, end - offset))
+                    if not data:
+                        break
+                    chunk = CHUNK_HEADER.pack(FILE_CHUNK, self.transfer, offset, crc32(data)) + data
+                    # Compression runs here, before encryption, and only
+                    # keeps what it shrinks.
+                    if self._pack:
+                        chunk = self._pack(chunk)
+                    put((chunk, len(data)))
+                    offset += len(data)
+        put(_DONE)
+
+    def _encrypt(self):
+        while True:
+            item = self._plain.get()
+            if item is _DONE or self._stop.is_set():
+                break
+            chunk, size = item
+            start = perf_counter()
+            chunk = self.proto.encrypt(chunk)
+            if self._encrypt_time:
+                self._encrypt_time.observe(perf_counter() - start)
+            self._cipher.put((chunk, size))
+        self._cipher.put(_DONE)
+
+    def _guard(self, stage):
+        try:
+            stage()
+        except BaseException as e:
+            self._error = e
+            self._abort()
+
+    def _abort(self):
+        # Unblock every stage so the threads can be joined.
+        self._stop.set()
+        for queue in (self._plain, self._cipher):
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            queue.put_nowait(_DONE)
+
+
+class ParallelTransfer:
+    # Sends the ranges of one file over the session's connection and up to
+    # streams - 1 extra ones. Every stream has its own Noise session and its
+    # own reader and encryptor threads, and takes the next slice off a shared
+    # queue when it is done with one. A slice lost with its stream is sent
+    # again by another.
+    def __init__(self, filepath: str, transfer: str, ranges, streams: int, main, open_stream,
+                 chunk_size: int = CHUNK_SIZE, progress=None, encrypt_time: Histogram = None,
+                 compressor=None, reader=None, whole: bool = False) -> None:
+        self.filepath = filepath
+        self.transfer = transfer
+        self.streams = streams
+        self.opened = 1
+        self.sent = 0
+        self._main = main
+        self._open_stream = open_stream
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._encrypt_time = encrypt_time
+        self._compressor = compressor
+        self._reader = reader
+        self._slices = Queue()
+        for piece in split_ranges(ranges, chunk_size * SLICE_CHUNKS, whole):
+            self._slices.put(piece)
+        self._lock = Lock()
+        self._error = None
+
+    def run(self) -> int:
+        workers = [self._start(*self._main)]
+        last, last_sent, last_rate = monotonic(), 0, None
+        adapting = True
+        while True:
+            alive = [worker for worker in workers if worker.is_alive()]
+            if not alive:
+                break
+            alive[0].join(max(0.0, last + ADAPT_INTERVAL - monotonic()))
+            now = monotonic()
+            if now - last < ADAPT_INTERVAL:
+                continue
+            rate = (self.sent - last_sent) / max(now - last, 1e-6)
+            last, last_sent = now, self.sent
+            if not adapting or self._slices.empty():
+                continue
+            if self.opened >= self.streams or (last_rate is not None
+                                               and rate < last_rate * (1 + ADAPT_GAIN)):
+                adapting = False
+                continue
+            stream = self._open_stream()
+            if stream is None:
+                adapting = False
+                continue
+            workers.append(self._start(*stream))
+            self.opened += 1
+            last_rate = rate
+        if not self._slices.empty() and self._error is None:
+            # Extra streams that failed last left their slices behind.
+            self._work(*self._main)
+        if self._error:
+            raise self._error
+        if not self._slices.empty():
+            raise ConnectionError(f"{self._slices.qsize()} slices of {self.filepath} were not sent.")
+        return self.sent
+
+    def _start(self, proto, send, close=None) -> Thread:
+        worker = Thread(target=self._work, args=(proto, send, close),
+                        name="file-stream", daemon=True)
+        worker.start()
+        return worker
+
+    def _work(self, proto, send, close=None):
+        compressor = self._compressor() if self._compressor else None
+        try:
+            while self._error is None:
+                try:
+                    piece = self._slices.get_nowait()
+                except Empty:
+                    break
+                counted = 0
+
+                def progress(sent):
+                    nonlocal counted
+                    self._add(sent - counted)
+                    counted = sent
+
+                try:
+                    FileStreamer(self.filepath, proto, send, self._chunk_size, progress=progress,
+                                 transfer=self.transfer, ranges=piece,
+                                 encrypt_time=self._encrypt_time,
+                                 pack=compressor.pack if compressor else None,
+                                 reader=self._reader).run()
+                except BaseException:
+                    self._slices.put(piece)
+                    raise
+        except Exception as e:
+            if close is None:
+                # The session's own connection failing ends the transfer.
+                self._error = e
+            else:
+                exception(f"Stream of {self.filepath} failed, its slice goes to another.")
+        finally:
+            if close:
+                close()
+
+    def _add(self, size: int):
+        with self._lock:
+            self.sent += size
+            sent = self.sent
+        if self._progress:
+            self._progress(sent)
+
+
+class ChannelClosed(ConnectionError):
+    pass
+
+
+class Channel:
+    # The frames of one transfer on their way to the session's scheduler.
+    # put() blocks once window bytes are waiting, so a transfer holds no
+    # more than that however slow the peer is. Callables given to call()
+    # run on the scheduler once the frames before them are sent.
+    def __init__(self, name: str, wake: Event, window: int = CHANNEL_WINDOW) -> None:
+        self.name = name
+        self.window = window
+        self.deficit = 0
+        self.cancelled = False
+        self._items = deque()
+        self._buffered = 0
+        self._finished = False
+        self._wake = wake
+        self._space = Condition()
+
+    @property
+    def done(self) -> bool:
+        with self._space:
+            return self._finished and not self._items
+
+    def put(self, frame: bytes):
+        with self._space:
+            self._space.wait_for(lambda: self._buffered < self.window or self.cancelled)
+            if self.cancelled:
+                raise ChannelClosed(f"Sending {self.name} was cancelled.")
+            self._items.append(frame)
+            self._buffered += len(frame)
+        self._wake.set()
+
+    def call(self, job):
+        with self._space:
+            if self.cancelled:
+                return
+            self._items.append(job)
+        self._wake.set()
+
+    def finish(self):
+        with self._space:
+            self._finished = True
+        self._wake.set()
+
+    def head(self):
+        with self._space:
+            return self._items[0] if self._items else None
+
+    def pop(self):
+        with self._space:
+            item = self._items.popleft()
+            if not callable(item):
+                self._buffered -= len(item)
+                self._space.notify()
+            return item
+
+    def cancel(self):
+        with self._space:
+            self.cancelled = True
+            self._items.clear()
+            self._buffered = 0
+            self._space.notify_all()
+
+
+class SendQueue(Thread):
+    # open_stream(transfer, key) connects another stream for a transfer the
+    # peer gave a key for, and returns its (proto, sender) or None. With
+    # dedup large files are offered as a list of content defined chunks,
+    # encoded with codec.
+    #
+    # The thread schedules everything sent on the session's connection.
+    # Queued messages and control jobs always go first. Files are read and
+    # compressed on threads of their own into a Channel each and take turns
+    # by bytes sent, so a message never waits for more than the frames being
+    # written and concurrent transfers share the link evenly. Every frame is
+    # encrypted here, in the order it goes out, and written by a thread of
+    # its own so the next one is encrypted while the socket is busy.
+    def __init__(self, sender, proto: NoiseConnection, maxsize: int = SEND_QUEUE_SIZE,
+                 labels: dict = None, compression: str = None, streams: int = 1,
+                 open_stream=None, codec=None, dedup: bool = False) -> None:
+        super().__init__(name="sender", daemon=True)
+        self.sender = sender
+        self.proto = proto
+        self.codec = codec or JsonCodec()
+        self.dedup = dedup
+        self.compression = compression
+        self.streams = streams
+        self.open_stream = open_stream
+        self.onprogress = Signal("sent", "total", "rate", "eta")
+        self.onfinished = Signal("filepath")
+        self.onerror = Signal("error")
+        self._jobs = Queue(maxsize)
+        self._channels = deque()
+        self._wake = Event()
+        self._offered = {}
+        self._resendable = {}
+        self._frames = Queue(FRAMES_AHEAD)
+        self._writer = Thread(target=self._write_frames, name="frame-writer", daemon=True)
+        self._write_error = None
+        self._labels = labels = labels or {}
+        self._stream = self._compressed_stream()
+        self._frames_out = REGISTRY.counter("peerlink_session_frames_out_total",
+                                            "Frames sent per session.", **labels)
+        self._bytes_out = REGISTRY.counter("peerlink_session_bytes_out_total",
+                                           "Encrypted bytes sent per session.", **labels)
+        self._encrypt_time = REGISTRY.histogram("peerlink_session_encrypt_seconds",
+                                                "Time to encrypt one frame.", **labels)
+        self._depth = REGISTRY.gauge("peerlink_send_queue_depth",
+                                     "Jobs waiting in the send queue.", **labels)
+        self._file_rate = REGISTRY.histogram("peerlink_file_send_rate_bytes",
+                                             "File transfer rate in bytes per second.",
+                                             RATE_BUCKETS, **labels)
+        self._file_streams = REGISTRY.gauge("peerlink_file_streams",
+                                            "Connections used by the last file sent.", **labels)
+
+    def send_data(self, payload: bytes) -> bool:
+        return self._put((self._write_data, payload))
+
+    def send_packed(self, payload: bytes) -> bool:
+        # For a payload already compressed for this session's compression,
+        # only the encryption is left to do.
+        return self._put((self._write_packed, payload))
+
+    def send_file(self, filepath: str, transfer: str, header: bytes) -> bool:
+        # Only the header goes out now, the chunks follow once the peer has
+        # answered with the ranges it is missing.
+        return self._put((self._write_offer, filepath, transfer, [header]))
+
+    def send_tree(self, label: str, transfer: str, headers, tree: Tree) -> bool:
+        # Same as a file, the manifest goes first and the files follow as one
+        # stream. label stands in for the path in progress and results.
+        return self._put((self._write_offer, label, transfer, headers, tree.open))
+
+    def resume(self, transfer: str, ranges, key: bytes = b"", chunks: bytes = b"",
+               refused: str = ""):
+        offer = self._offered.pop(transfer, None)
+        resend = offer is None
+        if resend:
+            # A second Resume asks for chunks that arrived damaged, each
+            # range is one chunk and goes out as it is.
+            offer = self._resendable.get(transfer)
+            if offer is None:
+                error(f"Resume for unknown transfer {transfer}")
+                return
+            key, chunks = b"", b""
+        elif not refused:
+            self._resendable[transfer] = offer
+            if len(self._resendable) > RESENDABLE:
+                del self._resendable[next(iter(self._resendable))]
+        filepath, reader, spans = offer
+        if refused:
+            self.onerror.emit(f"{basename(filepath)} was refused: {refused}")
+            return
+        whole = bool(spans and chunks)
+        if whole:
+            # Every wanted chunk goes out as one frame, cut where it was
+            # offered, so the reciever can match it to its digest.
+            ranges = wanted_ranges(spans, chunks)
+        if not self._put((self._write_file, filepath, transfer, ranges, key, reader, whole,
+                          resend)):
+            self.onerror.emit("Send queue is full, transfer dropped.")
+
+    def close(self, timeout: float = None, farewell=None):
+        # Whatever is already queued is flushed, files being sent included,
+        # before the thread exits. farewell is the message that goes last.
+        try:
+            self._jobs.put((None, farewell), timeout=timeout)
+        except Full:
+            return
+        self._wake.set()
+        # A session closed while it was being set up never started its queue.
+        if self.ident is not None:
+            self.join(timeout)
+
+    def _put(self, job) -> bool:
+        # Callers are usually on the GUI thread, so a full queue is reported
+        # instead of blocking until the peer catches up.
+        try:
+            self._jobs.put_nowait(job)
+        except Full:
+            return False
+        self._depth.set(self._jobs.qsize())
+        self._wake.set()
+        return True
+
+    def run(self):
+        self._writer.start()
+        try:
+            self._schedule()
+        finally:
+            self._frames.put(_DONE)
+            self._writer.join()
+
+    def _schedule(self):
+        closing = False
+        while not closing or self._channels:
+            # Cleared before looking, so whatever is queued from here on
+            # wakes the wait below.
+            self._wake.clear()
+            if self._jobs.empty():
+                if not self._next_frame():
+                    self._wake.wait()
+                continue
+            job, *args = self._jobs.get_nowait()
+            self._depth.set(self._jobs.qsize())
+            if job is None:
+                closing, farewell = True, args[0]
+                continue
+            self._run(job, *args)
+        if farewell is not None:
+            self._run(self._write_data, self.codec.encode(farewell))
+
+    def _run(self, job, *args):
+        try:
+            job(*args)
+        except Exception as e:
+            exception("Couldn't send queued data.")
+            self.onerror.emit(str(e))
+
+    def _next_frame(self) -> bool:
+        # Deficit round robin: a channel sends while its frames fit in the
+        # bytes it has been given, then the next one gets a turn. Returns
+        # False when there was nothing to do.
+        idle = 0
+        while idle < len(self._channels):
+            channel = self._channels[0]
+            item = channel.head()
+            if item is None:
+                if channel.done:
+                    self._channels.popleft()
+                    return True
+                # A channel with nothing waiting saves up no bytes for later.
+                channel.deficit = 0
+                self._channels.rotate(-1)
+                idle += 1
+                continue
+            idle = 0
+            if callable(item):
+                channel.pop()
+                try:
+                    item()
+                except Exception:
+                    exception(f"Couldn't finish sending {channel.name}")
+                return True
+            if len(item) > channel.deficit:
+                channel.deficit += QUANTUM
+                self._channels.rotate(-1)
+                continue
+            channel.deficit -= len(item)
+            channel.pop()
+            try:
+                self._write_packed(item)
+            except Exception as e:
+                exception(f"Couldn't send {channel.name}")
+                channel.cancel()
+                self._channels.remove(channel)
+                self.onerror.emit(str(e))
+            return True
+        return False
+
+    def _open_channel(self, name: str, target, *args) -> Channel:
+        # target(channel, *args) fills the channel on a thread of its own.
+        channel = Channel(name, self._wake)
+        self._channels.append(channel)
+        Thread(target=target, args=(channel, *args), name="file-channel", daemon=True).start()
+        return channel
+
+    def _write_data(self, payload: bytes):
+        if self._stream:
+            payload = self._stream.pack(payload)
+        self._write_packed(payload)
+
+    def _write_packed(self, payload: bytes):
+        # Encryption happens here so nonces follow the order on the wire.
+        # A connection that failed fails every frame after it.
+        if self._write_error:
+            raise self._write_error
+        start = perf_counter()
+        payload = self.proto.encrypt(payload)
+        self._encrypt_time.observe(perf_counter() - start)
+        self._frames.put(payload)
+
+    def _write_frames(self):
+        while (frame := self._frames.get()) is not _DONE:
+            if self._write_error:
+                continue
+            try:
+                self._send_frame(frame)
+            except Exception as e:
+                exception("Couldn't write to the session's connection.")
+                self._write_error = e
+
+    def _send_frame(self, data: bytes, sender=None):
+        (sender or self.sender).send_frame(data)
+        self._frames_out.inc()
+        self._bytes_out.inc(len(data))
+
+    def _write_offer(self, filepath: str, transfer: str, headers, reader=None):
+        if self.dedup and reader is None and getsize(filepath) >= DEDUP_MIN_SIZE:
+            # Cutting the file by content takes a while, messages keep going
+            # out meanwhile.
+            self._open_channel(filepath, self._fill_offer, filepath, transfer, headers)
+            return
+        self._offered[transfer] = (filepath, reader, None)
+        for header in headers:
+            self._write_data(header)
+
+    def _fill_offer(self, channel: Channel, filepath: str, transfer: str, headers):
+        stream = self._compressed_stream()
+        spans = []
+
+        def pack(payload):
+            return stream.pack(payload) if stream else payload
+
+        try:
+            start = monotonic()
+            # The lists go out while the rest of the file is still cut, the
+            # header follows the last one.
+            for message in chunk_lists(transfer, content_chunks(filepath), spans):
+                channel.put(pack(self.codec.encode(message)))
+            if spans:
+                info(f"Cut {filepath} into {len(spans)} chunks in {monotonic() - start:.2f}s")
+            self._offered[transfer] = (filepath, None, spans or None)
+            for header in headers:
+                channel.put(pack(header))
+        except Exception as e:
+            if not channel.cancelled:
+                exception(f"Couldn't offer {filepath}")
+                channel.call(partial(self.onerror.emit, str(e)))
+        finally:
+            channel.finish()
+
+    def _write_file(self, filepath: str, transfer: str, ranges, key: bytes = b"", reader=None,
+                    whole: bool = False, resend: bool = False):
+        self._open_channel(filepath, self._fill_file, filepath, transfer, ranges, key, reader,
+                           whole, resend)
+
+    def _fill_file(self, channel: Channel, filepath: str, transfer: str, ranges, key: bytes,
+                   reader, whole: bool, resend: bool):
+        total = sum(end - start for start, end in ranges)
+        start = last = monotonic()
+
+        def progress(sent):
+            nonlocal last
+            now = monotonic()
+            if now - last < PROGRESS_INTERVAL and sent < total:
+                return
+            last = now
+            rate = sent / max(now - start, 1e-6)
+            self.onprogress.emit(sent, total, rate, (total - sent) / rate if rate else 0.0)
+
+        # A tree mixes all kinds of files, compression backs off by itself
+        # on the parts that do not shrink.
+        packs = reader is not None or compressible(guess_type(filepath)[0])
+        try:
+            # Chunks for this connection go into the channel unencrypted,
+            # extra streams encrypt and send their own.
+            if key and self.streams > 1 and self.open_stream:
+                parallel = ParallelTransfer(
+                    filepath, transfer, ranges, self.streams, (None, channel.put),
+                    partial(self._open_stream, transfer, key), progress=progress,
+                    encrypt_time=self._encrypt_time,
+                    compressor=self._compressed_stream if packs else None, reader=reader,
+                    whole=whole)
+                sent = parallel.run()
+                self._file_streams.set(parallel.opened)
+                info(f"Sent {filepath} over {parallel.opened} streams")
+            else:
+                stream = self._compressed_stream() if packs else None
+                sent = FileStreamer(filepath, None, channel.put, progress=progress,
+                                    transfer=transfer, ranges=ranges,
+                                    pack=stream.pack if stream else None, reader=reader).run()
+                self._file_streams.set(1)
+                if stream:
+                    info(f"Sent {filepath} at compression ratio {stream.ratio:.2f}")
+        except Exception as e:
+            if not channel.cancelled:
+                exception(f"Couldn't send {filepath}")
+                channel.call(partial(self.onerror.emit, str(e)))
+        else:
+            if not resend:
+                channel.call(partial(self._file_sent, filepath, sent, start))
+        finally:
+            channel.finish()
+
+    def _file_sent(self, filepath: str, sent: int, start: float):
+        self._file_rate.observe(sent / max(monotonic() - start, 1e-6))
+        self.onfinished.emit(filepath)
+
+    def _open_stream(self, transfer: str, key: bytes):
+        try:
+            stream = self.open_stream(transfer, key)
+        except Exception:
+            exception(f"Couldn't open another stream for {transfer}")
+            return None
+        if stream is None:
+            return None
+        proto, sender = stream
+        return proto, partial(self._send_frame, sender=sender), sender.close
+
+    def _compressed_stream(self):
+        # Every stream gets its own compressor, they run on different threads.
+        if self.compression:
+            return CompressedStream(COMPRESSIONS[self.compression](), self._labels)
+        return None
+
+
+class IncomingFile:
+    # spans maps the offset of every chunk to its length when the sender cut
+    # the file by content, otherwise chunks are header.chunk long. refetch is
+    # called with the range of a chunk that arrived damaged.
+    def __init__(self, header, directory: str = ".", name: str = None, spans=None,
+                 refetch=None) -> None:
+        # Only the name is taken from the peer, never a path.
+        self.filepath = join(directory, name or basename(header.filename))
+        self.transfer = header.transfer
+        self.size = header.size
+        self.chunk = header.chunk
+        self._spans = spans
+        self._refetch = refetch
+        self._retries = {}
+        self._part_path = self.filepath + PART_SUFFIX
+        self._state_path = self.filepath + STATE_SUFFIX
+        self._verified = {}
+        self._received = 0
+        self._failed = False
+        self._closed = False
+        self._lock = Lock()
+        self._waiting = []
+
+        # A file resumed right after its session closed waits for the last
+        # chunks of the earlier attempt, at most a queue's worth.
+        previous = _suspended.pop(self._part_path, None)
+        if previous:
+            previous.join()
+        if self._load_state():
+            self._open_storage(resume=True)
+            self._verify()
+        else:
+            self._open_storage(resume=False)
+        # The sidecar is rewritten with the chunks that survived verification,
+        # then every chunk is appended as "offset crc" once it is on disk.
+        self._state = open(self._state_path, "w")
+        self._state.write(json.dumps({"transfer": self.transfer, "size": self.size,
+                                      "chunk": self.chunk}) + "\n")
+        for offset, crc in self._verified.items():
+            self._state.write(f"{offset} {crc}\n")
+        # Disk writes happen on a thread of their own so a slow disk never
+        # stalls the network loop. The queue does not block, the connection
+        # is throttled instead while the writer is behind.
+        self._jobs = Queue()
+        self._writer = Thread(target=self._write_loop, name="file-writer", daemon=True)
+        self._writer.start()
+
+    @property
+    def done(self) -> bool:
+        return self._received >= self.size
+
+    def missing(self):
+        ranges = []
+        for offset, length in self._chunks():
+            if offset in self._verified:
+                continue
+            end = offset + length
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1][1] = end
+            else:
+                ranges.append([offset, end])
+        return ranges
+
+    def wanted(self) -> bytes:
+        # One bit per chunk in file order, set for the ones still missing.
+        bits = bytearray((len(self._spans) + 7) // 8)
+        for index, offset in enumerate(self._spans):
+            if offset not in self._verified:
+                bits[index >> 3] |= 0x80 >> (index & 7)
+        return bytes(bits)
+
+    def write(self, offset: int, crc: int, data) -> bool:
+        if crc32(data) != crc:
+            error(f"Checksum mismatch at offset {offset} of {self.filepath}")
+            self._retry(offset)
+            return False
+        if self._spans is not None and self._spans.get(offset) != len(data):
+            error(f"Chunk at offset {offset} of {self.filepath} does not match the offer")
+            return False
+        if offset not in self._verified:
+            self._verified[offset] = crc
+            self._received += len(data)
+            self._jobs.put((offset, crc, data))
+        return True
+
+    def _retry(self, offset: int):
+        # The length comes from the offer, not from the damaged frame.
+        if self._spans is not None:
+            length = self._spans.get(offset)
+        elif offset % self.chunk == 0:
+            length = min(self.chunk, self.size - offset)
+        else:
+            length = None
+        tries = self._retries[offset] = self._retries.get(offset, 0) + 1
+        if (self._refetch and length and length > 0 and offset not in self._verified
+                and tries <= MAX_RETRIES):
+            self._refetch([[offset, offset + length]])
+
+    def throttle(self, resume) -> bool:
+        # True when WRITE_QUEUE_SIZE jobs are waiting, resume is then called
+        # on the writer thread once half of them are done.
+        with self._lock:
+            if self._closed or self._jobs.qsize() < WRITE_QUEUE_SIZE:
+                return False
+            self._waiting.append(resume)
+            return True
+
+    def reuse(self, offset: int, load) -> bool:
+        # A chunk this node has already, load reads it on the writer thread.
+        if offset in self._verified:
+            return False
+        self._verified[offset] = None
+        self._received += self._spans[offset]
+        self._jobs.put((offset, None, load))
+        return True
+
+    def finish(self, callback=None):
+        # Runs after every queued chunk is written, callback is called on the
+        # writer thread once the file has its final name.
+        def finish():
+            self._close()
+            if self._failed:
+                error(f"{self.filepath} is incomplete, kept as {self._part_path}")
+                return
+            self._move_in_place()
+            os.remove(self._state_path)
+            if callback:
+                callback()
+        self._jobs.put(finish)
+
+    def suspend(self):
+        # Keeps the partial file and the sidecar for the next attempt, the
+        # chunks already queued are written first on the writer thread.
+        _suspended[self._part_path] = self._writer
+        self._jobs.put(self._close)
+
+    def _chunks(self):
+        if self._spans is not None:
+            return self._spans.items()
+        return ((offset, min(self.chunk, self.size - offset))
+                for offset in range(0, self.size, self.chunk))
+
+    def _open_storage(self, resume: bool):
+        if resume:
+            self._file = open(self._part_path, "r+b", buffering=0)
+        else:
+            self._file = open(self._part_path, "w+b", buffering=0)
+            _preallocate(self._file.fileno(), self.size)
+
+    def _write_run(self, offset: int, buffers):
+        _write_at(self._file, offset, buffers)
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def _close_storage(self):
+        self._file.close()
+
+    def _move_in_place(self):
+        os.replace(self._part_path, self.filepath)
+
+    def _close(self):
+        self._closed = True
+        self._close_storage()
+        self._state.close()
+
+    def _release(self, closing: bool = False):
+        with self._lock:
+            if not closing and self._jobs.qsize() > WRITE_QUEUE_SIZE // 2:
+                return
+            waiting, self._waiting = self._waiting, []
+        for resume in waiting:
+            resume()
+
+    def _write_loop(self):
+        try:
+            self._write_jobs()
+        finally:
+            self._release(closing=True)
+            if _suspended.get(self._part_path) is self._writer:
+                del _suspended[self._part_path]
+
+    def _write_jobs(self):
+        item = None
+        while not self._closed:
+            if self._waiting:
+                self._release()
+            if item is None:
+                item = self._resolve(self._jobs.get())
+            if callable(item):
+                try:
+                    item()
+                except OSError:
+                    exception(f"Couldn't finish {self.filepath}")
+                    self._close()
+                item = None
+                continue
+            # Chunks that follow each other in the queue and in the file go
+            # out in one positioned write.
+            run = [item]
+            end = item[0] + len(item[2])
+            item = None
+            while len(run) < WRITE_BATCH:
+                try:
+                    item = self._resolve(self._jobs.get_nowait())
+                except Empty:
+                    item = None
+                    break
+                if callable(item) or item[0] != end:
+                    break
+                run.append(item)
+                end += len(item[2])
+                item = None
+            if self._failed:
+                continue
+            try:
+                self._write_run(run[0][0], [data for _, _, data in run])
+            except OSError:
+                # The rest of the transfer is drained and dropped, the chunks
+                # on record can still be resumed later.
+                exception(f"Couldn't write to {self._part_path}")
+                self._failed = True
+                continue
+            self._state.write("".join(f"{offset} {crc}\n" for offset, crc, _ in run))
+
+    def _resolve(self, item):
+        # Chunks taken from the store are read here, off the network thread.
+        if callable(item) or item[1] is not None:
+            return item
+        offset, _, load = item
+        data = load()
+        if data is None:
+            error(f"Chunk at offset {offset} of {self.filepath} left the store before it was copied")
+            self._failed = True
+            data = b""
+        crc = self._verified[offset] = crc32(data)
+        return offset, crc, data
+
+    def _load_state(self) -> bool:
+        if not (exists(self._state_path) and exists(self._part_path)):
+            return False
+        with open(self._state_path) as state:
+            try:
+                meta = json.loads(state.readline())
+            except json.JSONDecodeError:
+                return False
+            if meta != {"transfer": self.transfer, "size": self.size, "chunk": self.chunk}:
+                return False
+            for line in state:
+                try:
+                    offset, crc = map(int, line.split())
+                except ValueError:
+                    break
+                self._verified[offset] = crc
+        return True
+
+    def _verify(self):
+        # Chunks are checked against their recorded crc, anything that did not
+        # make it to disk intact is requested again.
+        lengths = dict(self._chunks())
+        for offset, crc in list(self._verified.items()):
+            data = self._read_at(offset, lengths.get(offset, 0))
+            if crc32(data) == crc:
+                self._received += len(data)
+            else:
+                del self._verified[offset]
+
+
+class IncomingTree(IncomingFile):
+    # The files of a manifest are written into a hidden staging directory
+    # in the downloads, chunks that span several files are split among
+    # them. Once everything is verified the top level entries are moved in
+    # place, under a new name where one is taken already, and the modes
+    # from the manifest applied to what was moved.
+    def __init__(self, manifest, directory: str = ".", refetch=None) -> None:
+        self.directory = directory
+        name = f".{manifest.transfer}"
+        self.tree = Tree.staged(manifest.entries, join(directory, name + PART_SUFFIX))
+        self._files = {}
+        super().__init__(manifest, directory, name, refetch=refetch)
+
+    def _open_storage(self, resume: bool):
+        # Files are created on their first write, only the directories are
+        # needed up front.
+        os.makedirs(self._part_path, exist_ok=True)
+        for path, size, _ in self.tree.entries:
+            if size == DIRECTORY:
+                os.makedirs(join(self._part_path, *path.split("/")), exist_ok=True)
+
+    def _write_run(self, offset: int, buffers):
+        data = memoryview(b"".join(buffers))
+        start = 0
+        for index, at, count in self.tree.segments(offset, len(data)):
+            _write_at(self._file_at(index), at, [data[start:start + count]])
+            start += count
+
+    def _file_at(self, index: int):
+        file = self._files.pop(index, None)
+        if file is None:
+            if len(self._files) >= OPEN_FILES:
+                self._files.pop(next(iter(self._files))).close()
+            fd = os.open(self.tree.paths[index], os.O_RDWR | os.O_CREAT, 0o600)
+            file = os.fdopen(fd, "r+b", buffering=0)
+        self._files[index] = file
+        return file
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        try:
+            with self.tree.open() as reader:
+                reader.seek(offset)
+                return reader.read(size)
+        except OSError:
+            # Never written, the chunk is requested again.
+            return b""
+
+    def _close_storage(self):
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+
+    def _move_in_place(self):
+        for (_, size, _), path in zip(self.tree.files(), self.tree.paths):
+            if not size:
+                # Empty files never saw a write.
+                open(path, "ab").close()
+        tops = {}
+        for path, _, _ in self.tree.entries:
+            top = path.split("/")[0]
+            if top not in tops:
+                tops[top] = _free_name(self.directory, top)
+                os.rename(join(self._part_path, top), join(self.directory, tops[top]))
+        os.rmdir(self._part_path)
+        # Children first, a read-only directory still takes its files.
+        for path, _, mode in reversed(self.tree.entries):
+            top, *rest = path.split("/")
+            os.chmod(join(self.directory, tops[top], *rest), mode & 0o777)
+
+
+def _free_name(directory: str, name: str) -> str:
+    # Nothing that is there already is merged into or replaced, the
+    # transfer lands next to it as "name (1)", "name (2)" and so on.
+    stem, ext = splitext(name)
+    candidate, number = name, 0
+    while lexists(join(directory, candidate)):
+        number += 1
+        candidate = f"{stem} ({number}){ext}"
+    return candidate
+
+
+def _mode(path: str) -> int:
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def _posix(path: str) -> str:
+    return path.replace(os.sep, "/")
+
+
+def _preallocate(fd: int, size: int):
+    # Reserves the blocks up front where the platform allows it, otherwise the
+    # file is at least extended to its final size.
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def _write_at(file, offset: int, buffers):
+    if not hasattr(os, "pwritev"):
+        file.seek(offset)
+        for data in buffers:
+            file.write(data)
+        return
+    fd = file.fileno()
+    while buffers:
+        written = os.pwritev(fd, buffers, offset)
+        offset += written
+        # A short write leaves part of the buffers for the next call.
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
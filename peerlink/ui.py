@@ -1,15 +1,28 @@
+import json
+from array import array
 from datetime import datetime
 from functools import partial
+from os import SEEK_END
+from tempfile import TemporaryFile
 from time import time
 
-from PyQt6.QtCore import QObject, Qt, pyqtSignal
+from PyQt6.QtCore import (QAbstractListModel, QModelIndex, QObject, Qt,
+                          QTimer, pyqtSignal)
 from PyQt6.QtGui import QIcon, QPixmap
-from PyQt6.QtWidgets import (QApplication, QFileDialog, QGridLayout,
-                             QHBoxLayout, QLabel, QLineEdit, QMessageBox,
-                             QPushButton, QScrollArea, QTextEdit, QVBoxLayout,
-                             QWidget)
+from PyQt6.QtWidgets import (QAbstractItemView, QApplication, QFileDialog,
+                             QHBoxLayout, QLabel, QLineEdit, QListView,
+                             QMessageBox, QProgressBar, QPushButton,
+                             QVBoxLayout, QWidget)
+from peerlink import history
 from peerlink.utils import resource_path
 
+# Chat lines kept in memory, older ones are spooled to disk and read back
+# CHAT_PAGE at a time when scrolled to the top, then the peer's history.
+CHAT_WINDOW = 500
+CHAT_PAGE = 100
+# Lines arriving within this many milliseconds are inserted together.
+CHAT_FLUSH_MS = 30
+
 # https://stackoverflow.com/questions/69594116/passing-generic-type-to-inner-class
 # A modified version
 class QSignal:
@@ -23,6 +36,184 @@ class QSignal:
     def connect(self, slot):
         self.emitter.signal.connect(slot)
 
+    def disconnect(self, slot):
+        self.emitter.signal.disconnect(slot)
+
+
+class PeerListModel(QAbstractListModel):
+    # Rows keyed by service name or uuid. Adding or removing one only touches
+    # its own row, the view never rebuilds the rest.
+    def __init__(self, icon: str, parent=None):
+        super().__init__(parent)
+        self._icon = QIcon(icon)
+        self._keys = []
+        self._entries = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._keys)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._keys):
+            return None
+        key = self._keys[index.row()]
+        entry = self._entries[key]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return entry['name']
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self._icon
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return f"{entry['ip']}:{entry['port']}"
+        if role == Qt.ItemDataRole.UserRole:
+            return key
+        return None
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def add(self, key, name, ip, port):
+        entry = {'name': name, 'ip': ip, 'port': port}
+        if key in self._entries:
+            self._entries[key] = entry
+            index = self.index(self._keys.index(key))
+            self.dataChanged.emit(index, index)
+            return
+        row = len(self._keys)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._keys.append(key)
+        self._entries[key] = entry
+        self.endInsertRows()
+
+    def remove(self, key):
+        if key not in self._entries:
+            return
+        row = self._keys.index(key)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._keys[row]
+        del self._entries[key]
+        self.endRemoveRows()
+
+    def reset(self, entries: dict):
+        # entries is updated from other threads, a copy is taken in one step.
+        self.beginResetModel()
+        self._entries = {key: {'name': entry['name'], 'ip': entry['ip'], 'port': entry['port']}
+                         for key, entry in entries.copy().items()}
+        self._keys = list(self._entries)
+        self.endResetModel()
+
+
+class ChatSpool:
+    # Chat lines evicted from the view, newest last, in a temporary file.
+    def __init__(self) -> None:
+        self._file = TemporaryFile()
+        self._offsets = array('Q')
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def push(self, rows):
+        self._file.seek(0, SEEK_END)
+        for row in rows:
+            self._offsets.append(self._file.tell())
+            self._file.write(json.dumps(row).encode() + b"\n")
+
+    def pop(self, count: int):
+        # Takes back the newest count lines, the ones just above the view.
+        count = min(count, len(self._offsets))
+        if not count:
+            return []
+        start = self._offsets[-count]
+        self._file.seek(start)
+        rows = [tuple(json.loads(line)) for line in self._file.read().splitlines()]
+        del self._offsets[-count:]
+        self._file.truncate(start)
+        return rows
+
+    def close(self):
+        self._file.close()
+
+
+class ChatModel(QAbstractListModel):
+    # Rows are (text, alignment). At most limit of them stay in memory while
+    # the view follows the newest line, the rest wait in a ChatSpool. Once
+    # that is empty, source(count) is asked for lines from before the view.
+    def __init__(self, limit: int = CHAT_WINDOW, parent=None):
+        super().__init__(parent)
+        self.limit = limit
+        self.follow = True
+        self.source = None
+        self._rows = []
+        self._pending = []
+        self._spool = ChatSpool()
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(CHAT_FLUSH_MS)
+        self._timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        text, align = self._rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return text
+        if role == Qt.ItemDataRole.TextAlignmentRole:
+            return Qt.AlignmentFlag(align)
+        return None
+
+    @property
+    def has_older(self) -> bool:
+        return bool(len(self._spool) or self.source)
+
+    def append(self, text: str, align=Qt.AlignmentFlag.AlignLeft):
+        self._pending.append((text, align.value))
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        self._timer.stop()
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+        if self.follow:
+            self.trim()
+
+    def trim(self):
+        excess = len(self._rows) - self.limit
+        if excess <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        self._spool.push(self._rows[:excess])
+        del self._rows[:excess]
+        self.endRemoveRows()
+
+    def load_older(self, count: int = CHAT_PAGE) -> int:
+        rows = self._spool.pop(count)
+        if not rows and self.source:
+            rows = self.source(count)
+            if len(rows) < count:
+                self.source = None
+        if rows:
+            self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+            self._rows[:0] = rows
+            self.endInsertRows()
+        return len(rows)
+
+    def clear(self):
+        self._timer.stop()
+        self.beginResetModel()
+        self._rows = []
+        self._pending = []
+        self.source = None
+        self._spool.close()
+        self._spool = ChatSpool()
+        self.endResetModel()
+
 
 class LoginWindow(QWidget):
     def __init__(self):
@@ -60,25 +251,19 @@ class ConnectionWindow(QWidget):
         self.label = QLabel("Available Peers :")
         self.reload_btn = QPushButton(QIcon(resource_path("icons/reload.png")), "")
 
-        self.peer_list_area = QScrollArea()
-        self.peer_list_widget = QWidget()
-        self.peer_list_layout = QGridLayout(self.peer_list_widget)
-        self.peer_list_area.setWidgetResizable(True)
-        self.peer_list_area.setWidget(self.peer_list_widget)
+        self.peer_list = QListView()
+        self.peer_list.setUniformItemSizes(True)
 
         self.req_label = QLabel("Incoming Requests :")
-        self.req_list_area = QScrollArea()
-        self.req_list_container = QWidget()
-        self.req_list_layout = QGridLayout(self.req_list_container)
-        self.req_list_area.setWidgetResizable(True)
-        self.req_list_area.setWidget(self.req_list_container)
+        self.req_list = QListView()
+        self.req_list.setUniformItemSizes(True)
 
         h_layout.addWidget(self.label)
         h_layout.addWidget(self.reload_btn)
         root_layout.addLayout(h_layout)
-        root_layout.addWidget(self.peer_list_area)
+        root_layout.addWidget(self.peer_list)
         root_layout.addWidget(self.req_label)
-        root_layout.addWidget(self.req_list_area)
+        root_layout.addWidget(self.req_list)
 
         self.setLayout(root_layout)
 
@@ -96,15 +281,21 @@ class ChatWindow(QWidget):
         self.conn_label = QLabel("Connected to : ")
         self.disconnect_btn = QPushButton("Disconnect")
 
-        self.chat_widget = QTextEdit()
-        self.chat_widget.ensureCursorVisible()
-        self.chat_widget.setAcceptRichText(True)
-        self.chat_widget.setReadOnly(True)
-        self.chat_widget.setTextInteractionFlags(
-            Qt.TextInteractionFlag.NoTextInteraction
-        )
+        self.chat_view = QListView()
+        self.chat_view.setWordWrap(True)
+        self.chat_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_view.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.chat_view.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.hide()
 
         self.files_btn = QPushButton(QIcon(resource_path("icons/upload.png")), "")
+        self.files_btn.setToolTip("Send files")
+        self.folder_btn = QPushButton(QIcon(resource_path("icons/attach.png")), "")
+        self.folder_btn.setToolTip("Send a folder")
         self.chat_text = QLineEdit()
         self.send_btn = QPushButton("send")
         self.send_btn.setShortcut("Return")
@@ -113,11 +304,13 @@ class ChatWindow(QWidget):
         v1_layout.addWidget(self.disconnect_btn)
 
         v2_layout.addWidget(self.files_btn)
+        v2_layout.addWidget(self.folder_btn)
         v2_layout.addWidget(self.chat_text)
         v2_layout.addWidget(self.send_btn)
 
         root_layout.addLayout(v1_layout)
-        root_layout.addWidget(self.chat_widget)
+        root_layout.addWidget(self.chat_view)
+        root_layout.addWidget(self.progress_bar)
         root_layout.addLayout(v2_layout)
 
         self.setLayout(root_layout)
@@ -130,12 +323,19 @@ class Controller(QObject):
         conn_win: ConnectionWindow,
         chat_win: ChatWindow,
         model=None,
+        chat_limit=CHAT_WINDOW,
     ):
         super().__init__()
         self.login_ui = login_win
         self.conn_ui = conn_win
         self.chat_ui = chat_win
         self.model = model
+        self.peers = PeerListModel(resource_path("icons/add.png"), self)
+        self.requests = PeerListModel(resource_path("icons/accept.png"), self)
+        self.conn_ui.peer_list.setModel(self.peers)
+        self.conn_ui.req_list.setModel(self.requests)
+        self.chat = ChatModel(chat_limit, self)
+        self.chat_ui.chat_view.setModel(self.chat)
         self._bind_btn()
         self._bind_callback()
 
@@ -144,7 +344,12 @@ class Controller(QObject):
         self.conn_ui.reload_btn.clicked.connect(self._reload)
         self.chat_ui.send_btn.clicked.connect(self._send_msg)
         self.chat_ui.files_btn.clicked.connect(self._send_file)
+        self.chat_ui.folder_btn.clicked.connect(self._send_folder)
         self.chat_ui.disconnect_btn.clicked.connect(self._disconnect)
+        self.conn_ui.peer_list.clicked.connect(self._peer_clicked)
+        self.conn_ui.req_list.clicked.connect(self._req_clicked)
+        self.chat.rowsInserted.connect(self._chat_inserted)
+        self.chat_ui.chat_view.verticalScrollBar().valueChanged.connect(self._chat_scrolled)
 
     def _bind_callback(self):
         self.login_ui.closeEvent = self.shutdown
@@ -153,43 +358,58 @@ class Controller(QObject):
         self.model.onreqacpt.connect(self._accept_req)
         self.model.onreqrecv.connect(self.new_req)
         self.model.ondevicediscovery.connect(self.new_peer)
-        self.model.ondeviceloss.connect(self._reload)
+        self.model.ondeviceloss.connect(self.lost_peer)
         self.model.ontext.connect(self._recv_text)
         self.model.onfile.connect(self._recv_file)
         self.model.onfilefinished.connect(self._file_recved)
         self.model.ondisconnect.connect(self._remote_disconnect)
         self.model.onconnsecure.connect(self._conn_secured)
+        self.model.onfileprogress.connect(self._file_progress)
+        self.model.onfilesent.connect(self._file_sent)
+        self.model.onsenderror.connect(self._send_error)
 
     def new_peer(self, name, host, port):
-        self._add_to_grid(
-            self.conn_ui.peer_list_layout,
-            name,
-            resource_path("icons/add.png"),
-            partial(self.model.send_req, host, port),
-        )
+        self.peers.add(name, name, host, port)
 
-    def new_req(self, name, host, port):
-        self._add_to_grid(
-            self.conn_ui.req_list_layout,
-            name,
-            resource_path("icons/accept.png"),
-            partial(self.model.accept_req, host, port),
-        )
+    def lost_peer(self, name):
+        self.peers.remove(name)
+
+    def new_req(self, uuid, name, host, port):
+        self.requests.add(uuid, name, host, port)
 
     def shutdown(self, event):
         self.model.shutdown()
         event.accept()
 
-    def _recv_text(self, text, time):
-        self.chat_ui.chat_widget.append(f"{self._posix_to_datetime(time)} - {text}")
-        self.chat_ui.chat_widget.setAlignment(Qt.AlignmentFlag.AlignLeft)
+    def _recv_text(self, uuid, text, time):
+        if uuid != self.model.active:
+            text = f"{self._peer_name(uuid)}: {text}"
+        self.chat.append(f"{self._posix_to_datetime(time)} - {text}", Qt.AlignmentFlag.AlignLeft)
 
-    def _conn_secured(self):
-        self._chat_print_info("Connection is secured.")
+    def _conn_secured(self, uuid):
+        self._chat_print_info(f"Connection with {self._peer_name(uuid)} is secured.")
+
+    def _peer_name(self, uuid):
+        return self.model.sessions.names.get(uuid, uuid)
 
     def _chat_print_info(self, text):
-        self.chat_ui.chat_widget.append(text)
-        self.chat_ui.chat_widget.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.chat.append(text, Qt.AlignmentFlag.AlignCenter)
+
+    def _chat_inserted(self, parent, first, last):
+        # Lines added at the bottom keep it in view unless the user scrolled up.
+        if self.chat.follow and last == self.chat.rowCount() - 1:
+            self.chat_ui.chat_view.scrollToBottom()
+
+    def _chat_scrolled(self, value):
+        bar = self.chat_ui.chat_view.verticalScrollBar()
+        self.chat.follow = value >= bar.maximum()
+        if self.chat.follow:
+            self.chat.trim()
+        elif value == bar.minimum() and self.chat.has_older:
+            loaded = self.chat.load_older()
+            # The line that was on top stays there.
+            self.chat_ui.chat_view.scrollTo(
+                self.chat.index(loaded), QAbstractItemView.ScrollHint.PositionAtTop)
 
     def _switch_btn_state(self, *args, disable=True):
         for btn in args:
@@ -199,30 +419,57 @@ class Controller(QObject):
                 btn.setDisabled(False)
 
     def _reload(self):
-        self._refill_grid(
-            self.conn_ui.peer_list_layout, self.model.local_devices, self.new_peer
-        )
-
-    def _recv_file(self, filename, time):
-        self._switch_btn_state(self.chat_ui.send_btn, self.chat_ui.files_btn)
-        self._chat_print_info(f"Receiving file {filename}")
-
-    def _file_recved(self):
-        self._switch_btn_state(
-            self.chat_ui.send_btn, self.chat_ui.files_btn, disable=False
-        )
-        self._chat_print_info(f"File received")
-
-    def _remote_disconnect(self):
-        self._chat_print_info("Connection shutdown by remote peer.")
-        self._switch_btn_state(self.chat_ui.send_btn, self.chat_ui.files_btn)
-
-    def _refill_grid(self, grid, item_list, add_func):
-        for i in range(grid.count()):
-            grid.itemAt(i).widget().deleteLater()
-
-        for i in item_list:
-            add_func(i["name"], i["ip"], i["port"])
+        self.peers.reset(self.model.local_devices)
+
+    def _peer_clicked(self, index):
+        peer = self.peers.get(index.data(Qt.ItemDataRole.UserRole))
+        if peer:
+            self.model.send_req(peer['ip'], peer['port'])
+
+    def _req_clicked(self, index):
+        uuid = index.data(Qt.ItemDataRole.UserRole)
+        self.requests.remove(uuid)
+        self.model.accept_req(uuid)
+
+    def _open_history(self, uuid):
+        if self.model.history:
+            self.chat.source = partial(self._history_lines, self.model.history.pager(uuid))
+            self.chat.load_older()
+
+    def _history_lines(self, pager, count):
+        return [self._history_line(row) for row in pager.older(count)]
+
+    def _history_line(self, row):
+        # The same lines the chat shows live, built from a history row.
+        name = self._peer_name(row["peer"])
+        kind, text, when = row["kind"], row["text"], self._posix_to_datetime(row["time"])
+        if kind == history.TEXT and row["outgoing"]:
+            return (f"{text} - {when}", Qt.AlignmentFlag.AlignRight.value)
+        if kind == history.TEXT:
+            return (f"{when} - {text}", Qt.AlignmentFlag.AlignLeft.value)
+        if kind == history.FILE and row["outgoing"]:
+            text = f"Sending file - {text}"
+        elif kind == history.FILE:
+            text = f"Receiving file {text} from {name}"
+        elif kind == history.FILE_RECIEVED:
+            text = f"File received from {name}"
+        elif kind == history.FILE_SENT:
+            text = "File sent"
+        elif kind == history.FILE_FAILED:
+            text = f"Sending failed - {text}"
+        return (text, Qt.AlignmentFlag.AlignCenter.value)
+
+    def _recv_file(self, uuid, filename, time):
+        self._chat_print_info(f"Receiving file {filename} from {self._peer_name(uuid)}")
+
+    def _file_recved(self, uuid):
+        self._chat_print_info(f"File received from {self._peer_name(uuid)}")
+
+    def _remote_disconnect(self, uuid):
+        self._chat_print_info(f"Connection shutdown by {self._peer_name(uuid)}.")
+        if self.model.active is None:
+            self._switch_btn_state(self.chat_ui.send_btn, self.chat_ui.files_btn,
+                                   self.chat_ui.folder_btn)
 
     def _posix_to_datetime(self, time):
         time = datetime.fromtimestamp(time)
@@ -252,35 +499,61 @@ class Controller(QObject):
             msg = self.chat_ui.chat_text.text()
             self.chat_ui.chat_text.clear()
 
-            self.chat_ui.chat_widget.append(
-                f"{msg} - {self._posix_to_datetime(time())}"
+            self.chat.follow = True
+            self.chat.append(
+                f"{msg} - {self._posix_to_datetime(time())}", Qt.AlignmentFlag.AlignRight
             )
-            self.chat_ui.chat_widget.setAlignment(Qt.AlignmentFlag.AlignRight)
 
-            self.chat_ui.chat_widget.verticalScrollBar().setValue(
-                self.chat_ui.chat_widget.verticalScrollBar().maximum()
-            )
-
-            self.model.send_msg(msg)
+            if not self.model.send_msg(msg):
+                self._chat_print_info("Send queue is full, message dropped.")
             pass
 
     def _send_file(self):
-        filepath, type_ = QFileDialog.getOpenFileName(self.chat_ui, "Send File")
-        if not filepath == '':
-            self._chat_print_info(f"Sending file - {filepath}")
-            self._switch_btn_state(self.chat_ui.send_btn, self.chat_ui.files_btn)
-            self.model.send_file(filepath)
-            self._switch_btn_state(self.chat_ui.send_btn, self.chat_ui.files_btn, disable=False)
+        filepaths, type_ = QFileDialog.getOpenFileNames(self.chat_ui, "Send Files")
+        if len(filepaths) == 1:
+            self._sending(filepaths[0], self.model.send_file(filepaths[0]))
+        elif filepaths:
+            # Several files go out as one transfer.
+            self._sending(f"{len(filepaths)} files", self.model.send_files(filepaths))
+
+    def _send_folder(self):
+        folder = QFileDialog.getExistingDirectory(self.chat_ui, "Send Folder")
+        if folder:
+            self._sending(folder, self.model.send_files([folder]))
+
+    def _sending(self, name, queued):
+        if queued:
+            self._chat_print_info(f"Sending file - {name}")
+            self._switch_btn_state(self.chat_ui.files_btn, self.chat_ui.folder_btn)
+            self.chat_ui.progress_bar.setValue(0)
+            self.chat_ui.progress_bar.show()
+        else:
+            self._chat_print_info("Send queue is full, try again later.")
 
-        pass
+    def _file_progress(self, uuid, sent, total, rate, eta):
+        self.chat_ui.progress_bar.setValue(int(sent * 100 / total) if total else 100)
+        self.chat_ui.progress_bar.setFormat(
+            f"%p% - {rate / 1024 / 1024:.1f} MB/s - {int(eta)}s left"
+        )
+
+    def _file_sent(self, uuid, filepath):
+        self.chat_ui.progress_bar.hide()
+        self._switch_btn_state(self.chat_ui.files_btn, self.chat_ui.folder_btn, disable=False)
+        self._chat_print_info("File sent")
 
-    def _accept_req(self, name, ip, port):
+    def _send_error(self, uuid, error):
+        self.chat_ui.progress_bar.hide()
+        self._switch_btn_state(self.chat_ui.files_btn, self.chat_ui.folder_btn, disable=False)
+        self._chat_print_info(f"Sending failed - {error}")
+
+    def _accept_req(self, uuid, name, ip, port):
         self.chat_ui.conn_label.setText(f"Connected to : {name} ({ip}:{port})")
 
         self.chat_ui.move(self.conn_ui.pos())
-        self.chat_ui.chat_widget.clear()
+        self.chat.clear()
+        self._open_history(uuid)
         self._switch_btn_state(
-            self.chat_ui.send_btn, self.chat_ui.files_btn, disable=False
+            self.chat_ui.send_btn, self.chat_ui.files_btn, self.chat_ui.folder_btn, disable=False
         )
         self.chat_ui.show()
         self.conn_ui.hide()
@@ -289,15 +562,6 @@ class Controller(QObject):
         self.model.disconnect_n_return()
         self.chat_ui.hide()
         self._reload()
-        self._refill_grid(
-            self.conn_ui.req_list_layout, self.model.recv_reqs, self.new_req
-        )
+        self.requests.reset(self.model.recv_reqs)
         self.conn_ui.show()
         pass
-
-    def _add_to_grid(self, grid: QGridLayout, label: str, icon: str, callback):
-        btn = QPushButton(QIcon(icon), "")
-        btn.setFixedSize(30, 30)
-        btn.clicked.connect(callback)
-        grid.addWidget(QLabel(label), grid.rowCount(), 0)
-        grid.addWidget(btn, grid.rowCount() - 1, 1)
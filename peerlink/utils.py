@@ -1,103 +1,229 @@
 import json
+import os
 import sys
+from functools import partial
+from hashlib import sha1
 from inspect import getfullargspec
-from mimetypes import guess_type
-from os.path import abspath, getsize, join
-from time import time
+from logging import exception
+from os.path import abspath, dirname, join
+from queue import Empty, SimpleQueue
+from threading import RLock, Thread
 from uuid import UUID, uuid4
+from weakref import WeakMethod
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (Encoding, NoEncryption,
+                                                          PrivateFormat, PublicFormat)
+
+# Noise caps a transport message at 65535 bytes including the 16 byte
+# Poly1305 tag, file chunks stay page aligned and leave room below that limit.
+CHUNK_SIZE = 60 * 1024
+
+
+_SIGNATURES = {}
+
+
+def _slot_args(slot) -> list:
+    # Parameter names are looked up once per function, a lambda created in a
+    # loop or a method bound to many instances shares one code object.
+    func = getattr(slot, "__func__", slot)
+    key = getattr(func, "__code__", None)
+    args = _SIGNATURES.get(key) if key else None
+    if args is None:
+        args = [arg for arg in getfullargspec(slot).args if arg not in ("self", "cls")]
+        if key:
+            _SIGNATURES[key] = args
+    return args
+
+
+class Dispatcher:
+    # Queued slots run on whichever thread calls process(), or on a thread of
+    # the dispatcher's own after start().
+    def __init__(self) -> None:
+        self._queue = SimpleQueue()
+        self._thread = None
+
+    def post(self, slot, args, kwargs):
+        self._queue.put((slot, args, kwargs))
+
+    def process(self, timeout: float = None) -> int:
+        # Runs everything already queued, waiting up to timeout for the first.
+        done = 0
+        try:
+            item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+            while item is not None:
+                slot, args, kwargs = item
+                try:
+                    slot(*args, **kwargs)
+                except Exception:
+                    exception("Queued slot failed.")
+                done += 1
+                item = self._queue.get_nowait()
+        except Empty:
+            pass
+        return done
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="dispatcher", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            slot, args, kwargs = item
+            try:
+                slot(*args, **kwargs)
+            except Exception:
+                exception("Queued slot failed.")
 
 
 class Signal:
     def __init__(self, *args) -> None:
-        self.slots = []
         self.args = list(args)
-
-    def connect(self, slot):
-        argspec = getfullargspec(slot)
-        if "self" in argspec.args:
-            argspec.args.remove("self")
-        if "cls" in argspec.args:
-            argspec.args.remove("cls")
-        if self.args != argspec.args:
-            raise ValueError(f"Invalid Params/Arguments - {self.args}, {argspec.args}")
-        if not slot in self.slots:
-            self.slots.append(slot)
+        # (key, call) pairs and the calls alone, both replaced as a whole on
+        # every change so emit can iterate them without a lock.
+        self._entries = ()
+        self._calls = ()
+        # Weak slots expire from the garbage collector, which may run while
+        # this thread already holds the lock.
+        self._lock = RLock()
+
+    @property
+    def slots(self) -> list:
+        slots = (self._target(key) for key, _ in self._entries)
+        return [slot for slot in slots if slot is not None]
+
+    def connect(self, slot, weak: bool = False, dispatcher: Dispatcher = None):
+        args = _slot_args(slot)
+        if self.args != args:
+            raise ValueError(f"Invalid Params/Arguments - {self.args}, {args}")
+        key = slot
+        if weak and hasattr(slot, "__self__"):
+            # The signal does not keep the instance alive, the slot goes away
+            # with it.
+            key = WeakMethod(slot, self._expired)
+            call = self._weak_call(key)
+        else:
+            call = slot
+        if dispatcher:
+            call = partial(self._queued_call, dispatcher, call)
+        with self._lock:
+            if any(self._target(entry) == slot for entry, _ in self._entries):
+                return
+            self._replace(self._entries + ((key, call),))
 
     def emit(self, *args, **kwargs):
         if self.args and not args:
             raise ValueError("Params registered but not emitted.")
         elif not self.args and args:
             raise ValueError("Params not registered but attempted to emit.")
-        for slot in self.slots:
-            slot(*args, **kwargs)
+        for call in self._calls:
+            call(*args, **kwargs)
 
     def disconnect(self, slot):
-        if slot in self.slots:
-            self.slots.remove(slot)
-        else:
-            raise IndexError("Slot isnt connected to signal.")
+        with self._lock:
+            entries = tuple(entry for entry in self._entries if self._target(entry[0]) != slot)
+            if len(entries) == len(self._entries):
+                raise IndexError("Slot isnt connected to signal.")
+            self._replace(entries)
 
     def disconnectall(self):
-        for slot in self.slots:
-            self.disconnect(slot)
+        with self._lock:
+            self._replace(())
 
+    def _replace(self, entries):
+        # A slot that expired while the entries were being rebuilt is dropped
+        # with the next change.
+        entries = tuple(entry for entry in entries if self._target(entry[0]) is not None)
+        self._entries = entries
+        self._calls = tuple(call for _, call in entries)
 
-class MsgFormat(dict):
-    def __init__(cls, **kwargs):
-        kwargs["time"] = time()
-        super().__init__(**kwargs)
+    def _expired(self, ref):
+        with self._lock:
+            self._replace(tuple(entry for entry in self._entries if entry[0] is not ref))
 
-    @classmethod
-    def text(cls, text_: str):
-        return cls(text=text_)
+    @staticmethod
+    def _target(key):
+        return key() if isinstance(key, WeakMethod) else key
 
-    @classmethod
-    def file(cls, filepath: str):
-        return cls(
-            filename=filepath.split("/")[-1],
-            type=guess_type(filepath),
-            size=getsize(filepath),
-        )
+    @staticmethod
+    def _weak_call(ref):
+        def call(*args, **kwargs):
+            slot = ref()
+            if slot is not None:
+                slot(*args, **kwargs)
+        return call
 
-    @classmethod
-    def query_req(cls, name, uuid, ip, port):
-        return cls(query="req", name=name, uuid=uuid, ip=ip, port=port)
+    @staticmethod
+    def _queued_call(dispatcher, call, *args, **kwargs):
+        dispatcher.post(call, args, kwargs)
 
-    @classmethod
-    def query_shut(cls):
-        return cls(query="shut")
 
-    @classmethod
-    def query_acpt(cls, name, uuid, ip, port):
-        return cls(query="acp", name=name, uuid=uuid, ip=ip, port=port)
+class DirectSignal:
+    # The interface of ui.QSignal without Qt, for running headless. Slots run
+    # on the emitting thread, the argument types are only for symmetry.
+    def __init__(self, *types) -> None:
+        self._slots = ()
 
-    def pack(self):
-        return json.dumps(self).encode("utf-8")
+    def connect(self, slot):
+        self._slots += (slot,)
+
+    def disconnect(self, slot):
+        self._slots = tuple(s for s in self._slots if s != slot)
+
+    def emit(self, *args, **kwargs):
+        for slot in self._slots:
+            slot(*args, **kwargs)
 
-    @staticmethod
-    def unpack(bytes_) -> dict:
-        try:
-            return json.loads(bytes_)
-        except json.JSONDecodeError:
-            print(str(bytes_, encoding="utf-8"))
-            raise
+
+def transfer_id(filepath: str) -> str:
+    # Stable across reconnects for as long as the file is unchanged.
+    stat = os.stat(filepath)
+    key = f"{os.path.basename(filepath)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return sha1(key.encode("utf-8")).hexdigest()[:16]
 
 
 class Peer:
-    def __init__(self, username: str) -> None:
+    def __init__(self, username: str, uuid: UUID = None, priv_key: bytes = None) -> None:
         self.username = username
-        self.uuid: UUID = uuid4()
-        self.priv_key: bytes
-        self.pub_key: bytes
+        self.uuid: UUID = uuid or uuid4()
+        self.priv_key: bytes = priv_key or self.gen_priv_key()
+        self.pub_key: bytes = self.gen_pub_key()
+
+    @classmethod
+    def load(cls, username: str, home: str):
+        # The uuid and the static key survive restarts so peers can recognise
+        # each other, they are kept per username under home.
+        path = join(home, username, "identity.json")
+        try:
+            with open(path) as file:
+                identity = json.load(file)
+            return cls(username, UUID(identity["uuid"]), bytes.fromhex(identity["priv_key"]))
+        except (OSError, ValueError, KeyError):
+            pass
+        peer = cls(username)
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            json.dump({"uuid": str(peer.uuid), "priv_key": peer.priv_key.hex()}, file)
+        return peer
 
     def get_uuid(self) -> str:
         return str(self.uuid).replace("-", "")
 
-    def gen_priv_key(self):
-        pass
+    def gen_priv_key(self) -> bytes:
+        key = X25519PrivateKey.generate()
+        return key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
 
-    def gen_pub_key(self):
-        pass
+    def gen_pub_key(self) -> bytes:
+        key = X25519PrivateKey.from_private_bytes(self.priv_key)
+        return key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
 
 def resource_path(relative_path) -> str:
     try: